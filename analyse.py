@@ -1,10 +1,8 @@
 import pandas as pd
 import ast
-import matplotlib.pyplot as plt
-import pandas as pd
-import matplotlib.dates as mdates
 from datetime import datetime
 import json
+from metrics import traced
 
 
 
@@ -19,6 +17,7 @@ def sum_reactions(reaction_str):
         return 0  # Return 0 for invalid or empty entries
 
 
+@traced()
 def sum_reactions_by_type(df, column='reactions'):
     reaction_sums = {}
     for reaction_str in df[column]:
@@ -37,6 +36,7 @@ def sum_reactions_by_type(df, column='reactions'):
 
 
 # New function to calculate sum of reactions by date
+@traced()
 def sum_reactions_by_date(df, date_column='date', reaction_column='reactions'):
     reaction_sums_by_date = {}
     for index, row in df.iterrows():
@@ -100,6 +100,7 @@ def sort_dictionary_by_values(d, ascending=False):
         # Handle non-numeric values or invalid input gracefully
         return {}  
 
+@traced()
 def analyze_content_type(df):
     """
     Analyzes the 'type_of_content' field in the 'json' column of a DataFrame.
@@ -129,12 +130,17 @@ def analyze_content_type(df):
             
     return content_type_counts
 
-def analyze_entities(df):
+@traced()
+def analyze_entities(df, return_values=False, resolver=None):
     """
     Analyzes the 'entities' object in the 'json' column of a DataFrame.
     
     Parameters:
         df (pandas.DataFrame): DataFrame with a 'json' column containing JSON strings.
+        return_values (bool): If True, return the set of unique values instead of its size
+            (needed to merge results across partitions).
+        resolver (EntityResolver): Optional entity mapping (see entity_resolution.py); name
+            variants of one entity are then counted once and entity types are merged.
         
     Returns:
         tuple: (dict, int)
@@ -155,6 +161,9 @@ def analyze_entities(df):
             entities = json_data.get('entities', {})
             # Count each entity key and collect unique values
             for key, values in entities.items():
+                if resolver is not None:
+                    values = _resolve_values(resolver, key, values)
+                    key = resolver.type_name(key)
                 # Update key count
                 entity_key_counts[key] = entity_key_counts.get(key, 0) + 1
                 # Add values to the set (assuming values is a list)
@@ -167,12 +176,16 @@ def analyze_entities(df):
             continue
     
     
+    if return_values:
+        return entity_key_counts, unique_values
+
     # Count of unique values
     unique_values_count = len(unique_values)
     
     return entity_key_counts, unique_values_count
 
 
+@traced()
 def analyze_hashtags(df):   
     """
     Analyzes the 'hashtags' object in the 'json' column of a DataFrame.
@@ -197,13 +210,25 @@ def analyze_hashtags(df):
     return hashtag_counts
 
 
-def analyze_entity_pairs(df):
+def _resolve_values(resolver, entity_type, values):
+    """Replaces entity names by the canonical IDs of their clusters."""
+    if isinstance(values, str):
+        values = [values]
+    if not isinstance(values, list):
+        return values
+    return [resolver.canonical_id(entity_type, v) for v in values if isinstance(v, str) and v.strip()]
+
+
+@traced()
+def analyze_entity_pairs(df, resolver=None):
     """
     Analyzes the 'entities' object in the 'json' column of a DataFrame and returns
     a dictionary with tuple keys representing entity pairs and their occurrence counts.
     
     Parameters:
         df (pandas.DataFrame): DataFrame with a 'json' column containing JSON strings.
+        resolver (EntityResolver): Optional entity mapping; spellings of one entity type
+            ("Country", "country", "Countries") then form a single key.
         
     Returns:
         dict: Dictionary with tuple keys (entity_name1, entity_name2) and values as counts.
@@ -224,7 +249,10 @@ def analyze_entity_pairs(df):
                 continue
             
             # Get all entity keys from the dictionary
-            entity_keys = list(entities.keys())
+            if resolver is not None:
+                entity_keys = list(dict.fromkeys(resolver.type_name(key) for key in entities))
+            else:
+                entity_keys = list(entities.keys())
             
             # Generate all possible pairs of entities
             for i in range(len(entity_keys)):
@@ -241,6 +269,7 @@ def analyze_entity_pairs(df):
     return entity_pair_counts
 
 
+@traced()
 def extract_unique_entities_from_pairs(entity_pairs_dict):
     """
     Extracts unique entities from a dictionary with tuple keys and returns their counts.
@@ -264,20 +293,215 @@ def extract_unique_entities_from_pairs(entity_pairs_dict):
     return sort_dictionary_by_values(unique_entities_count)
 
 
+def date_to_month(date_str):
+    """
+    Converts an exported message date ("25.10.2015") to a month key ("2015-10").
+    
+    Parameters:
+        date_str (str): Date string in day.month.year format.
+        
+    Returns:
+        str or None: Month key in YYYY-MM format, or None if the date can't be parsed.
+    """
+    try:
+        return datetime.strptime(str(date_str), "%d.%m.%Y").strftime("%Y-%m")
+    except ValueError:
+        return None
 
 
+@traced()
+def analyze_content_type_by_month(df, date_column='date'):
+    """
+    Counts each 'type_of_content' per month.
+    
+    Parameters:
+        df (pandas.DataFrame): DataFrame with a date column and a 'json' column containing JSON strings.
+        date_column (str): Name of the date column.
+        
+    Returns:
+        dict: Dictionary {type_of_content: {month: count}}.
+    """
+    content_type_by_month = {}
+    for date_str, json_str in zip(df[date_column], df['json']):
+        month = date_to_month(date_str)
+        if month is None:
+            continue
+        try:
+            content_type = json.loads(str(json_str)).get('type_of_content')
+        except (json.JSONDecodeError, AttributeError):
+            continue
+        if content_type:
+            months = content_type_by_month.setdefault(content_type, {})
+            months[month] = months.get(month, 0) + 1
+    return content_type_by_month
 
 
-if __name__ == "__main__":
-    # Read the CSV file into a pandas DataFrame
-    df = pd.read_csv('telegram_messages.csv')
+@traced()
+def analyze_entity_trends(df, top_n=10, date_column='date'):
+    """
+    Counts how often each entity type is mentioned per month, for the top_n most frequent types.
+    
+    Parameters:
+        df (pandas.DataFrame): DataFrame with a date column and a 'json' column containing JSON strings.
+        top_n (int): Number of entity types to keep.
+        date_column (str): Name of the date column.
+        
+    Returns:
+        dict: Dictionary {entity_type: {month: count}}.
+    """
+    entity_by_month = {}
+    for date_str, json_str in zip(df[date_column], df['json']):
+        month = date_to_month(date_str)
+        if month is None:
+            continue
+        try:
+            entities = json.loads(str(json_str)).get('entities', {})
+        except (json.JSONDecodeError, AttributeError):
+            continue
+        if not isinstance(entities, dict):
+            continue
+        for key in entities:
+            months = entity_by_month.setdefault(key, {})
+            months[month] = months.get(month, 0) + 1
+
+    totals = sort_dictionary_by_values({k: sum_dictionary_values(v) for k, v in entity_by_month.items()})
+    return {k: entity_by_month[k] for k in list(totals)[:top_n]}
+
+
+@traced()
+def sum_reactions_by_month(df, date_column='date', reaction_column='reactions'):
+    """
+    Sums all reactions per month.
+    
+    Parameters:
+        df (pandas.DataFrame): DataFrame with date and reactions columns.
+        date_column (str): Name of the date column.
+        reaction_column (str): Name of the reactions column.
+        
+    Returns:
+        dict: Dictionary {month: total reactions}.
+    """
+    reaction_sums_by_month = {}
+    for date_str, reaction_str in zip(df[date_column], df[reaction_column]):
+        month = date_to_month(date_str)
+        if month is None:
+            continue
+        total = sum_reactions(reaction_str)
+        if total:
+            reaction_sums_by_month[month] = reaction_sums_by_month.get(month, 0) + total
+    return reaction_sums_by_month
+
+
+
+
+
+
+def merge_counts(dicts):
+    """
+    Sums several count dictionaries into one.
     
-    content_type_counts = sort_dictionary_by_values(analyze_content_type(df))
+    Parameters:
+        dicts (iterable): Dictionaries with numeric values.
+        
+    Returns:
+        dict: Dictionary with the summed count of every key.
+    """
+    merged = {}
+    for d in dicts:
+        for key, value in d.items():
+            merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def analyze_partition(csv_file, entity_map=None):
+    """
+    Computes the report aggregates of a single CSV file (one channel/month partition).
+    
+    Parameters:
+        csv_file (str): Path of a processed messages CSV.
+        entity_map (str): Optional entity mapping file written by entity_resolution.py.
+        
+    Returns:
+        dict: Aggregates of the partition, see analyze_frame.
+    """
+    df = pd.read_csv(csv_file, usecols=lambda c: c in ('date', 'reactions', 'json'))
+    if 'json' not in df.columns:
+        df['json'] = None
+    return analyze_frame(df, _load_resolver(entity_map))
+
+
+def _load_resolver(entity_map):
+    if not entity_map:
+        return None
+    from entity_resolution import load_resolver
+    return load_resolver(entity_map)
+
+
+def analyze_frame(df, resolver=None):
+    """
+    Computes the report aggregates of a DataFrame with a 'json' column.
+    
+    Parameters:
+        df (pandas.DataFrame): Messages, or only the newly extracted ones (see watcher.py).
+        resolver (EntityResolver): Optional entity mapping, see analyze_entities.
+        
+    Returns:
+        dict: Aggregates that merge_results can combine.
+    """
+    entity_key_counts, entity_values = analyze_entities(df, return_values=True, resolver=resolver)
+    return {
+        'content_types': analyze_content_type(df),
+        'entity_keys': entity_key_counts,
+        'entity_values': entity_values,
+        'hashtags': analyze_hashtags(df),
+        'entity_pairs': analyze_entity_pairs(df, resolver=resolver),
+    }
+
+
+def analyze_partitions(csv_files, max_workers=4, entity_map=None):
+    """
+    Computes the report aggregates of many partitions in parallel and merges them.
+    
+    Parameters:
+        csv_files (list): Paths of partition CSV files (see read_sources.list_partitions).
+        max_workers (int): Number of worker processes.
+        entity_map (str): Optional entity mapping file written by entity_resolution.py.
+        
+    Returns:
+        dict: Merged aggregates, same keys as analyze_partition.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(analyze_partition, csv_files, [entity_map] * len(csv_files)))
+    return merge_results(results)
+
+
+def merge_results(results):
+    """
+    Combines aggregates of several partitions or batches into one.
+    
+    Parameters:
+        results (list): Dictionaries returned by analyze_frame.
+        
+    Returns:
+        dict: Merged aggregates with the same keys.
+    """
+    return {
+        'content_types': merge_counts(r['content_types'] for r in results),
+        'entity_keys': merge_counts(r['entity_keys'] for r in results),
+        'entity_values': set().union(*(r['entity_values'] for r in results)),
+        'hashtags': merge_counts(r['hashtags'] for r in results),
+        'entity_pairs': merge_counts(r['entity_pairs'] for r in results),
+    }
+
+
+def print_report(content_type_counts, entity_key_counts, unique_values_count, hashtags_counts, pair_entitis_count):
+    content_type_counts = sort_dictionary_by_values(content_type_counts)
     print("Count of analyzed news: ", sum_dictionary_values(content_type_counts))
     print("Type of News: ", content_type_counts)
 
     print("\n\n--------------------------------\n\n")
-    entity_key_counts, unique_values_count = analyze_entities(df)
 
     entity_key_counts = sort_dictionary_by_values(entity_key_counts)
 
@@ -289,7 +513,7 @@ if __name__ == "__main__":
 
     print("\n\n--------------------------------\n\n")
 
-    hashtags_counts = sort_dictionary_by_values(analyze_hashtags(df))
+    hashtags_counts = sort_dictionary_by_values(hashtags_counts)
     print("Length of Hashtags: ", len(hashtags_counts))
     hashtags_counts_greater10 = {k: v for k, v in hashtags_counts.items() if isinstance(v, (int, float)) and v > 10}
     print("Hashtags that have more than 1 value: ", len(hashtags_counts_greater10))
@@ -297,7 +521,7 @@ if __name__ == "__main__":
 
     print("\n\n--------------------------------\n\n")
 
-    pair_entitis_count = sort_dictionary_by_values(analyze_entity_pairs(df))
+    pair_entitis_count = sort_dictionary_by_values(pair_entitis_count)
     print("Number of Pair Entities: ", len(pair_entitis_count))
     pair_entitis_count_greater10 = {k: v for k, v in pair_entitis_count.items() if isinstance(v, (int, float)) and v > 10}
     print("Number of Pair Entities that have more than 10 value: ", len(pair_entitis_count_greater10))
@@ -310,11 +534,31 @@ if __name__ == "__main__":
     print("Most important Entities: ", unique_entities_from_pairs)
 
 
+def main(csv_file='telegram_messages.csv', partitions_root=None, max_workers=4, entity_map=None):
+    if partitions_root:
+        # Partitioned storage: aggregate every channel/month partition in parallel
+        from read_sources import list_partitions
+        merged = analyze_partitions(list_partitions(partitions_root), max_workers, entity_map)
+        print_report(merged['content_types'], merged['entity_keys'], len(merged['entity_values']),
+                     merged['hashtags'], merged['entity_pairs'])
+        return
 
+    # Read the CSV file into a pandas DataFrame
+    df = pd.read_csv(csv_file)
+    
+    resolver = _load_resolver(entity_map)
+    entity_key_counts, unique_values_count = analyze_entities(df, resolver=resolver)
+    print_report(analyze_content_type(df), entity_key_counts, unique_values_count,
+                 analyze_hashtags(df), analyze_entity_pairs(df, resolver=resolver))
 
 
-
-
-
-
-
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Print statistics of the processed messages")
+    parser.add_argument("--csv", default="telegram_messages.csv", help="Processed messages CSV")
+    parser.add_argument("--partitions", help="Analyse all partitions under this root instead of --csv")
+    parser.add_argument("--workers", type=int, default=4, help="Worker processes for --partitions")
+    parser.add_argument("--entity-map", help="Merge entity name variants using this mapping "
+                                             "(written by entity_resolution.py)")
+    args = parser.parse_args()
+    main(args.csv, args.partitions, args.workers, args.entity_map)
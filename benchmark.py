@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Ingest and analysis benchmark suite.
+
+Runs read_sources.parse_html_file and the analyse.py aggregators on synthetic
+data (synthetic_export.py) at several sizes and reports, per function and size:
+best wall time, throughput (messages/s), peak Python memory (tracemalloc) and
+the scaling exponent (slope of log time over log size; ~1.0 is linear).
+
+Results can be stored as a baseline and compared against later runs:
+
+    python benchmark.py --scales 1000,10000,100000 --save-baseline
+    python benchmark.py --scales 1000,10000,100000          # compares, exits 1 on regression
+"""
+
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+try:
+    from config import BENCHMARK_DIR
+except ImportError:
+    BENCHMARK_DIR = "benchmarks"
+
+ANALYSE_FUNCTIONS = [
+    "sum_reactions_by_type",
+    "sum_reactions_by_date",
+    "sum_reactions_by_month",
+    "analyze_content_type",
+    "analyze_content_type_by_month",
+    "analyze_entities",
+    "analyze_entity_trends",
+    "analyze_hashtags",
+    "analyze_entity_pairs",
+]
+
+
+def _measure(func, repeat):
+    """Returns (best seconds, peak traced bytes) for calling func."""
+    best = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    # Memory is measured in a separate run because tracing slows everything down
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def bench_parse(num_messages, work_dir, repeat, seed=0):
+    """Benchmarks parse_html_file over a whole synthetic export of num_messages."""
+    from read_sources import parse_html_file
+    from synthetic_export import generate_export
+
+    export_dir = os.path.join(work_dir, f"export_{num_messages}")
+    if not os.path.isdir(export_dir):
+        generate_export(export_dir, num_messages, seed=seed)
+    files = sorted(os.listdir(export_dir))
+
+    def run():
+        for filename in files:
+            parse_html_file(os.path.join(export_dir, filename), filename)
+
+    return _measure(run, repeat)
+
+
+def bench_analyse(num_messages, repeat, seed=0):
+    """Benchmarks every aggregator in ANALYSE_FUNCTIONS on a synthetic DataFrame of num_messages."""
+    import analyse
+    from synthetic_export import generate_dataframe
+
+    df = generate_dataframe(num_messages, seed=seed)
+    results = {}
+    for name in ANALYSE_FUNCTIONS:
+        func = getattr(analyse, name)
+        results[name] = _measure(lambda: func(df), repeat)
+    return results
+
+
+def scaling_exponent(points):
+    """Least-squares slope of log(seconds) over log(size)."""
+    points = [(math.log(n), math.log(s)) for n, s in points if s > 0]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    denominator = sum((x - mean_x) ** 2 for x, _ in points)
+    if denominator == 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / denominator
+
+
+def run_suite(scales, repeat=3, seed=0, skip_parse=False):
+    """
+    Runs all benchmarks.
+
+    Returns:
+        dict: Dictionary {function: {"scales": {size: {...}}, "exponent": float}}.
+    """
+    from metrics import configure
+
+    # Measure the functions themselves, not the tracing around them
+    configure(enabled=False)
+    results = {}
+
+    def record(name, size, seconds, peak):
+        entry = results.setdefault(name, {"scales": {}})
+        entry["scales"][str(size)] = {
+            "seconds": seconds,
+            "throughput": size / seconds if seconds > 0 else None,
+            "peak_bytes": peak,
+        }
+
+    work_dir = tempfile.mkdtemp(prefix="benchmark_")
+    try:
+        for size in scales:
+            if not skip_parse:
+                record("parse_html_file", size, *bench_parse(size, work_dir, repeat, seed))
+            for name, (seconds, peak) in bench_analyse(size, repeat, seed).items():
+                record(name, size, seconds, peak)
+            print(f"Finished size {size}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for entry in results.values():
+        entry["exponent"] = scaling_exponent([(int(n), r["seconds"]) for n, r in entry["scales"].items()])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares results with a stored baseline.
+
+    Returns:
+        list: Human-readable regression descriptions (empty if none).
+    """
+    regressions = []
+    for name, entry in results.items():
+        for size, current in entry["scales"].items():
+            previous = baseline.get(name, {}).get("scales", {}).get(size)
+            if not previous:
+                continue
+            if current["throughput"] and previous["throughput"] and \
+                    current["throughput"] < previous["throughput"] * (1 - tolerance):
+                regressions.append(f"{name} @ {size}: throughput {current['throughput']:.0f}/s "
+                                   f"vs baseline {previous['throughput']:.0f}/s")
+            if current["peak_bytes"] > previous["peak_bytes"] * (1 + tolerance):
+                regressions.append(f"{name} @ {size}: peak memory {current['peak_bytes'] / 1e6:.1f} MB "
+                                   f"vs baseline {previous['peak_bytes'] / 1e6:.1f} MB")
+    return regressions
+
+
+def print_table(results):
+    print(f"\n{'function':<32}{'size':>9}{'seconds':>10}{'msg/s':>12}{'peak MB':>10}{'exponent':>10}")
+    for name, entry in results.items():
+        exponent = f"{entry['exponent']:.2f}" if entry["exponent"] is not None else "-"
+        for size, r in entry["scales"].items():
+            throughput = f"{r['throughput']:.0f}" if r["throughput"] is not None else "-"
+            print(f"{name:<32}{size:>9}{r['seconds']:>10.3f}{throughput:>12}"
+                  f"{r['peak_bytes'] / 1e6:>10.1f}{exponent:>10}")
+            exponent = ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest and analysis on synthetic data")
+    parser.add_argument("--scales", default="1000,5000,20000", help="Comma-separated message counts")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per measurement (best is kept)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic data")
+    parser.add_argument("--skip-parse", action="store_true", help="Only benchmark the analyse.py functions")
+    parser.add_argument("--output-dir", default=BENCHMARK_DIR, help="Directory for results and baselines")
+    parser.add_argument("--save-baseline", action="store_true", help="Store this run as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown/memory growth")
+    args = parser.parse_args()
+
+    scales = [int(s) for s in args.scales.split(",") if s.strip()]
+    results = run_suite(scales, repeat=args.repeat, seed=args.seed, skip_parse=args.skip_parse)
+    print_table(results)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    run = {"created": time.strftime("%Y-%m-%d %H:%M:%S"), "machine": platform.platform(),
+           "python": platform.python_version(), "results": results}
+    with open(os.path.join(args.output_dir, "latest.json"), "w", encoding="utf-8") as f:
+        json.dump(run, f, indent=2)
+
+    baseline_path = os.path.join(args.output_dir, "baseline.json")
+    if args.save_baseline:
+        with open(baseline_path, "w", encoding="utf-8") as f:
+            json.dump(run, f, indent=2)
+        print(f"\nSaved baseline to {baseline_path}")
+        return 0
+    if not os.path.exists(baseline_path):
+        print("\nNo baseline yet, run with --save-baseline to store one")
+        return 0
+
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline["results"], args.tolerance)
+    if regressions:
+        print(f"\nRegressions against baseline from {baseline['created']}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print(f"\nNo regressions against baseline from {baseline['created']}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -14,7 +14,7 @@ MAX_CONCURRENT = 5  # Number of concurrent async API calls
 API_DELAY = 0.1  # Delay between batches to avoid rate limiting (seconds)
 
 # Processing method
-# Options: "thread" or "async"
+# Options: "thread", "async" or "queue" (lease-based work queue, see work_queue.py)
 PROCESSING_METHOD = "async"  # Change to "async" for best performance
 
 # Error handling
@@ -23,4 +23,108 @@ RETRY_DELAY = 1.0  # Delay between retries (seconds)
 
 # Logging
 LOG_LEVEL = "INFO"  # DEBUG, INFO, WARNING, ERROR
-LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s" 
\ No newline at end of file
+LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s" 
+# Reports
+REPORT_DIR = "reports"  # Directory for cached chart images
+REPORT_MAX_WORKERS = 4  # Number of processes used to render charts
+REPORT_TOP_N = 15  # Number of items shown in top-N and trend charts
+
+# Neo4j knowledge graph loading
+NEO4J_BATCH_SIZE = 1000  # Number of messages written per transaction
+NEO4J_MAX_POOL_SIZE = 10  # Maximum number of pooled driver connections
+KG_IMPORT_DIR = "kg_import"  # Output directory for neo4j-admin import CSV files
+
+# In-process entity graph
+ENTITY_GRAPH_DIR = "entity_graph"  # Directory of the saved CSR arrays
+
+# Similar news search
+SIMILAR_NEWS_DIR = "similar_news"  # Directory of the hashed TF-IDF index
+SIMILAR_NEWS_FEATURES = 2 ** 18  # Number of hashed features per vector
+
+# Metrics and profiling
+METRICS_ENABLED = True  # Record stage timings and counters
+METRICS_DIR = "metrics"  # Directory for trace.jsonl, pipeline.prom and profiles
+METRICS_TRACE_MAX_BYTES = 50 * 1024 * 1024  # trace.jsonl is rotated to trace.jsonl.1 once it grows past this
+METRICS_TRACE_BACKUPS = 3  # Rotated trace files kept (trace.jsonl.1 ... .3)
+PROFILE_STAGES = []  # Stages to run under a profiler, e.g. ["parse_html_file", "analyze_entity_pairs"]
+PROFILER = "cprofile"  # "cprofile" or "pyinstrument"
+
+# Benchmarks
+BENCHMARK_DIR = "benchmarks"  # Directory for benchmark results and the stored baseline
+
+# Multi-channel ingest
+PARTITIONS_DIR = "partitions"  # Root of the channel/month partitioned storage
+INGEST_MAX_WORKERS = 4  # Number of processes parsing HTML files
+INGEST_MESSAGES_PER_CHUNK = 100  # Messages parsed into one HTML tree at a time (0 = whole file)
+
+# Work queue (PROCESSING_METHOD = "queue" or work_queue.py)
+WORK_QUEUE_PATH = "work_queue.sqlite"  # Queue database; for several hosts a shared folder with working file locks
+WORK_QUEUE_LEASE_SECONDS = 120  # Rows of a worker that stops heartbeating are reclaimed after this
+WORK_QUEUE_CLAIM_SIZE = 10  # Rows leased per claim
+WORK_QUEUE_JOURNAL_MODE = "DELETE"  # "WAL" is faster but only works when all workers are on one host
+QUEUE_PROCESSES = 1  # Local worker processes started by llm.py
+
+# Extraction scheduling (see scheduler.py)
+SCHEDULER_HALF_LIFE_HOURS = 24  # A post this much newer scores one point more
+SCHEDULER_WEIGHTS = {"engagement": 1.0, "hints": 1.0, "cost": 0.5}  # Points per doubling of reactions / per hint / per doubling of tokens
+SCHEDULER_HINTS = {"فوری": 2.0, "قیمت": 0.5, "price": 0.5, "LME": 0.5}  # Keyword -> bonus points ("urgent", "price", ...)
+PROMPT_OVERHEAD_TOKENS = 900  # Estimated tokens of the system prompt
+OUTPUT_TOKENS_ESTIMATE = 250  # Estimated tokens of one JSON answer
+CHARS_PER_TOKEN = 3.0  # Estimated characters per token of message text
+PRICE_PER_MILLION_INPUT_TOKENS = 0.15  # USD, used for cost budgets
+PRICE_PER_MILLION_OUTPUT_TOKENS = 0.60  # USD
+EXTRACT_MAX_TOKENS = None  # Default token budget per run (None = unlimited)
+EXTRACT_MAX_COST = None  # Default USD budget per run
+EXTRACT_MAX_SECONDS = None  # Default time budget per run
+
+# Tail latency (async method)
+STREAM_RESPONSES = True  # Stream answers, stop at the first complete JSON object and hedge slow calls
+OUTPUT_TOKENS_BASE = 200  # max_tokens of a call: base ...
+OUTPUT_TOKENS_PER_INPUT_TOKEN = 0.5  # ... plus this per estimated token of message text ...
+OUTPUT_TOKENS_CEILING = 1000  # ... capped here
+HEDGE_PERCENTILE = 95  # Send a duplicate request once a call waits longer than this percentile for its first chunk
+HEDGE_MAX_FRACTION = 0.05  # Hedged requests allowed as a fraction of all requests
+HEDGE_MIN_SAMPLES = 20  # Latencies observed before hedging starts
+HEDGE_WINDOW = 500  # Number of recent latencies the percentile is computed over
+
+# Watch mode (see watcher.py)
+WATCH_STATE_FILE = ".watch_state.json"  # Checkpoint of the signatures of ingested export files
+WATCH_POLL_INTERVAL = 2.0  # Seconds between scans when inotify isn't available
+WATCH_SETTLE_SECONDS = 1.0  # Files written to more recently than this are picked up on the next scan
+WATCH_APPLY_INTERVAL = 1.0  # Seconds between writing finished results and updating the report
+WATCH_WORKERS = 1  # Extraction worker processes started by the daemon
+WATCH_SHUTDOWN_TIMEOUT = 120  # Seconds workers get to finish their current batch on shutdown
+
+# Entity resolution (see entity_resolution.py)
+ENTITY_MAP_PATH = "entity_map.sqlite"  # Persistent variant -> canonical entity mapping
+ENTITY_MATCH_THRESHOLD = 0.92  # IDF-weighted Jaro-Winkler similarity at which two names are one entity
+ENTITY_PHONETIC_THRESHOLD = 0.88  # Lower threshold for names with the same consonant skeleton ("Isfahan"/"Esfahan")
+ENTITY_MAX_BLOCK_SIZE = 30  # Larger blocks are only searched around the name (sorted neighbourhood) ...
+ENTITY_BLOCK_WINDOW = 5  # ... this many names on either side
+ENTITY_ALIASES = {  # Abbreviations no similarity measure catches, per entity type
+    "Country": [["USA", "US", "United States", "United States of America", "America"],
+                ["UK", "United Kingdom", "Britain", "Great Britain"],
+                ["UAE", "United Arab Emirates", "Emirates"]],
+    "Organization": [["Fed", "Federal Reserve", "US Federal Reserve"]],
+}
+
+# Model routing (see router.py)
+ROUTING_ENABLED = False  # Route every message to a model tier instead of always using gpt-4o-mini
+MODEL_TIERS = [  # Cheapest first; a tier takes messages up to max_chars (None = any length) in its languages and content types
+    {"name": "small", "model": "gpt-4.1-nano", "input_price": 0.10, "output_price": 0.40,
+     "max_chars": 600, "languages": ["fa", "en"], "content_types": ["commodity", "news"]},
+    {"name": "standard", "model": "gpt-4o-mini", "input_price": 0.15, "output_price": 0.60,
+     "max_chars": 4000, "languages": ["fa", "en"], "content_types": ["macro", "industry", "commodity", "news"]},
+    {"name": "large", "model": "gpt-4o", "input_price": 2.50, "output_price": 10.00,
+     "max_chars": None, "languages": ["fa", "en"], "content_types": ["macro", "industry", "commodity", "news"]},
+]  # Prices in USD per million input / output tokens
+ROUTING_CONTENT_KEYWORDS = {  # Pre-classification of the content type; the type with most keyword hits wins, else "news"
+    "macro": ["Fed", "inflation", "GDP", "interest rate", "تورم", "نرخ بهره", "فدرال", "اقتصاد", "رکود", "تحریم"],
+    "industry": ["industry", "production", "capacity", "صنعت", "تولید", "ظرفیت", "کارخانه", "معدن"],
+    "commodity": ["price", "LME", "tonnes", "$", "قیمت", "دلار", "تن", "بورس کالا", "شمش", "میلگرد"],
+}
+ROUTING_MAX_ERROR_RATE = 0.2  # A tier failing more often than this recently is skipped ...
+ROUTING_LATENCY_SLO = 20.0  # ... as is one whose recent p95 latency exceeds this many seconds
+ROUTING_MIN_SAMPLES = 10  # Calls observed before a tier's error rate and latency are trusted
+ROUTING_WINDOW_SECONDS = 300  # Calls older than this are forgotten, so a skipped tier gets retried later
+ROUTING_MAX_ATTEMPTS = 3  # Calls per message, the first tier included, before giving up
@@ -0,0 +1,340 @@
+"""
+Embedded, in-process entity co-mention graph.
+
+Answers questions like "which entities co-occur with Steel, ranked by strength"
+or "central entities this month" without a running Neo4j server. Entities are
+nodes (keyed like kg_loader.py), and two entities are connected when they are
+mentioned in the same message; the edge weight is the number of such messages.
+
+The graph is stored as CSR arrays (indptr/indices/weights) in NumPy. A
+month-sorted edge table is kept next to it so time-sliced subgraphs can be
+built without re-reading the messages. save() writes plain .npy files and
+load() memory-maps them, so opening even a large graph is instant.
+"""
+
+import argparse
+import json
+import logging
+import os
+from itertools import combinations
+
+import numpy as np
+
+from kg_loader import canonical_name, entity_id, iter_csv_records, parse_extraction
+
+try:
+    from config import ENTITY_GRAPH_DIR
+except ImportError:
+    ENTITY_GRAPH_DIR = "entity_graph"
+
+logger = logging.getLogger(__name__)
+
+ARRAY_NAMES = ["indptr", "indices", "weights", "mentions",
+               "event_month", "event_src", "event_dst", "event_count"]
+
+
+def _build_csr(n, src, dst, weight):
+    """
+    Builds symmetric CSR arrays from an undirected edge list, summing duplicate edges.
+    """
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    weight = np.asarray(weight, dtype=np.float64)
+    rows = np.concatenate([src, dst])
+    cols = np.concatenate([dst, src])
+    vals = np.concatenate([weight, weight])
+
+    if len(rows):
+        keys, inverse = np.unique(rows * n + cols, return_inverse=True)
+        vals = np.bincount(inverse, weights=vals)
+        rows, cols = keys // n, keys % n
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols.astype(np.int32), vals.astype(np.float32)
+
+
+class EntityGraph:
+    """
+    Weighted, undirected entity co-mention graph in CSR form.
+
+    Attributes:
+        ids (list): Node keys ("type:name").
+        names (list): Display name of each node.
+        types (list): Entity type of each node.
+        months (list): Sorted month keys ("YYYY-MM") referenced by event_month.
+        indptr, indices, weights (numpy.ndarray): CSR adjacency.
+        mentions (numpy.ndarray): Number of messages mentioning each node.
+    """
+
+    def __init__(self, ids, names, types, months, arrays):
+        self.ids = ids
+        self.names = names
+        self.types = types
+        self.months = months
+        for name in ARRAY_NAMES:
+            setattr(self, name, arrays[name])
+        self._index = {key: i for i, key in enumerate(ids)}
+        self._name_index = {}
+        for i, name in enumerate(names):
+            self._name_index.setdefault(canonical_name(name), []).append(i)
+
+    @property
+    def num_nodes(self):
+        return len(self.ids)
+
+    @property
+    def num_edges(self):
+        return len(self.indices) // 2
+
+    @classmethod
+    def from_records(cls, records, resolver=None):
+        """
+        Builds the graph from message records with 'date' and 'json' keys.
+        With a resolver (see entity_resolution.py), the variants of an entity
+        are merged into one node named after the entity's canonical spelling.
+        """
+        from analyse import date_to_month
+
+        index = {}
+        names, types = [], []
+        mentions = []
+        events = {}  # (month, src, dst) -> count
+        month_keys = set()
+
+        for record in records:
+            data = parse_extraction(record.get("json"))
+            if data is None:
+                continue
+            entity_dict = data.get("entities", {})
+            if not isinstance(entity_dict, dict):
+                continue
+            nodes = set()
+            for entity_type, values in entity_dict.items():
+                if isinstance(values, str):
+                    values = [values]
+                if not isinstance(values, list):
+                    continue
+                for name in values:
+                    if not isinstance(name, str) or not name.strip():
+                        continue
+                    if resolver is not None:
+                        key = resolver.canonical_id(entity_type, name)
+                    else:
+                        key = entity_id(entity_type, name)
+                    if key not in index:
+                        index[key] = len(names)
+                        names.append(resolver.canonical_name(entity_type, name) if resolver else name.strip())
+                        types.append(canonical_name(entity_type))
+                        mentions.append(0)
+                    nodes.add(index[key])
+            for node in nodes:
+                mentions[node] += 1
+            if len(nodes) < 2:
+                continue
+            month = date_to_month(record.get("date")) or ""
+            month_keys.add(month)
+            for a, b in combinations(sorted(nodes), 2):
+                events[(month, a, b)] = events.get((month, a, b), 0) + 1
+
+        months = sorted(month_keys)
+        month_index = {m: i for i, m in enumerate(months)}
+        ordered = sorted(events.items(), key=lambda x: (month_index[x[0][0]], x[0][1], x[0][2]))
+        event_month = np.array([month_index[k[0]] for k, _ in ordered], dtype=np.int32)
+        event_src = np.array([k[1] for k, _ in ordered], dtype=np.int32)
+        event_dst = np.array([k[2] for k, _ in ordered], dtype=np.int32)
+        event_count = np.array([v for _, v in ordered], dtype=np.float32)
+
+        ids = list(index)
+        indptr, indices, weights = _build_csr(len(ids), event_src, event_dst, event_count)
+        arrays = {
+            "indptr": indptr, "indices": indices, "weights": weights,
+            "mentions": np.array(mentions, dtype=np.int64),
+            "event_month": event_month, "event_src": event_src,
+            "event_dst": event_dst, "event_count": event_count,
+        }
+        graph = cls(ids, names, types, months, arrays)
+        logger.info(f"Built entity graph: {graph.num_nodes} nodes, {graph.num_edges} edges, {len(months)} months")
+        return graph
+
+    @classmethod
+    def from_csv(cls, csv_file, resolver=None):
+        """Builds the graph from the processed messages CSV."""
+        return cls.from_records(iter_csv_records(csv_file), resolver)
+
+    def save(self, graph_dir=ENTITY_GRAPH_DIR):
+        """Writes the graph as .npy arrays plus a JSON node table."""
+        os.makedirs(graph_dir, exist_ok=True)
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(graph_dir, f"{name}.npy"), np.asarray(getattr(self, name)))
+        with open(os.path.join(graph_dir, "nodes.json"), "w", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "names": self.names, "types": self.types, "months": self.months},
+                      f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, graph_dir=ENTITY_GRAPH_DIR, mmap=True):
+        """Opens a saved graph; arrays are memory-mapped unless mmap is False."""
+        with open(os.path.join(graph_dir, "nodes.json"), encoding="utf-8") as f:
+            nodes = json.load(f)
+        mode = "r" if mmap else None
+        arrays = {name: np.load(os.path.join(graph_dir, f"{name}.npy"), mmap_mode=mode) for name in ARRAY_NAMES}
+        return cls(nodes["ids"], nodes["names"], nodes["types"], nodes["months"], arrays)
+
+    def node(self, name):
+        """
+        Resolves a node key ("commodity:steel") or a plain name ("Steel") to a node index.
+        A plain name shared by several entity types resolves to the most mentioned one.
+        """
+        if name in self._index:
+            return self._index[name]
+        candidates = self._name_index.get(canonical_name(name))
+        if not candidates:
+            raise KeyError(f"Unknown entity: {name}")
+        return max(candidates, key=lambda i: self.mentions[i])
+
+    def label(self, i):
+        return f"{self.names[i]} ({self.types[i]})"
+
+    def neighbors(self, name, top_k=10):
+        """
+        Returns the entities co-mentioned with name, strongest first.
+
+        Returns:
+            list: List of (label, weight) tuples.
+        """
+        i = self.node(name)
+        start, end = self.indptr[i], self.indptr[i + 1]
+        cols = np.asarray(self.indices[start:end])
+        vals = np.asarray(self.weights[start:end])
+        order = np.argsort(-vals, kind="stable")[:top_k]
+        return [(self.label(int(cols[j])), float(vals[j])) for j in order]
+
+    def degree_centrality(self, weighted=True, top_k=10):
+        """
+        Returns the most central entities by (weighted) degree.
+
+        Returns:
+            list: List of (label, score) tuples.
+        """
+        if weighted:
+            rows = np.repeat(np.arange(self.num_nodes), np.diff(self.indptr))
+            scores = np.bincount(rows, weights=self.weights, minlength=self.num_nodes)
+        else:
+            scores = np.diff(self.indptr).astype(np.float64)
+        return self._top(scores, top_k)
+
+    def pagerank(self, damping=0.85, max_iter=100, tol=1e-8, top_k=10):
+        """
+        Weighted PageRank by power iteration.
+
+        Returns:
+            list: List of (label, score) tuples.
+        """
+        return self._top(self.pagerank_scores(damping, max_iter, tol), top_k)
+
+    def pagerank_scores(self, damping=0.85, max_iter=100, tol=1e-8):
+        """Returns the full PageRank vector."""
+        n = self.num_nodes
+        if n == 0:
+            return np.zeros(0)
+        rows = np.repeat(np.arange(n), np.diff(self.indptr))
+        weights = np.asarray(self.weights, dtype=np.float64)
+        strength = np.bincount(rows, weights=weights, minlength=n)
+        dangling = strength == 0
+        # Share of each edge in its source node's outgoing weight
+        edge_share = weights / np.where(strength > 0, strength, 1)[rows]
+        indices = np.asarray(self.indices)
+
+        rank = np.full(n, 1.0 / n)
+        for _ in range(max_iter):
+            spread = np.bincount(indices, weights=rank[rows] * edge_share, minlength=n)
+            new_rank = (1 - damping) / n + damping * (spread + rank[dangling].sum() / n)
+            converged = np.abs(new_rank - rank).sum() < tol
+            rank = new_rank
+            if converged:
+                break
+        return rank
+
+    def k_hop(self, name, k=2):
+        """
+        Returns the entities reachable from name within k hops, with their hop distance.
+
+        Returns:
+            dict: Dictionary {label: hops}.
+        """
+        start = self.node(name)
+        distance = np.full(self.num_nodes, -1, dtype=np.int32)
+        distance[start] = 0
+        frontier = np.array([start])
+        for hop in range(1, k + 1):
+            if len(frontier) == 0:
+                break
+            spans = [np.asarray(self.indices[self.indptr[i]:self.indptr[i + 1]]) for i in frontier]
+            reached = np.unique(np.concatenate(spans)) if spans else np.array([], dtype=np.int32)
+            frontier = reached[distance[reached] == -1]
+            distance[frontier] = hop
+        found = np.nonzero(distance > 0)[0]
+        return {self.label(int(i)): int(distance[i]) for i in found[np.argsort(distance[found], kind="stable")]}
+
+    def subgraph(self, start_month=None, end_month=None):
+        """
+        Returns the graph restricted to co-mentions between start_month and end_month (inclusive, "YYYY-MM").
+        Node indices are kept, so node lookups work the same on the subgraph.
+        """
+        lo = np.searchsorted(self.months, start_month, side="left") if start_month else 0
+        hi = np.searchsorted(self.months, end_month, side="right") if end_month else len(self.months)
+        # Events are sorted by month, so the slice is contiguous
+        first = np.searchsorted(self.event_month, lo, side="left")
+        last = np.searchsorted(self.event_month, hi, side="left")
+        src = np.asarray(self.event_src[first:last])
+        dst = np.asarray(self.event_dst[first:last])
+        count = np.asarray(self.event_count[first:last])
+
+        indptr, indices, weights = _build_csr(self.num_nodes, src, dst, count)
+        arrays = {
+            # Mention counts are only used to disambiguate names, so the overall counts are kept
+            "indptr": indptr, "indices": indices, "weights": weights, "mentions": self.mentions,
+            "event_month": np.asarray(self.event_month[first:last]) - lo, "event_src": src,
+            "event_dst": dst, "event_count": count,
+        }
+        return EntityGraph(self.ids, self.names, self.types, list(self.months[lo:hi]), arrays)
+
+    def _top(self, scores, top_k):
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        return [(self.label(int(i)), float(scores[i])) for i in order]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and query the in-process entity graph")
+    parser.add_argument("--csv", default="telegram_messages.csv", help="Processed messages CSV")
+    parser.add_argument("--graph-dir", default=ENTITY_GRAPH_DIR, help="Directory of the saved graph")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the graph from the CSV")
+    parser.add_argument("--entity", help="Show neighbors and k-hop expansion of this entity")
+    parser.add_argument("--month", help="Restrict queries to one month (YYYY-MM)")
+    parser.add_argument("--top-k", type=int, default=10, help="Number of results")
+    parser.add_argument("--entity-map", help="Merge entity name variants using this mapping "
+                                             "(written by entity_resolution.py)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if args.rebuild or not os.path.exists(os.path.join(args.graph_dir, "nodes.json")):
+        resolver = None
+        if args.entity_map:
+            from entity_resolution import load_resolver
+            resolver = load_resolver(args.entity_map)
+        graph = EntityGraph.from_csv(args.csv, resolver)
+        graph.save(args.graph_dir)
+    else:
+        graph = EntityGraph.load(args.graph_dir)
+    if args.month:
+        graph = graph.subgraph(args.month, args.month)
+
+    print("Most central entities (PageRank): ", graph.pagerank(top_k=args.top_k))
+    print("Most connected entities (weighted degree): ", graph.degree_centrality(top_k=args.top_k))
+    if args.entity:
+        print(f"Co-mentioned with {args.entity}: ", graph.neighbors(args.entity, top_k=args.top_k))
+        print(f"Within 2 hops of {args.entity}: ", len(graph.k_hop(args.entity, k=2)))
+
+
+if __name__ == "__main__":
+    main()
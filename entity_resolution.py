@@ -0,0 +1,775 @@
+"""
+Entity resolution: merges the name variants the LLM returns for one entity.
+
+The extraction step writes "USA", "US" and "United States", "Iron ore" and
+"Iron Ore", "Esfahan" and "اصفهان" as separate names, so every count keyed by
+name (analyse.py, the entity graph, the knowledge graph) is split across
+variants. This module clusters the variants of each entity type and keeps a
+persistent mapping from every variant to a canonical ID.
+
+Resolution runs in four steps:
+
+    normalize   NFKC, Arabic -> Persian letter forms, diacritics and
+                punctuation removed, case-folded ("U.S." -> "us")
+    block       every name gets a few blocking keys: a phonetic consonant
+                skeleton (prefix and suffix) that is the same for Latin and
+                Persian spellings, its sorted tokens, its initials and a
+                character n-gram key. Only names sharing a key are compared.
+    compare     Jaro-Winkler similarity, acronym matches, equal skeletons
+                across scripts and the curated ENTITY_ALIASES
+    cluster     union-find over the matching pairs; a cluster's ID is the
+                entity_id() of its most mentioned spelling
+
+Blocks larger than ENTITY_MAX_BLOCK_SIZE are not compared all-pairs: their
+names are kept sorted and each name is only compared with its
+ENTITY_BLOCK_WINDOW nearest neighbours (sorted neighbourhood), so the work per
+name is bounded and resolution stays linear in the number of names.
+
+The mapping is stored in SQLite (ENTITY_MAP_PATH) and updated incrementally:
+names already in it are only counted, new names are compared with the names in
+their blocks and join an existing cluster, found a new one, or merge clusters
+they bridge. Cluster IDs stay stable except when two clusters merge.
+"""
+
+import argparse
+import logging
+import math
+import os
+import random
+import re
+import sqlite3
+import time
+import unicodedata
+from bisect import bisect_left, insort
+from collections import Counter
+from functools import lru_cache
+
+from kg_loader import canonical_name, entity_id, parse_extraction
+
+try:
+    from config import (ENTITY_MAP_PATH, ENTITY_MATCH_THRESHOLD, ENTITY_PHONETIC_THRESHOLD,
+                        ENTITY_MAX_BLOCK_SIZE, ENTITY_BLOCK_WINDOW, ENTITY_ALIASES)
+except ImportError:
+    ENTITY_MAP_PATH = "entity_map.sqlite"
+    ENTITY_MATCH_THRESHOLD = 0.92
+    ENTITY_PHONETIC_THRESHOLD = 0.88
+    ENTITY_MAX_BLOCK_SIZE = 30
+    ENTITY_BLOCK_WINDOW = 5
+    ENTITY_ALIASES = {}
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS variants (
+    type TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    name TEXT NOT NULL,
+    cluster TEXT NOT NULL,
+    mentions INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (type, variant)
+);
+CREATE TABLE IF NOT EXISTS clusters (
+    id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entity_types (
+    type TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+"""
+
+# Arabic code points used interchangeably with the Persian ones, and joiners
+PERSIAN_FORMS = str.maketrans({
+    "ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "أ": "ا", "إ": "ا", "ٱ": "ا", "ؤ": "و",
+    "\u200c": " ", "\u200d": "", "\u200e": "", "\u200f": "",
+    **{chr(0x06F0 + i): str(i) for i in range(10)},
+    **{chr(0x0660 + i): str(i) for i in range(10)},
+})
+KEEP_PUNCTUATION = set("/%&+")
+DROP_PUNCTUATION = set(".'’`")
+STOPWORDS = {"of", "the", "and", "&", "for"}
+# Legal forms dropped from the end ("Vale S.A.", "BHP Ltd") and "شرکت" ("company") from the start
+LEGAL_FORMS = {"co", "company", "corp", "corporation", "inc", "ltd", "llc", "plc", "sa", "ag", "pjsc"}
+
+# Consonant classes shared by Latin and Persian spellings; vowels, h, w/v/و and
+# ی/ا/ه/ع are dropped because transliterations disagree on them
+LATIN_DIGRAPHS = [("kh", "k"), ("gh", "k"), ("sh", "s"), ("zh", "s"), ("ch", "j"), ("ph", "f"), ("th", "t")]
+SOUND_CLASSES = {
+    **dict.fromkeys("bp", "b"), **dict.fromkeys("ckq", "k"), "x": "ks", "g": "g", "j": "j",
+    **dict.fromkeys("dt", "t"), **dict.fromkeys("sz", "s"), "f": "f", "l": "l", "r": "r", "m": "m", "n": "n",
+    **dict.fromkeys("بپ", "b"), **dict.fromkeys("تدط", "t"), **dict.fromkeys("ثذزژسشصضظ", "s"),
+    **dict.fromkeys("جچ", "j"), **dict.fromkeys("خغقک", "k"),
+    "گ": "g", "ف": "f", "ل": "l", "ر": "r", "م": "m", "ن": "n",
+}
+ARABIC_SCRIPT = re.compile("[\u0600-\u06ff]")
+DIGITS = re.compile(r"\d+")
+MIN_SKELETON = 3  # Shorter skeletons ("rn" for Iran) are too ambiguous to match across scripts
+
+
+def normalize_name(name):
+    """
+    Normalizes a name for comparison: NFKC, Persian letter forms and digits,
+    diacritics and most punctuation removed, collapsed whitespace, case-folded,
+    a leading "the" and legal forms dropped.
+    """
+    text = unicodedata.normalize("NFKC", str(name)).translate(PERSIAN_FORMS).casefold()
+    chars = []
+    for char in unicodedata.normalize("NFKD", text):
+        if unicodedata.combining(char) or char in DROP_PUNCTUATION:
+            continue
+        if unicodedata.category(char).startswith("P") and char not in KEEP_PUNCTUATION:
+            chars.append(" ")
+        else:
+            chars.append(char)
+    tokens = unicodedata.normalize("NFC", "".join(chars)).split()
+    if len(tokens) > 1 and tokens[0] in ("the", "شرکت"):
+        tokens = tokens[1:]
+    while len(tokens) > 1 and tokens[-1] in LEGAL_FORMS:
+        tokens = tokens[:-1]
+    return " ".join(tokens)
+
+
+def phonetic_key(normalized):
+    """
+    Consonant skeleton of a normalized name, e.g. "esfahan" and "اصفهان" -> "sfn".
+    """
+    for digraph, replacement in LATIN_DIGRAPHS:
+        normalized = normalized.replace(digraph, replacement)
+    out = []
+    for char in normalized:
+        sound = SOUND_CLASSES.get(char)
+        if sound and (not out or out[-1] != sound):
+            out.append(sound)
+    return "".join(out)
+
+
+def jaro_winkler(a, b, prefix_scale=0.1):
+    """Jaro-Winkler similarity of two strings, between 0 and 1."""
+    if a == b:
+        return 1.0
+    len_a, len_b = len(a), len(b)
+    if not len_a or not len_b:
+        return 0.0
+    window = (len_a if len_a > len_b else len_b) // 2 - 1
+    if window < 0:
+        window = 0
+    b_matched = [False] * len_b
+    a_chars = []
+    for i, char in enumerate(a):
+        lo = i - window if i > window else 0
+        hi = i + window + 1
+        j = b.find(char, lo, hi)
+        while j >= 0 and b_matched[j]:
+            j = b.find(char, j + 1, hi)
+        if j >= 0:
+            b_matched[j] = True
+            a_chars.append(char)
+    matches = len(a_chars)
+    if not matches:
+        return 0.0
+    b_chars = [char for char, matched in zip(b, b_matched) if matched]
+    transpositions = sum(x != y for x, y in zip(a_chars, b_chars)) / 2
+    jaro = (matches / len_a + matches / len_b + (matches - transpositions) / matches) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y:
+            break
+        prefix += 1
+    return jaro + prefix * prefix_scale * (1 - jaro)
+
+
+@lru_cache(maxsize=1 << 20)
+def _token_score(a, b):
+    # The Winkler prefix bonus is meant for typos, not for one word extending another
+    # ("soster" / "sosternigol")
+    return jaro_winkler(a, b, 0.1 if abs(len(a) - len(b)) <= 2 else 0.0)
+
+
+@lru_cache(maxsize=1 << 18)
+def features(normalized):
+    """
+    Comparison features of a normalized name.
+
+    Returns:
+        tuple: (skeleton, is Persian script, digit groups, sorted tokens, initials, can be an acronym)
+    """
+    tokens = normalized.split()
+    words = [t for t in tokens if t not in STOPWORDS] or tokens
+    initials = set()
+    if len(tokens) > 1:
+        initials = {"".join(t[0] for t in tokens), "".join(t[0] for t in words)}
+    acronym = len(tokens) == 1 and 2 <= len(normalized) <= 5 and normalized.isascii() and normalized.isalpha()
+    return (phonetic_key(normalized), bool(ARABIC_SCRIPT.search(normalized)),
+            tuple(DIGITS.findall(normalized)), " ".join(sorted(tokens)), initials, acronym)
+
+
+def is_acronym(name):
+    """True for spellings like "US" or "LME" that may abbreviate a longer name."""
+    return features(normalize_name(name))[5] and name.strip().replace(".", "").isupper()
+
+
+def blocking_keys(normalized, acronym=False, probe=False):
+    """
+    Keys of the blocks a normalized name is placed in. Two names are only
+    compared when they share at least one key: the sorted tokens, or the start
+    or end of a token's consonant skeleton (so one typo can't hide a variant).
+
+    Acronyms are indexed apart from the names they may abbreviate, so that
+    names with the same initials are not compared with each other:
+    probe=True returns the keys to look candidates up under instead.
+    """
+    _, _, _, sorted_tokens, initials, _ = features(normalized)
+    keys = {"t:" + sorted_tokens}
+    for token in normalized.split():
+        if token not in STOPWORDS:
+            skeleton = phonetic_key(token)
+            if skeleton:
+                keys.add("s:" + skeleton[:4])
+                keys.add("e:" + skeleton[-4:])
+    initials_prefix, acronym_prefix = ("a:", "i:") if probe else ("i:", "a:")
+    keys.update(initials_prefix + key for key in initials)
+    if acronym:
+        keys.add(acronym_prefix + normalized)
+    return keys
+
+
+def token_similarity(tokens_a, tokens_b, weight=None):
+    """
+    Similarity of two tokenized names: every token is scored by its best
+    Jaro-Winkler match in the other name and the scores are averaged, weighted by
+    weight(token). Of the two directions the lower score is returned, so an extra
+    distinctive token lowers it. With IDF weights, tokens shared by many names
+    ("steel", "resources") barely count, so "Mobarakeh Steel" and
+    "Esfahan Steel" stay apart.
+    """
+    scores = [[_token_score(x, y) for y in tokens_b] for x in tokens_a]
+    weights_a = [weight(token) if weight else 1.0 for token in tokens_a]
+    weights_b = [weight(token) if weight else 1.0 for token in tokens_b]
+    forward = sum(w * max(row) for w, row in zip(weights_a, scores)) / sum(weights_a)
+    backward = sum(w * max(column) for w, column in zip(weights_b, zip(*scores))) / sum(weights_b)
+    return min(forward, backward)
+
+
+def is_match(a, b, acronyms=(), weight=None, threshold=ENTITY_MATCH_THRESHOLD,
+             phonetic_threshold=ENTITY_PHONETIC_THRESHOLD):
+    """
+    Decides whether two normalized names of the same type are variants of one entity.
+
+    Parameters:
+        a, b (str): Normalized names.
+        acronyms (container): Those of a and b that were spelled as acronyms.
+        weight (callable): Token weight for token_similarity(), e.g. its IDF.
+    """
+    skeleton_a, persian_a, digits_a, tokens_a, initials_a, _ = features(a)
+    skeleton_b, persian_b, digits_b, tokens_b, initials_b, _ = features(b)
+    # "$100/ton" and "$450/ton" are different prices however similar they look
+    if digits_a != digits_b:
+        return False
+    if tokens_a == tokens_b:
+        return True
+    if (a in acronyms and a in initials_b) or (b in acronyms and b in initials_a):
+        return True
+    same_skeleton = skeleton_a == skeleton_b and len(skeleton_a) >= MIN_SKELETON
+    if persian_a != persian_b:
+        return same_skeleton
+    similarity = token_similarity(a.split(), b.split(), weight)
+    return similarity >= threshold or (same_skeleton and similarity >= phonetic_threshold)
+
+
+class EntityResolver:
+    """
+    Persistent variant -> canonical entity mapping, updated incrementally.
+
+    Parameters:
+        path (str): SQLite file of the mapping; None keeps it in memory only.
+        aliases (dict): Dictionary {entity type: [[names of one entity], ...]} of
+            variants that are always merged (abbreviations no similarity measure
+            can catch, like "Fed" and "Federal Reserve").
+
+    Usage:
+        resolver = EntityResolver()
+        resolver.update(iter_mentions(records))
+        resolver.save()
+        resolver.canonical_id("Country", "U.S.")  # -> "country:united states"
+    """
+
+    def __init__(self, path=ENTITY_MAP_PATH, aliases=None, threshold=ENTITY_MATCH_THRESHOLD,
+                 max_block_size=ENTITY_MAX_BLOCK_SIZE, window=ENTITY_BLOCK_WINDOW):
+        self.path = path
+        self.threshold = threshold
+        self.max_block_size = max_block_size
+        self.window = window
+        self.variants = {}  # (type, variant) -> [name, cluster id, mentions]
+        self.clusters = {}  # cluster id -> [type, name]
+        self.members = {}  # cluster id -> set of variants
+        self.type_names = {}  # canonical type -> display name
+        self.blocks = None  # (type, key) -> sorted list of variants, built on first update
+        self.aliases = {}  # (type, variant) -> alias group
+        self.acronyms = set()  # (type, variant) spelled as an acronym
+        self.token_counts = {}  # type -> Counter of tokens over its variants, for IDF weights
+        self.type_sizes = Counter()  # type -> number of variants
+        self._weights = {}  # (type, token) -> IDF, cleared when the counts change
+        self._dirty_variants = set()
+        self._dirty_clusters = set()
+        self._removed_clusters = set()
+
+        aliases = ENTITY_ALIASES if aliases is None else aliases
+        for entity_type, groups in aliases.items():
+            for i, group in enumerate(groups):
+                for name in group:
+                    self.aliases[(canonical_name(entity_type), normalize_name(name))] = i
+
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path)
+            self.conn.executescript(SCHEMA)
+            self._load()
+
+    def _load(self):
+        for type_name, variant, name, cluster, mentions in self.conn.execute(
+                "SELECT type, variant, name, cluster, mentions FROM variants"):
+            self.variants[(type_name, variant)] = [name, cluster, mentions]
+            if is_acronym(name):
+                self.acronyms.add((type_name, variant))
+            self.members.setdefault(cluster, set()).add(variant)
+        for cluster, type_name, name in self.conn.execute("SELECT id, type, name FROM clusters"):
+            self.clusters[cluster] = [type_name, name]
+        self.type_names = dict(self.conn.execute("SELECT type, name FROM entity_types"))
+
+    def _build_blocks(self):
+        self.blocks = {}
+        for type_name, variant in sorted(self.variants):
+            for key in self._keys(type_name, variant):
+                self.blocks.setdefault((type_name, key), []).append(variant)
+            self._count_tokens(type_name, variant)
+
+    def _count_tokens(self, type_name, variant):
+        self.token_counts.setdefault(type_name, Counter()).update(set(variant.split()))
+        self.type_sizes[type_name] += 1
+
+    def _keys(self, type_name, variant, probe=False):
+        keys = blocking_keys(variant, (type_name, variant) in self.acronyms, probe)
+        group = self.aliases.get((type_name, variant))
+        if group is not None:
+            keys.add(f"l:{group}")
+        return keys
+
+    def _candidates(self, type_name, variant):
+        """
+        Variants sharing a block with variant (which must already be in its blocks).
+        Oversized blocks (a common word like "steel") are skipped when a smaller
+        block covers the name; otherwise only its sorted neighbours are taken.
+        """
+        blocks = [self.blocks.get((type_name, key), ()) for key in self._keys(type_name, variant, probe=True)]
+        small = [block for block in blocks if len(block) <= self.max_block_size]
+        candidates = set()
+        for block in small:
+            candidates.update(block)
+        if not any(len(block) > 1 for block in small):
+            for block in blocks:
+                if len(block) > self.max_block_size:
+                    i = bisect_left(block, variant)
+                    candidates.update(block[max(0, i - self.window):i + self.window + 1])
+        candidates.discard(variant)
+        return candidates
+
+    def _weight(self, type_name, token):
+        """IDF of a token among the variants of a type."""
+        key = (type_name, token)
+        weight = self._weights.get(key)
+        if weight is None:
+            weight = math.log(1 + self.type_sizes[type_name] / max(1, self.token_counts[type_name][token]))
+            self._weights[key] = weight
+        return weight
+
+    def _match(self, type_name, a, b):
+        group = self.aliases.get((type_name, a))
+        if group is not None and group == self.aliases.get((type_name, b)):
+            return True
+        acronyms = [v for v in (a, b) if (type_name, v) in self.acronyms]
+        return is_match(a, b, acronyms, lambda token: self._weight(type_name, token), self.threshold)
+
+    def update(self, mentions):
+        """
+        Adds entity mentions to the mapping. Known variants are only counted;
+        new ones are compared with the variants in their blocks and clustered.
+
+        Parameters:
+            mentions (iterable): (entity type, name) tuples, one per mention.
+
+        Returns:
+            dict: Numbers of 'new_variants', 'new_clusters', 'merged_clusters' and 'comparisons'.
+        """
+        if self.blocks is None:
+            self._build_blocks()
+
+        new = {}  # (type, variant) -> Counter of spellings
+        for entity_type, name in mentions:
+            if not isinstance(name, str) or not name.strip():
+                continue
+            type_name = canonical_name(entity_type)
+            variant = normalize_name(name)
+            if not variant:
+                continue
+            if type_name not in self.type_names:
+                self.type_names[type_name] = " ".join(str(entity_type).split())
+            entry = self.variants.get((type_name, variant))
+            if entry is not None:
+                entry[2] += 1
+                self._dirty_variants.add((type_name, variant))
+            else:
+                new.setdefault((type_name, variant), Counter())[name.strip()] += 1
+
+        for (type_name, variant), spellings in new.items():
+            if any(is_acronym(spelling) for spelling in spellings):
+                self.acronyms.add((type_name, variant))
+            for key in self._keys(type_name, variant):
+                insort(self.blocks.setdefault((type_name, key), []), variant)
+            self._count_tokens(type_name, variant)
+        self._weights.clear()
+
+        # Union-find over existing clusters (by ID) and new variants (by key)
+        parent = {}
+
+        def find(node):
+            root = node
+            while parent.get(root, root) != root:
+                root = parent[root]
+            while node != root:
+                parent[node], node = root, parent.get(node, node)
+            return root
+
+        def node_of(type_name, variant):
+            if (type_name, variant) in new:
+                return (type_name, variant)
+            return self.variants[(type_name, variant)][1]
+
+        comparisons = 0
+        compared = set()
+        for type_name, variant in new:
+            for other in self._candidates(type_name, variant):
+                pair = (type_name, min(variant, other), max(variant, other))
+                if pair in compared:
+                    continue
+                compared.add(pair)
+                a, b = find(node_of(type_name, variant)), find(node_of(type_name, other))
+                if a == b:
+                    continue
+                comparisons += 1
+                if self._match(type_name, variant, other):
+                    parent[a] = b
+
+        components = {}
+        for key in new:
+            components.setdefault(find(key), []).append(key)
+        # Every union involves a new variant, so each merged cluster is in one of these components
+        existing = {}
+        for node in set(parent) | set(parent.values()):
+            if isinstance(node, str):
+                existing.setdefault(find(node), set()).add(node)
+
+        stats = {"new_variants": len(new), "new_clusters": 0, "merged_clusters": 0, "comparisons": comparisons}
+        for root, keys in components.items():
+            clusters = existing.get(root, set())
+            if isinstance(root, str):
+                clusters.add(root)
+            if clusters:
+                target = max(clusters, key=lambda c: (self._cluster_mentions(c), c))
+                for cluster in clusters:
+                    if cluster != target:
+                        self._merge(cluster, target)
+                        stats["merged_clusters"] += 1
+            else:
+                spellings = Counter()
+                for key in keys:
+                    spellings.update(new[key])
+                name = max(spellings, key=lambda s: (spellings[s], len(s), s))
+                target = entity_id(keys[0][0], name)
+                self.clusters[target] = [keys[0][0], name]
+                self.members[target] = set()
+                self._dirty_clusters.add(target)
+                stats["new_clusters"] += 1
+            for type_name, variant in keys:
+                spellings = new[(type_name, variant)]
+                self.variants[(type_name, variant)] = [spellings.most_common(1)[0][0], target,
+                                                       sum(spellings.values())]
+                self.members[target].add(variant)
+                self._dirty_variants.add((type_name, variant))
+        return stats
+
+    def reset_counts(self):
+        """
+        Sets the mention count of every variant to 0, so the full input can be counted
+        again (update adds to the counts).
+        """
+        for key, entry in self.variants.items():
+            if entry[2]:
+                entry[2] = 0
+                self._dirty_variants.add(key)
+
+    def _cluster_mentions(self, cluster):
+        type_name = self.clusters[cluster][0]
+        return sum(self.variants[(type_name, v)][2] for v in self.members.get(cluster, ()))
+
+    def _merge(self, cluster, target):
+        type_name = self.clusters[cluster][0]
+        logger.info(f"Merging {cluster} into {target}")
+        for variant in self.members.pop(cluster, set()):
+            self.variants[(type_name, variant)][1] = target
+            self.members[target].add(variant)
+            self._dirty_variants.add((type_name, variant))
+        del self.clusters[cluster]
+        self._dirty_clusters.discard(cluster)
+        self._removed_clusters.add(cluster)
+
+    def save(self):
+        """Writes the changes since the last save to the SQLite file."""
+        if self.conn is None:
+            return
+        with self.conn:
+            self.conn.executemany("DELETE FROM clusters WHERE id = ?", [(c,) for c in self._removed_clusters])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO clusters (id, type, name) VALUES (?, ?, ?)",
+                [(c, *self.clusters[c]) for c in self._dirty_clusters])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO variants (type, variant, name, cluster, mentions) VALUES (?, ?, ?, ?, ?)",
+                [(t, v, *self.variants[(t, v)]) for t, v in self._dirty_variants])
+            self.conn.executemany("INSERT OR IGNORE INTO entity_types (type, name) VALUES (?, ?)",
+                                  list(self.type_names.items()))
+        self._dirty_variants.clear()
+        self._dirty_clusters.clear()
+        self._removed_clusters.clear()
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def cluster_of(self, entity_type, name):
+        """Cluster ID of a name, or None if it isn't in the mapping."""
+        entry = self.variants.get((canonical_name(entity_type), normalize_name(name)))
+        return entry[1] if entry else None
+
+    def canonical_id(self, entity_type, name):
+        """Node key of a name: its cluster ID, or entity_id() for names not in the mapping."""
+        return self.cluster_of(entity_type, name) or entity_id(entity_type, name)
+
+    def canonical_name(self, entity_type, name):
+        """Display name of a name's cluster, or the name itself."""
+        cluster = self.cluster_of(entity_type, name)
+        return self.clusters[cluster][1] if cluster else name.strip()
+
+    def type_name(self, entity_type):
+        """Display name shared by all spellings of an entity type ("Country", "country", ...)."""
+        return self.type_names.get(canonical_name(entity_type), entity_type)
+
+    def cluster_members(self, cluster):
+        """Spellings of the variants in a cluster."""
+        type_name = self.clusters[cluster][0]
+        return sorted(self.variants[(type_name, v)][0] for v in self.members.get(cluster, ()))
+
+
+@lru_cache(maxsize=4)
+def load_resolver(path=ENTITY_MAP_PATH):
+    """
+    Opens a saved mapping for lookups, or returns None if there is none.
+    Cached, so every partition analysed in a worker process shares one copy.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    resolver = EntityResolver(path)
+    resolver.close()
+    return resolver
+
+
+def iter_mentions(records):
+    """
+    Yields (entity type, name) for every entity in the 'json' column of message records.
+    """
+    for record in records:
+        data = parse_extraction(record.get("json"))
+        if data is None or not isinstance(data.get("entities"), dict):
+            continue
+        for entity_type, values in data["entities"].items():
+            if isinstance(values, str):
+                values = [values]
+            if not isinstance(values, list):
+                continue
+            for name in values:
+                if isinstance(name, str) and name.strip():
+                    yield entity_type, name
+
+
+def resolve_files(csv_files, path=ENTITY_MAP_PATH, rebuild=False, recount=False):
+    """
+    Updates (or with rebuild, recreates) the mapping from processed message CSVs.
+
+    Parameters:
+        csv_files (list): Processed message CSVs.
+        path (str): SQLite file of the mapping.
+        rebuild (bool): Start from an empty mapping.
+        recount (bool): The CSVs are the full set of messages: mention counts are
+            recounted from them instead of added, so reading the same messages again
+            doesn't inflate the counts or shift the spelling a merged cluster keeps.
+            Without it the CSVs must only contain messages not resolved before.
+
+    Returns:
+        dict: Totals of the update statistics plus 'clusters' and 'variants'.
+    """
+    import pandas as pd
+
+    if rebuild and path and os.path.exists(path):
+        os.remove(path)
+    resolver = EntityResolver(path)
+    start_time = time.time()
+    mentions = Counter()
+    for csv_file in csv_files:
+        df = pd.read_csv(csv_file, usecols=lambda c: c == "json")
+        if "json" not in df.columns:
+            continue
+        mentions.update(iter_mentions({"json": value} for value in df["json"]))
+    if recount:
+        resolver.reset_counts()
+    totals = Counter(resolver.update(mentions.elements()))
+    resolver.save()
+    totals.update(clusters=len(resolver.clusters), variants=len(resolver.variants))
+    resolver.close()
+    load_resolver.cache_clear()
+    logger.info(f"Resolved entities in {time.time() - start_time:.1f}s: {dict(totals)}")
+    return dict(totals)
+
+
+def synthetic_names(n, seed=0, variants_per_entity=4):
+    """
+    Distinct names with known ground truth for benchmarking: random entity names
+    plus typo, case, punctuation, word order and "the" variants of each.
+
+    Returns:
+        list: (name, entity index) tuples.
+    """
+    rng = random.Random(seed)
+    syllables = [onset + vowel + coda for onset in ["b", "d", "f", "g", "k", "l", "m", "n", "p", "r", "s",
+                                                    "t", "v", "z", "sh", "br", "st", "tr"]
+                 for vowel in "aeiou" for coda in ["", "", "n", "r", "x"]]
+    suffixes = ["", "", " Steel", " Mining", " Group", " Metals", " Holdings", " Resources"]
+
+    def word():
+        return "".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))).capitalize()
+
+    def typo(name):
+        i = rng.randrange(1, len(name) - 1)
+        op = rng.random()
+        if op < 0.4:
+            return name[:i] + name[i + 1:]
+        if op < 0.7:
+            return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+        return name[:i] + rng.choice("aeiou") + name[i:]
+
+    names = {}  # name -> entity index
+    seen = set()
+    entity = 0
+    while len(names) < n:
+        base = word() + (" " + word() if rng.random() < 0.5 else "") + rng.choice(suffixes)
+        candidates = [base, typo(base), base.upper(), "The " + base, base.replace(" ", "-"),
+                      " ".join(reversed(base.split())) if " " in base else typo(typo(base))]
+        for name in candidates[:1] + rng.sample(candidates[1:], variants_per_entity - 1):
+            # Only names that differ after normalization count as distinct
+            if normalize_name(name) not in seen:
+                seen.add(normalize_name(name))
+                names[name] = entity
+        entity += 1
+    return list(names.items())[:n]
+
+
+def bench(n=100_000, seed=0, incremental_fraction=0.01):
+    """
+    Resolves n synthetic names, reports time, comparisons against the all-pairs
+    count and pairwise precision/recall, then times an incremental update.
+    """
+    names = synthetic_names(n, seed)
+    split = int(len(names) * (1 - incremental_fraction))
+    resolver = EntityResolver(path=None, aliases={})
+
+    start_time = time.time()
+    stats = resolver.update(("Company", name) for name, _ in names[:split])
+    build_seconds = time.time() - start_time
+    start_time = time.time()
+    incremental = resolver.update(("Company", name) for name, _ in names[split:])
+    update_seconds = time.time() - start_time
+
+    # Pairwise precision/recall from the contingency table of predicted vs. true clusters
+    def pairs(counts):
+        return sum(c * (c - 1) // 2 for c in counts.values())
+
+    predicted = [resolver.cluster_of("Company", name) for name, _ in names]
+    true_pairs = pairs(Counter(entity for _, entity in names))
+    predicted_pairs = pairs(Counter(predicted))
+    correct_pairs = pairs(Counter(zip(predicted, (entity for _, entity in names))))
+
+    all_pairs = len(names) * (len(names) - 1) // 2
+    comparisons = stats["comparisons"] + incremental["comparisons"]
+    print(f"Names:           {len(names)} ({len(set(e for _, e in names))} entities)")
+    print(f"Clusters:        {len(resolver.clusters)}")
+    print(f"Comparisons:     {comparisons} ({comparisons / all_pairs:.5%} of {all_pairs} all-pairs)")
+    print(f"Precision:       {correct_pairs / max(predicted_pairs, 1):.3f}")
+    print(f"Recall:          {correct_pairs / max(true_pairs, 1):.3f}")
+    print(f"Build:           {build_seconds:.1f}s for {split} names")
+    print(f"Incremental:     {update_seconds:.2f}s for {len(names) - split} new names "
+          f"({incremental['merged_clusters']} merges)")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    parser = argparse.ArgumentParser(description="Cluster entity name variants into canonical entities")
+    parser.add_argument("--map", default=ENTITY_MAP_PATH, help="SQLite file of the mapping")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command, help_text in [("update", "Add the entities of new messages (not resolved before) to the mapping"),
+                               ("recount", "Update the mapping from the full message history, recounting mentions"),
+                               ("build", "Recreate the mapping from scratch")]:
+        sub = subparsers.add_parser(command, help=help_text)
+        sub.add_argument("--csv", default="telegram_messages.csv", help="Processed messages CSV")
+        sub.add_argument("--partitions", help="Use every partition under this root instead of --csv")
+    sub = subparsers.add_parser("show", help="List the largest clusters")
+    sub.add_argument("--type", help="Only clusters of this entity type")
+    sub.add_argument("--top", type=int, default=20, help="Number of clusters")
+    sub = subparsers.add_parser("lookup", help="Show the canonical entity of a name")
+    sub.add_argument("type", help="Entity type")
+    sub.add_argument("name", help="Entity name")
+    sub = subparsers.add_parser("bench", help="Resolve synthetic names and measure speed and accuracy")
+    sub.add_argument("--names", type=int, default=100_000, help="Number of distinct names")
+    sub.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command in ("update", "recount", "build"):
+        if args.partitions:
+            from read_sources import list_partitions
+            csv_files = list_partitions(args.partitions)
+        else:
+            csv_files = [args.csv]
+        totals = resolve_files(csv_files, args.map, rebuild=args.command == "build",
+                               recount=args.command == "recount")
+        print(f"{totals['variants']} variants in {totals['clusters']} clusters "
+              f"({totals.get('new_variants', 0)} new variants, {totals.get('merged_clusters', 0)} merges)")
+    elif args.command == "show":
+        resolver = EntityResolver(args.map)
+        type_name = canonical_name(args.type) if args.type else None
+        clusters = [c for c in resolver.clusters if type_name is None or resolver.clusters[c][0] == type_name]
+        clusters.sort(key=lambda c: (-len(resolver.members.get(c, ())), c))
+        for cluster in clusters[:args.top]:
+            print(f"{cluster:<40} {resolver.cluster_members(cluster)}")
+        resolver.close()
+    elif args.command == "lookup":
+        resolver = EntityResolver(args.map)
+        cluster = resolver.cluster_of(args.type, args.name)
+        if cluster is None:
+            print(f"{args.name!r} is not in the mapping")
+        else:
+            print(f"{cluster} ({resolver.clusters[cluster][1]}): {resolver.cluster_members(cluster)}")
+        resolver.close()
+    else:
+        bench(args.names, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+Local stand-in for the OpenAI chat completions API, for latency experiments
+without an API key or cost.
+
+    python fake_llm.py serve --port 8765
+    OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=fake python llm.py --csv sample.csv
+
+    python fake_llm.py bench --messages 300 --concurrency 20
+
+The server answers POST /v1/chat/completions, streamed (server-sent events)
+or not, with an llm.py-style JSON extraction of the user message
+(synthetic_export.synthetic_json). Its latency model imitates what makes the
+real API's tail long:
+
+  - time to first token is log-normal, and a few requests land on a stalled
+    replica and wait STALL_FACTOR times longer;
+  - tokens are generated at a fixed rate, so long answers take long;
+  - some answers wrap the JSON in a ```json fence and add a note after it;
+  - a few answers run away (the subject string never ends) until max_tokens
+    or RUNAWAY_TOKENS is reached.
+
+max_tokens is honoured (finish_reason "length"), and a streamed response stops
+generating as soon as the client disconnects. GET /stats returns the number of
+requests and generated tokens.
+
+Model names listed in MODEL_PROFILES ("fake-small", "fake-standard",
+"fake-large") behave like cheaper or more capable models: faster or slower,
+missing more or fewer entities, failing with HTTP 500 or answering with broken
+JSON more or less often. Any other model name gets the plain behaviour above.
+router.py's report uses them to compare model tiers.
+
+bench runs the same messages through the plain async call, the streamed call
+with early JSON completion and the max_tokens ceiling, and the streamed call
+with hedging, and prints per-message latency percentiles for each.
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHARS_PER_TOKEN = 4
+TOKENS_PER_CHUNK = 4
+TOKENS_PER_SECOND = 60.0
+FIRST_TOKEN_MEDIAN = 0.5  # seconds
+FIRST_TOKEN_SIGMA = 0.3
+STALL_PROBABILITY = 0.04
+STALL_FACTOR = 8.0
+FENCE_PROBABILITY = 0.5
+NOTE_PROBABILITY = 0.3
+RUNAWAY_PROBABILITY = 0.02
+RUNAWAY_TOKENS = 3000
+
+# speed multiplies every delay; recall is the share of entities (and content types) kept;
+# errors and invalid are the fractions of HTTP 500s and truncated answers
+DEFAULT_PROFILE = {"speed": 1.0, "recall": 1.0, "errors": 0.0, "invalid": 0.0}
+MODEL_PROFILES = {
+    "fake-small": {"speed": 0.6, "recall": 0.75, "errors": 0.03, "invalid": 0.05},
+    "fake-standard": {"speed": 1.0, "recall": 0.92, "errors": 0.01, "invalid": 0.01},
+    "fake-large": {"speed": 1.8, "recall": 1.0, "errors": 0.005, "invalid": 0.0},
+}
+
+
+class FakeBackend:
+    """
+    Answer generation and latency model shared by all request handlers.
+
+    Parameters:
+        time_scale (float): Multiplies every delay (0.1 runs ten times faster).
+        seed (int): Seed of the latency and content randomness.
+    """
+
+    def __init__(self, time_scale=1.0, seed=0):
+        self.time_scale = time_scale
+        self.seed = seed
+        self.requests = 0
+        self.tokens = 0
+        self.disconnects = 0
+        self._lock = threading.Lock()
+
+    def next_rng(self):
+        """Independent randomness for every request, so a hedged duplicate gets its own latency."""
+        with self._lock:
+            self.requests += 1
+            return random.Random(self.seed * 1_000_003 + self.requests)
+
+    def count_tokens(self, tokens):
+        with self._lock:
+            self.tokens += tokens
+
+    def count_disconnect(self):
+        with self._lock:
+            self.disconnects += 1
+
+    def stats(self):
+        with self._lock:
+            return {"requests": self.requests, "tokens": self.tokens, "disconnects": self.disconnects}
+
+    def answer(self, rng, text, model="fake"):
+        """The full text the model would produce if nothing stopped it."""
+        from synthetic_export import synthetic_json, CONTENT_TYPES
+
+        # The extraction itself depends only on the message (and model), like a deterministic model
+        extraction = synthetic_json(random.Random(zlib.crc32(text.encode("utf-8"))), text)
+        profile = MODEL_PROFILES.get(model, DEFAULT_PROFILE)
+        if profile["recall"] < 1:
+            model_rng = random.Random(zlib.crc32((model + text).encode("utf-8")))
+            result = json.loads(extraction)
+            entities = {entity_type: [value for value in values if model_rng.random() < profile["recall"]]
+                        for entity_type, values in result["entities"].items()}
+            result["entities"] = {entity_type: values for entity_type, values in entities.items() if values}
+            if model_rng.random() >= profile["recall"]:
+                result["type_of_content"] = model_rng.choice(CONTENT_TYPES)
+            extraction = json.dumps(result, ensure_ascii=False)
+        if profile["invalid"] and rng.random() < profile["invalid"]:
+            return extraction[:len(extraction) // 2]
+        if rng.random() < RUNAWAY_PROBABILITY:
+            words = " ".join(rng.choice(["steel", "prices", "supply", "demand", "China"])
+                             for _ in range(RUNAWAY_TOKENS))
+            return extraction[:extraction.rindex('"subject": "') + 12] + words
+        answer = extraction
+        if rng.random() < FENCE_PROBABILITY:
+            answer = "```json\n" + answer + "\n```"
+        if rng.random() < NOTE_PROBABILITY:
+            note_tokens = rng.randint(50, 250)
+            answer += "\n\nNote: " + " ".join(["the extraction is based on the text only."] * (note_tokens // 9))
+        return answer
+
+    def first_token_delay(self, rng, model="fake"):
+        delay = FIRST_TOKEN_MEDIAN * math.exp(rng.gauss(0, FIRST_TOKEN_SIGMA))
+        if rng.random() < STALL_PROBABILITY:
+            delay *= STALL_FACTOR
+        return delay * MODEL_PROFILES.get(model, DEFAULT_PROFILE)["speed"] * self.time_scale
+
+    def chunks(self, answer, max_tokens):
+        """
+        Splits the answer into streamed pieces.
+
+        Returns:
+            tuple: (list of text pieces, finish_reason).
+        """
+        size = TOKENS_PER_CHUNK * CHARS_PER_TOKEN
+        limit = len(answer) if max_tokens is None else min(len(answer), max_tokens * CHARS_PER_TOKEN)
+        pieces = [answer[i:min(i + size, limit)] for i in range(0, limit, size)]
+        return pieces, "length" if limit < len(answer) else "stop"
+
+
+def _completion_id(rng):
+    return f"chatcmpl-{rng.getrandbits(48):012x}"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    backend = None  # set by make_server
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/stats"):
+            self._send_json(200, self.backend.stats())
+        else:
+            self._send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found"}})
+            return
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        backend = self.backend
+        rng = backend.next_rng()
+        text = request["messages"][-1]["content"]
+        model = request.get("model", "fake")
+        max_tokens = request.get("max_tokens") or request.get("max_completion_tokens")
+        profile = MODEL_PROFILES.get(model, DEFAULT_PROFILE)
+        if profile["errors"] and rng.random() < profile["errors"]:
+            time.sleep(backend.first_token_delay(rng, model))
+            self._send_json(500, {"error": {"message": "The server had an error while processing your request",
+                                            "type": "server_error"}})
+            return
+        pieces, finish_reason = backend.chunks(backend.answer(rng, text, model), max_tokens)
+        seconds_per_chunk = TOKENS_PER_CHUNK / TOKENS_PER_SECOND * profile["speed"] * backend.time_scale
+        completion_id = _completion_id(rng)
+        time.sleep(backend.first_token_delay(rng, model))
+
+        if not request.get("stream"):
+            time.sleep(seconds_per_chunk * len(pieces))
+            backend.count_tokens(len(pieces) * TOKENS_PER_CHUNK)
+            content = "".join(pieces)
+            self._send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content},
+                             "finish_reason": finish_reason}],
+                "usage": {"prompt_tokens": len(text) // CHARS_PER_TOKEN,
+                          "completion_tokens": len(pieces) * TOKENS_PER_CHUNK,
+                          "total_tokens": len(text) // CHARS_PER_TOKEN + len(pieces) * TOKENS_PER_CHUNK},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(delta, finish=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}
+            data = f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        try:
+            event({"role": "assistant", "content": ""})
+            for piece in pieces:
+                time.sleep(seconds_per_chunk)
+                event({"content": piece})
+                backend.count_tokens(TOKENS_PER_CHUNK)
+            event({}, finish_reason)
+            done = b"data: [DONE]\n\n"
+            self.wfile.write(f"{len(done):x}\r\n".encode("ascii") + done + b"\r\n0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client closed the stream early; stop generating, like the real API
+            backend.count_disconnect()
+            self.close_connection = True
+
+
+def make_server(host="127.0.0.1", port=8765, time_scale=1.0, seed=0):
+    """
+    Creates (but doesn't start) a fake API server. port=0 picks a free port.
+
+    Returns:
+        ThreadingHTTPServer: The server; its backend is server.RequestHandlerClass.backend.
+    """
+    handler = type("FakeHandler", (Handler,), {"backend": FakeBackend(time_scale, seed)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else float("nan")
+
+
+async def _run_mode(mode, texts, base_url, concurrency):
+    """Per-message latencies and results of one call mode."""
+    from openai import AsyncOpenAI
+    import llm
+    from streaming import LatencyTracker
+
+    client = AsyncOpenAI(api_key="fake", base_url=base_url, max_retries=0)
+    tracker = LatencyTracker()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(text):
+        async with semaphore:
+            start = time.perf_counter()
+            if mode == "plain":
+                result = await llm.extract_entities_async(text, "fake", client)
+            elif mode == "stream":
+                result = await llm.extract_entities_stream_async(text, "fake", client)
+            else:
+                result = await llm.extract_entities_hedged_async(text, "fake", client, tracker)
+            return time.perf_counter() - start, result
+
+    try:
+        return await asyncio.gather(*(one(text) for text in texts))
+    finally:
+        await client.close()
+
+
+def bench(num_messages=300, concurrency=20, time_scale=1.0, seed=0):
+    """
+    Runs the three call modes against a fresh fake server each.
+
+    Returns:
+        dict: Dictionary {mode: {"p50", "p95", "p99", "max", "valid", "requests", "tokens"}}.
+    """
+    from metrics import configure
+    from synthetic_export import generate_dataframe
+
+    configure(enabled=False)
+    df = generate_dataframe(num_messages * 3, seed=seed, with_json=False)
+    texts = [t for t in df["text"] if isinstance(t, str) and len(t) > 100][:num_messages]
+
+    results = {}
+    for mode in ("plain", "stream", "hedged"):
+        server = make_server(port=0, time_scale=time_scale, seed=seed)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+            outcomes = asyncio.run(_run_mode(mode, texts, base_url, concurrency))
+        finally:
+            server.shutdown()
+            server.server_close()
+        latencies = [seconds / time_scale for seconds, _ in outcomes]
+        valid = 0
+        for _, result in outcomes:
+            try:
+                valid += isinstance(json.loads(result), dict)
+            except (TypeError, json.JSONDecodeError):
+                pass
+        stats = server.RequestHandlerClass.backend.stats()
+        results[mode] = {"p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+                         "p99": percentile(latencies, 99), "max": max(latencies),
+                         "valid": valid / len(outcomes), "requests": stats["requests"], "tokens": stats["tokens"]}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake OpenAI chat completions API")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sub = subparsers.add_parser("serve", help="Run the fake API")
+    sub.add_argument("--host", default="127.0.0.1")
+    sub.add_argument("--port", type=int, default=8765)
+    sub.add_argument("--time-scale", type=float, default=1.0, help="Multiplies every delay")
+    sub.add_argument("--seed", type=int, default=0)
+    sub = subparsers.add_parser("bench", help="Compare per-message latency of the call modes")
+    sub.add_argument("--messages", type=int, default=300)
+    sub.add_argument("--concurrency", type=int, default=20)
+    sub.add_argument("--time-scale", type=float, default=1.0,
+                     help="Multiplies every delay; reported latencies are scaled back to real time, so values "
+                          "below 1 run faster but inflate the client's per-chunk overhead")
+    sub.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = make_server(args.host, args.port, args.time_scale, args.seed)
+        print(f"Fake API on http://{args.host}:{server.server_address[1]}/v1")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    results = bench(args.messages, args.concurrency, args.time_scale, args.seed)
+    print(f"\nPer-message latency in seconds, {args.messages} messages, concurrency {args.concurrency}")
+    print(f"{'mode':<8}{'p50':>8}{'p95':>8}{'p99':>8}{'max':>8}{'valid':>8}{'requests':>10}{'tokens':>10}")
+    for mode, r in results.items():
+        print(f"{mode:<8}{r['p50']:>8.2f}{r['p95']:>8.2f}{r['p99']:>8.2f}{r['max']:>8.2f}"
+              f"{r['valid']:>8.0%}{r['requests']:>10}{r['tokens']:>10}")
+
+
+if __name__ == "__main__":
+    main()
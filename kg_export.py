@@ -0,0 +1,270 @@
+"""
+Offline CSV export for the first load of the knowledge graph.
+
+Transactional MERGE (kg_loader.py) is the right tool for incremental updates,
+but far too slow for the initial load of years of channel history. This module
+streams the processed messages CSV once and writes deduplicated node and
+relationship files in the header format of `neo4j-admin database import full`.
+
+Node keys are the same as kg_loader.py uses, so the graph can be bulk
+imported once and then kept up to date with kg_loader.py. Deduplication and
+co-mention counting go through a SQLite file next to the output, so memory use
+stays bounded no matter how long the history is.
+"""
+
+import argparse
+import csv
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from itertools import combinations
+
+from kg_loader import canonical_name, entity_id, iter_csv_records, message_key, parse_extraction
+
+try:
+    from config import KG_IMPORT_DIR, NEO4J_BATCH_SIZE
+except ImportError:
+    KG_IMPORT_DIR = "kg_import"
+    NEO4J_BATCH_SIZE = 1000
+
+logger = logging.getLogger(__name__)
+
+# file name -> header row, in neo4j-admin import format
+NODE_FILES = {
+    "messages.csv": ["id:ID(Message)", "date", "time", "text", "subject", "reactions:int"],
+    "entities.csv": ["id:ID(Entity)", "name", "type"],
+    "entity_types.csv": ["name:ID(EntityType)"],
+    "hashtags.csv": ["name:ID(Hashtag)"],
+    "content_types.csv": ["name:ID(ContentType)"],
+}
+
+RELATIONSHIP_FILES = {
+    "mentions.csv": [":START_ID(Message)", ":END_ID(Entity)"],
+    "is_a.csv": [":START_ID(Entity)", ":END_ID(EntityType)"],
+    "tagged.csv": [":START_ID(Message)", ":END_ID(Hashtag)"],
+    "has_content_type.csv": [":START_ID(Message)", ":END_ID(ContentType)"],
+    "co_mentioned.csv": [":START_ID(Entity)", ":END_ID(Entity)", "count:int"],
+}
+
+# node file -> label, relationship file -> type, for the import command
+LABELS = {
+    "messages.csv": "Message",
+    "entities.csv": "Entity",
+    "entity_types.csv": "EntityType",
+    "hashtags.csv": "Hashtag",
+    "content_types.csv": "ContentType",
+}
+
+RELATIONSHIP_TYPES = {
+    "mentions.csv": "MENTIONS",
+    "is_a.csv": "IS_A",
+    "tagged.csv": "TAGGED",
+    "has_content_type.csv": "HAS_CONTENT_TYPE",
+    "co_mentioned.csv": "CO_MENTIONED",
+}
+
+
+def key_hash(namespace, key):
+    """64-bit hash of a node key, used as the on-disk dedupe set entry."""
+    digest = hashlib.blake2b(f"{namespace}\0{key}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+class SeenSet:
+    """
+    On-disk set of node key hashes backed by SQLite.
+
+    Only 8-byte hashes are stored, so even millions of nodes stay small, and
+    nothing has to be held in memory between chunks.
+    """
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=OFF")
+        self.conn.execute("PRAGMA synchronous=OFF")
+        self.conn.execute("CREATE TABLE seen (h INTEGER PRIMARY KEY)")
+        self.conn.execute(
+            "CREATE TABLE co_mentions (a TEXT, b TEXT, count INTEGER, PRIMARY KEY (a, b)) WITHOUT ROWID"
+        )
+
+    def add(self, namespace, key):
+        """Adds a key. Returns True if it wasn't in the set before."""
+        cursor = self.conn.execute("INSERT OR IGNORE INTO seen (h) VALUES (?)", (key_hash(namespace, key),))
+        return cursor.rowcount == 1
+
+    def add_co_mentions(self, pairs):
+        self.conn.executemany(
+            "INSERT INTO co_mentions (a, b, count) VALUES (?, ?, 1) "
+            "ON CONFLICT (a, b) DO UPDATE SET count = count + 1",
+            pairs,
+        )
+
+    def iter_co_mentions(self):
+        yield from self.conn.execute("SELECT a, b, count FROM co_mentions ORDER BY a, b")
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def export_csv(csv_file, output_dir=KG_IMPORT_DIR, chunksize=NEO4J_BATCH_SIZE, resolver=None):
+    """
+    Writes neo4j-admin import files for a processed messages CSV.
+
+    Parameters:
+        csv_file (str): Path of the processed messages CSV.
+        output_dir (str): Directory for the node and relationship CSV files.
+        chunksize (int): Number of rows read from the input at a time.
+        resolver (EntityResolver): Optional entity mapping (see entity_resolution.py); all
+            variants of an entity then become one node.
+
+    Returns:
+        dict: Number of rows written per output file.
+    """
+    from analyse import sum_reactions
+
+    os.makedirs(output_dir, exist_ok=True)
+    seen = SeenSet(os.path.join(output_dir, ".dedupe.sqlite"))
+    files = {}
+    writers = {}
+    counts = {}
+    for name, header in {**NODE_FILES, **RELATIONSHIP_FILES}.items():
+        files[name] = open(os.path.join(output_dir, name), "w", newline="", encoding="utf-8")
+        writers[name] = csv.writer(files[name])
+        writers[name].writerow(header)
+        counts[name] = 0
+
+    def write(name, row):
+        writers[name].writerow(row)
+        counts[name] += 1
+
+    start_time = time.time()
+    processed = 0
+    try:
+        for record in iter_csv_records(csv_file, chunksize=chunksize):
+            data = parse_extraction(record.get("json"))
+            message_id = message_key(record)
+            if data is None or message_id is None:
+                continue
+            # Re-exported history can contain the same message twice
+            if not seen.add("Message", message_id):
+                continue
+
+            write("messages.csv", [
+                message_id,
+                _clean(record.get("date")),
+                _clean(record.get("time")),
+                _clean(record.get("text")),
+                data.get("subject") or "",
+                sum_reactions(record.get("reactions")),
+            ])
+
+            content_type = data.get("type_of_content")
+            if isinstance(content_type, str) and content_type:
+                if seen.add("ContentType", content_type):
+                    write("content_types.csv", [content_type])
+                write("has_content_type.csv", [message_id, content_type])
+
+            hashtag_list = data.get("hashtags", [])
+            if isinstance(hashtag_list, list):
+                for hashtag in sorted(set(h.strip() for h in hashtag_list if isinstance(h, str) and h.strip())):
+                    if seen.add("Hashtag", hashtag):
+                        write("hashtags.csv", [hashtag])
+                    write("tagged.csv", [message_id, hashtag])
+
+            message_entities = set()
+            entity_dict = data.get("entities", {})
+            if isinstance(entity_dict, dict):
+                for entity_type, values in entity_dict.items():
+                    if isinstance(values, str):
+                        values = [values]
+                    if not isinstance(values, list):
+                        continue
+                    type_name = canonical_name(entity_type)
+                    for name in values:
+                        if not isinstance(name, str) or not name.strip():
+                            continue
+                        if resolver is not None:
+                            key = resolver.canonical_id(entity_type, name)
+                        else:
+                            key = entity_id(entity_type, name)
+                        if key in message_entities:
+                            continue
+                        message_entities.add(key)
+                        if seen.add("EntityType", type_name):
+                            write("entity_types.csv", [type_name])
+                        if seen.add("Entity", key):
+                            display_name = resolver.canonical_name(entity_type, name) if resolver else name.strip()
+                            write("entities.csv", [key, display_name, type_name])
+                            write("is_a.csv", [key, type_name])
+                        write("mentions.csv", [message_id, key])
+
+            if len(message_entities) > 1:
+                seen.add_co_mentions(combinations(sorted(message_entities), 2))
+
+            processed += 1
+            if processed % chunksize == 0:
+                seen.commit()
+                logger.info(f"Exported {processed} messages ({processed / (time.time() - start_time):.0f} msg/s)")
+
+        for a, b, count in seen.iter_co_mentions():
+            write("co_mentioned.csv", [a, b, count])
+    finally:
+        for f in files.values():
+            f.close()
+        seen.close()
+        os.remove(os.path.join(output_dir, ".dedupe.sqlite"))
+
+    logger.info(f"Exported {processed} messages in {time.time() - start_time:.1f}s: {counts}")
+    return counts
+
+
+def _clean(value):
+    """Converts pandas NaN to an empty field."""
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    return value
+
+
+def import_command(output_dir=KG_IMPORT_DIR, database="neo4j"):
+    """
+    Returns the neo4j-admin command that imports the exported files into an empty database.
+    """
+    parts = ["neo4j-admin database import full"]
+    for name, label in LABELS.items():
+        parts.append(f"--nodes={label}={os.path.join(output_dir, name)}")
+    for name, rel_type in RELATIONSHIP_TYPES.items():
+        parts.append(f"--relationships={rel_type}={os.path.join(output_dir, name)}")
+    parts.append("--multiline-fields=true")
+    parts.append(database)
+    return " \\\n    ".join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export processed messages as neo4j-admin import CSV files")
+    parser.add_argument("--csv", default="telegram_messages.csv", help="Processed messages CSV")
+    parser.add_argument("--output-dir", default=KG_IMPORT_DIR, help="Directory for the import files")
+    parser.add_argument("--chunksize", type=int, default=NEO4J_BATCH_SIZE, help="Rows read at a time")
+    parser.add_argument("--entity-map", help="Merge entity name variants using this mapping "
+                                             "(written by entity_resolution.py)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    resolver = None
+    if args.entity_map:
+        from entity_resolution import load_resolver
+        resolver = load_resolver(args.entity_map)
+    export_csv(args.csv, args.output_dir, args.chunksize, resolver)
+    print("\nImport into an empty database (stop Neo4j first) with:\n")
+    print(import_command(args.output_dir))
+    print("\nThen run kg_loader.py once to create the constraints and indexes.")
+
+
+if __name__ == "__main__":
+    main()
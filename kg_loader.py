@@ -0,0 +1,354 @@
+"""
+Bulk loader for the Neo4j knowledge graph.
+
+Reads the processed messages CSV (the 'json' column written by llm.py) and
+writes Message, Entity, EntityType, Hashtag and ContentType nodes plus their
+relationships using batched UNWIND ... MERGE transactions. Every statement is a
+MERGE, so re-running the loader over the same file leaves the graph unchanged.
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+import unicodedata
+
+try:
+    from config import NEO4J_BATCH_SIZE, NEO4J_MAX_POOL_SIZE
+except ImportError:
+    NEO4J_BATCH_SIZE = 1000
+    NEO4J_MAX_POOL_SIZE = 10
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_STATEMENTS = [
+    "CREATE CONSTRAINT message_id IF NOT EXISTS FOR (m:Message) REQUIRE m.id IS UNIQUE",
+    "CREATE CONSTRAINT entity_id IF NOT EXISTS FOR (e:Entity) REQUIRE e.id IS UNIQUE",
+    "CREATE CONSTRAINT entity_type_name IF NOT EXISTS FOR (t:EntityType) REQUIRE t.name IS UNIQUE",
+    "CREATE CONSTRAINT hashtag_name IF NOT EXISTS FOR (h:Hashtag) REQUIRE h.name IS UNIQUE",
+    "CREATE CONSTRAINT content_type_name IF NOT EXISTS FOR (c:ContentType) REQUIRE c.name IS UNIQUE",
+    "CREATE INDEX message_date IF NOT EXISTS FOR (m:Message) ON (m.date)",
+    "CREATE INDEX entity_name IF NOT EXISTS FOR (e:Entity) ON (e.name)",
+]
+
+MERGE_MESSAGES = """
+UNWIND $rows AS row
+MERGE (m:Message {id: row.id})
+SET m.date = row.date, m.time = row.time, m.text = row.text,
+    m.subject = row.subject, m.reactions = row.reactions
+"""
+
+MERGE_ENTITIES = """
+UNWIND $rows AS row
+MERGE (t:EntityType {name: row.type})
+MERGE (e:Entity {id: row.id})
+ON CREATE SET e.name = row.name, e.type = row.type
+MERGE (e)-[:IS_A]->(t)
+"""
+
+MERGE_HASHTAGS = """
+UNWIND $names AS name
+MERGE (:Hashtag {name: name})
+"""
+
+MERGE_CONTENT_TYPES = """
+UNWIND $names AS name
+MERGE (:ContentType {name: name})
+"""
+
+MERGE_MENTIONS = """
+UNWIND $rows AS row
+MATCH (m:Message {id: row.message_id})
+MATCH (e:Entity {id: row.entity_id})
+MERGE (m)-[:MENTIONS]->(e)
+"""
+
+MERGE_TAGGED = """
+UNWIND $rows AS row
+MATCH (m:Message {id: row.message_id})
+MATCH (h:Hashtag {name: row.hashtag})
+MERGE (m)-[:TAGGED]->(h)
+"""
+
+MERGE_HAS_CONTENT_TYPE = """
+UNWIND $rows AS row
+MATCH (m:Message {id: row.message_id})
+MATCH (c:ContentType {name: row.content_type})
+MERGE (m)-[:HAS_CONTENT_TYPE]->(c)
+"""
+
+
+def get_driver(uri=None, user=None, password=None, max_pool_size=NEO4J_MAX_POOL_SIZE):
+    """
+    Creates a pooled Neo4j driver from the same environment variables as test_kg_connection.py.
+    """
+    from dotenv import load_dotenv
+    from neo4j import GraphDatabase
+
+    load_dotenv()
+    uri = uri or os.getenv("NEO4J_URI", "bolt://localhost:7687")
+    user = user or os.getenv("NEO4J_USER", "neo4j")
+    password = password if password is not None else os.getenv("NEO4J_PASSWORD", "")
+    return GraphDatabase.driver(uri, auth=(user, password), max_connection_pool_size=max_pool_size)
+
+
+def canonical_name(name):
+    """
+    Normalizes a name for use in a node key: Unicode NFKC, collapsed whitespace, case-folded.
+    """
+    return " ".join(unicodedata.normalize("NFKC", str(name)).split()).casefold()
+
+
+def entity_id(entity_type, name):
+    """
+    Stable key of an entity node. Entity type and name are both part of its identity,
+    and both are canonicalized so "Iron Ore" and "iron  ore" map to the same node.
+    EntityType nodes are named by the canonical type for the same reason.
+    """
+    return f"{canonical_name(entity_type)}:{canonical_name(name)}"
+
+
+def message_key(record):
+    """
+    Key of a message node. Telegram message ids are only unique within a channel,
+    so records from partitioned multi-channel storage are prefixed with their channel.
+
+    Returns:
+        str or None: The key, or None if the record has no id.
+    """
+    message_id = record.get("id")
+    if not isinstance(message_id, str) or not message_id:
+        return None
+    channel = record.get("channel")
+    return f"{channel}/{message_id}" if isinstance(channel, str) and channel else message_id
+
+
+def parse_extraction(json_str):
+    """
+    Parses one 'json' cell written by llm.py.
+
+    Returns:
+        dict or None: The parsed object, or None if the cell is empty or invalid.
+    """
+    if json_str is None or (isinstance(json_str, float) and json_str != json_str):
+        return None
+    try:
+        data = json.loads(str(json_str))
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def build_batch(records, resolver=None):
+    """
+    Turns message records into deduplicated parameter lists for the UNWIND statements.
+
+    Parameters:
+        records (list): Dicts with 'id', 'date', 'time', 'text', 'reactions' and 'json' keys
+            (and 'channel' for partitioned storage).
+        resolver (EntityResolver): Optional entity mapping (see entity_resolution.py); all
+            variants of an entity then become one node.
+
+    Returns:
+        dict: Parameter lists keyed by statement.
+    """
+    from analyse import sum_reactions
+
+    messages = []
+    entities = {}
+    hashtags = set()
+    content_types = set()
+    mentions = []
+    tagged = []
+    has_content_type = []
+
+    for record in records:
+        data = parse_extraction(record.get("json"))
+        message_id = message_key(record)
+        if data is None or message_id is None:
+            continue
+        messages.append({
+            "id": message_id,
+            "date": _clean(record.get("date")),
+            "time": _clean(record.get("time")),
+            "text": _clean(record.get("text")),
+            "subject": data.get("subject"),
+            "reactions": sum_reactions(record.get("reactions")),
+        })
+
+        content_type = data.get("type_of_content")
+        if isinstance(content_type, str) and content_type:
+            content_types.add(content_type)
+            has_content_type.append({"message_id": message_id, "content_type": content_type})
+
+        hashtag_list = data.get("hashtags", [])
+        if isinstance(hashtag_list, list):
+            for hashtag in set(h.strip() for h in hashtag_list if isinstance(h, str) and h.strip()):
+                hashtags.add(hashtag)
+                tagged.append({"message_id": message_id, "hashtag": hashtag})
+
+        entity_dict = data.get("entities", {})
+        if not isinstance(entity_dict, dict):
+            continue
+        seen = set()
+        for entity_type, values in entity_dict.items():
+            if isinstance(values, str):
+                values = [values]
+            if not isinstance(values, list):
+                continue
+            for name in values:
+                if not isinstance(name, str) or not name.strip():
+                    continue
+                if resolver is not None:
+                    key = resolver.canonical_id(entity_type, name)
+                    display_name = resolver.canonical_name(entity_type, name)
+                else:
+                    key, display_name = entity_id(entity_type, name), name.strip()
+                entities[key] = {"id": key, "name": display_name, "type": canonical_name(entity_type)}
+                if key not in seen:
+                    seen.add(key)
+                    mentions.append({"message_id": message_id, "entity_id": key})
+
+    return {
+        "messages": messages,
+        "entities": list(entities.values()),
+        "hashtags": sorted(hashtags),
+        "content_types": sorted(content_types),
+        "mentions": mentions,
+        "tagged": tagged,
+        "has_content_type": has_content_type,
+    }
+
+
+def _clean(value):
+    """Converts pandas NaN to None so it is stored as a missing property."""
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def _write_batch(tx, batch):
+    # Nodes first, then the relationships that MATCH them
+    tx.run(MERGE_MESSAGES, rows=batch["messages"])
+    if batch["entities"]:
+        tx.run(MERGE_ENTITIES, rows=batch["entities"])
+    if batch["hashtags"]:
+        tx.run(MERGE_HASHTAGS, names=batch["hashtags"])
+    if batch["content_types"]:
+        tx.run(MERGE_CONTENT_TYPES, names=batch["content_types"])
+    if batch["mentions"]:
+        tx.run(MERGE_MENTIONS, rows=batch["mentions"])
+    if batch["tagged"]:
+        tx.run(MERGE_TAGGED, rows=batch["tagged"])
+    if batch["has_content_type"]:
+        tx.run(MERGE_HAS_CONTENT_TYPE, rows=batch["has_content_type"])
+
+
+def create_schema(driver, database=None):
+    """Creates the uniqueness constraints and indexes. Safe to run repeatedly."""
+    with driver.session(database=database) as session:
+        for statement in SCHEMA_STATEMENTS:
+            session.run(statement).consume()
+    logger.info(f"Schema ready ({len(SCHEMA_STATEMENTS)} constraints/indexes)")
+
+
+def load_records(driver, records, batch_size=NEO4J_BATCH_SIZE, database=None, resolver=None):
+    """
+    Writes message records to the graph in batches, one write transaction per batch.
+
+    Parameters:
+        driver: Neo4j driver (or any object with the same session()/execute_write() interface).
+        records (iterable): Message dicts, see build_batch.
+        batch_size (int): Number of messages per transaction.
+        database (str): Target database, None for the server default.
+        resolver (EntityResolver): Optional entity mapping, see build_batch.
+
+    Returns:
+        int: Number of messages written.
+    """
+    written = 0
+    start_time = time.time()
+    batch = []
+    with driver.session(database=database) as session:
+        for record in records:
+            batch.append(record)
+            if len(batch) >= batch_size:
+                written += _flush(session, batch, resolver)
+                batch = []
+                elapsed = time.time() - start_time
+                logger.info(f"Loaded {written} messages ({written / max(elapsed, 1e-9):.0f} msg/s)")
+        if batch:
+            written += _flush(session, batch, resolver)
+
+    elapsed = time.time() - start_time
+    logger.info(f"Finished loading {written} messages in {elapsed:.1f}s ({written / max(elapsed, 1e-9):.0f} msg/s)")
+    return written
+
+
+def _flush(session, records, resolver=None):
+    params = build_batch(records, resolver)
+    if not params["messages"]:
+        return 0
+    session.execute_write(_write_batch, params)
+    return len(params["messages"])
+
+
+def iter_csv_records(csv_file, chunksize=NEO4J_BATCH_SIZE):
+    """
+    Streams message records from the processed CSV without loading it all at once.
+    """
+    import pandas as pd
+
+    columns = ["channel", "id", "date", "time", "text", "reactions", "json"]
+    for chunk in pd.read_csv(csv_file, chunksize=chunksize, usecols=lambda c: c in columns):
+        if "json" not in chunk.columns:
+            raise ValueError("CSV must contain a 'json' column, run llm.py first")
+        yield from chunk.to_dict("records")
+
+
+def load_csv(csv_file, driver=None, batch_size=NEO4J_BATCH_SIZE, database=None, resolver=None):
+    """
+    Creates the schema and loads a processed messages CSV into Neo4j.
+
+    Parameters:
+        csv_file (str): Path of the processed messages CSV.
+        driver: Optional existing driver; a pooled driver is created (and closed) otherwise.
+        batch_size (int): Number of messages per transaction.
+        database (str): Target database, None for the server default.
+        resolver (EntityResolver): Optional entity mapping, see build_batch.
+
+    Returns:
+        int: Number of messages written.
+    """
+    own_driver = driver is None
+    if own_driver:
+        driver = get_driver()
+    try:
+        create_schema(driver, database)
+        return load_records(driver, iter_csv_records(csv_file, chunksize=batch_size), batch_size, database,
+                            resolver)
+    finally:
+        if own_driver:
+            driver.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load processed messages into the Neo4j knowledge graph")
+    parser.add_argument("--csv", default="telegram_messages.csv", help="Processed messages CSV")
+    parser.add_argument("--batch-size", type=int, default=NEO4J_BATCH_SIZE, help="Messages per transaction")
+    parser.add_argument("--database", default=None, help="Neo4j database name")
+    parser.add_argument("--entity-map", help="Merge entity name variants using this mapping "
+                                             "(written by entity_resolution.py)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    resolver = None
+    if args.entity_map:
+        from entity_resolution import load_resolver
+        resolver = load_resolver(args.entity_map)
+    load_csv(args.csv, batch_size=args.batch_size, database=args.database, resolver=resolver)
+
+
+if __name__ == "__main__":
+    main()
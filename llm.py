@@ -8,7 +8,10 @@ import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import logging
 import asyncio
-from typing import List, Tuple, Optional
+from typing import Callable, List, Tuple, Optional
+from metrics import span, increment
+from scheduler import Budget, pending_rows
+from streaming import JsonStreamScanner, LatencyTracker
 
 # Import configuration
 try:
@@ -21,22 +24,35 @@ except ImportError:
     MAX_CONCURRENT = 5
     API_DELAY = 0.1
     PROCESSING_METHOD = "thread"
+    QUEUE_PROCESSES = 1
+    EXTRACT_MAX_TOKENS = None
+    EXTRACT_MAX_COST = None
+    EXTRACT_MAX_SECONDS = None
+    STREAM_RESPONSES = True
+    ROUTING_ENABLED = False
+    OUTPUT_TOKENS_BASE = 200
+    OUTPUT_TOKENS_PER_INPUT_TOKEN = 0.5
+    OUTPUT_TOKENS_CEILING = 1000
+    CHARS_PER_TOKEN = 3.0
     MAX_RETRIES = 3
     RETRY_DELAY = 1.0
     LOG_LEVEL = "INFO"
     LOG_FORMAT = "%(asctime)s - %(levelname)s - %(message)s"
 
-load_dotenv()
-
-# Set up logging
-logging.basicConfig(level=getattr(logging, LOG_LEVEL), format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
-def extract_entities(news_text: str, model: str = "gpt-4o-mini") -> str:
-    
-    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-    
-    system_prompt = f"""
+def setup_logging():
+    logging.basicConfig(level=getattr(logging, LOG_LEVEL), format=LOG_FORMAT)
+
+def get_api_key() -> Optional[str]:
+    """
+    Loads .env on first use so importing this module has no side effects
+    """
+    if not os.getenv("OPENAI_API_KEY"):
+        load_dotenv()
+    return os.getenv("OPENAI_API_KEY")
+
+SYSTEM_PROMPT = f"""
                         You are an expert commodity trader tasked with extracting entities from news articles to create a knowledge graph in Neo4j to find how entities can effect to each other. 
                         Your goal is to analyze news posts popular among commodity traders and managers, categorize their content, and extract entities(types and value) for nodes in a knowledge graph.
 
@@ -80,19 +96,27 @@ def extract_entities(news_text: str, model: str = "gpt-4o-mini") -> str:
                         Output: Provide the extracted information in the specified JSON format as text. Don't write anything more.
                         """
 
+def extract_entities(news_text: str, model: str = "gpt-4o-mini") -> str:
+    
+    client = OpenAI(api_key=get_api_key())
+    
+    system_prompt = SYSTEM_PROMPT
 
     user_prompt = "Input News Text: " + news_text
 
     try:
-        completion = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        )
+        with span("api_call", model=model, chars=len(news_text)):
+            increment("api_calls", model=model)
+            completion = client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ]
+            )
         return completion.choices[0].message.content
     except Exception as e:
+        increment("api_errors", model=model)
         logger.error(f"API call failed for text: {news_text[:100]}... Error: {str(e)}")
         return None
 
@@ -101,77 +125,144 @@ async def extract_entities_async(news_text: str, model: str = "gpt-4o-mini", cli
     Async version of extract_entities for better performance
     """
     if client is None:
-        client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+        client = AsyncOpenAI(api_key=get_api_key())
     
-    system_prompt = f"""
-                        You are an expert commodity trader tasked with extracting entities from news articles to create a knowledge graph in Neo4j to find how entities can effect to each other. 
-                        Your goal is to analyze news posts popular among commodity traders and managers, categorize their content, and extract entities(types and value) for nodes in a knowledge graph.
-
-                        Task:
-                        Analyze the provided news text to extract and categorize the following:
-
-                            Type of Content: Categorize the news based on its focus:
-                                Macro: Global economic trends, monetary policies, GDP, inflation, or geopolitical events (e.g., "Federal Reserve raises interest rates").
-                                Industry: Updates specific to an industry, like energy or agriculture (e.g., "New regulations in the steel sector").
-                                Commodity: Information about individual commodities, such as price, supply, or demand (e.g., "Gold prices hit $2,000/ounce").
-                                News: Breaking news or short-term events (e.g., "steel demand increase in turkey").
-                            Entities: Act as a NER(Name Entity Recognition) System and return a dictionary with entity types as keys and lists of unique entity names as values. you must think about entities that can effect to each other or any commodity price.
-                                Assign unique names to each entity by (don't mention duplicates). If no entities are found, return an empty dictionary {{}}.
-                            Hashtags: A list of hashtags (#) explicitly mentioned in the text. Return an empty list [] if none are present.
-                            Subject: A four-word description of the news's primary focus, prioritizing commodity-related themes (e.g., "steel Prices", "iron ore Supply").
+    system_prompt = SYSTEM_PROMPT
 
-                        Instructions:
-                            if a value entity type is empty don't mention it in output. Also don't write "other" in entities(just mention it.)
-                            Extract only information explicitly stated in the text. Do not infer or assume values and Don't just rely on the entitiy's type above or examples, think for yourself.
-                            Focus on the provided text. Analyze media or links only if they contain relevant text for entity extraction.
-                            Entities will be used as nodes in a Neo4j knowledge graph (Commodity, Price, Port, Country, ...), so ensure unique and consistent naming.
-                            Use standardized terminology (e.g., "Iron Ore" instead of "ore").
-                            your language must always be English.
-                            Output a valid JSON object in English, following this schema:
+    user_prompt = "Input News Text: " + news_text
 
-                                {{
-                                "type_of_content": "macro|industry|commodity|news",
-                                "entities": {{"entity_type": ["entity_name_1", "entity_name_2", ...], ...}},
-                                "hashtags": ["hashtag1", "hashtag2", ...],
-                                "subject": "four-word subject"
-                                }}
-       
-                        Restrictions:
-                            If a value entity type is empty don't mention it in output. Also don't write "other" in entities(just mention it.)
-                            Don't miss value of non-empty etities. mention all values of related entity that exist in news.
-                            Your language must always be English.
-                            Read again the text and find more entitity types if exist (Don't just rely on the entities mentioned above as example, think for yourself.)
+    try:
+        with span("api_call", model=model, chars=len(news_text)):
+            increment("api_calls", model=model)
+            completion = await client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": user_prompt}
+            ]
+            )
+        return completion.choices[0].message.content
+    except Exception as e:
+        increment("api_errors", model=model)
+        logger.error(f"Async API call failed for text: {news_text[:100]}... Error: {str(e)}")
+        return None
 
-                        Input News Text: [Insert the news article or text snippet here]
+def max_output_tokens(news_text: str) -> int:
+    """
+    Ceiling on the answer's length: grows with the message (longer posts mention more
+    entities) but stops runaway generations from running for minutes
+    """
+    return min(OUTPUT_TOKENS_CEILING, OUTPUT_TOKENS_BASE + int(len(news_text) / CHARS_PER_TOKEN * OUTPUT_TOKENS_PER_INPUT_TOKEN))
 
-                        Output: Provide the extracted information in the specified JSON format as text. Don't write anything more.
-                        """
+async def extract_entities_stream_async(news_text: str, model: str = "gpt-4o-mini", client: AsyncOpenAI = None,
+                                        on_first_chunk: Callable[[], None] = None) -> Optional[str]:
+    """
+    Streamed version of extract_entities_async: the request is closed as soon as a
+    complete JSON object has arrived. Returns None if the answer ended (or hit the
+    max_tokens ceiling) without one, so the row is retried later. on_first_chunk is
+    called when the first chunk of the answer arrives
+    """
+    if client is None:
+        client = AsyncOpenAI(api_key=get_api_key())
 
     user_prompt = "Input News Text: " + news_text
+    scanner = JsonStreamScanner()
 
     try:
-        completion = await client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-        )
-        return completion.choices[0].message.content
+        with span("api_call", model=model, chars=len(news_text), stream=True):
+            increment("api_calls", model=model)
+            stream = await client.chat.completions.create(
+                model=model,
+                messages=[
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": user_prompt}
+                ],
+                max_tokens=max_output_tokens(news_text),
+                stream=True
+            )
+            try:
+                async for chunk in stream:
+                    if on_first_chunk is not None:
+                        on_first_chunk()
+                        on_first_chunk = None
+                    if chunk.choices and chunk.choices[0].delta.content and scanner.feed(chunk.choices[0].delta.content):
+                        break
+            finally:
+                await stream.close()
+        if scanner.result is None:
+            increment("incomplete_responses", model=model)
+            logger.warning(f"No complete JSON object in the response for text: {news_text[:100]}...")
+        return scanner.result
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
-        logger.error(f"Async API call failed for text: {news_text[:100]}... Error: {str(e)}")
+        increment("api_errors", model=model)
+        logger.error(f"Streamed API call failed for text: {news_text[:100]}... Error: {str(e)}")
         return None
 
+# Times to first chunk of recent streamed calls, shared by all batches of the process
+latency_tracker = LatencyTracker()
+
+async def extract_entities_hedged_async(news_text: str, model: str = "gpt-4o-mini", client: AsyncOpenAI = None,
+                                        tracker: LatencyTracker = None) -> Optional[str]:
+    """
+    Streamed extraction with hedging: if the first chunk of the answer hasn't arrived after
+    the observed p95 time to first chunk (a stalled replica), a duplicate request is sent
+    (within the HEDGE_MAX_FRACTION budget) and whichever finishes first with a result wins;
+    the other one is cancelled. A call that is already streaming isn't hedged: the duplicate
+    would have to generate the whole answer again, so long answers only got slower
+    """
+    tracker = tracker or latency_tracker
+    start = time.perf_counter()
+    started = asyncio.Event()
+
+    def first_chunk():
+        started.set()
+        tracker.record(time.perf_counter() - start)
+
+    tasks = [asyncio.ensure_future(extract_entities_stream_async(news_text, model, client, first_chunk))]
+    delay = tracker.hedge_delay()
+    if delay is not None:
+        waiter = asyncio.ensure_future(started.wait())
+        done, _ = await asyncio.wait([tasks[0], waiter], timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        if not done and tracker.try_hedge():
+            increment("hedged_requests", model=model)
+            tasks.append(asyncio.ensure_future(extract_entities_stream_async(news_text, model, client)))
+
+    result = None
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            result = await next_done
+            if result is not None:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+        # Let the cancelled calls close their streams
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if len(tasks) > 1 and not started.is_set():
+            # The stalled call was cut short; its wait so far keeps the percentile honest
+            tracker.record(time.perf_counter() - start)
+    return result
+
 def extract_entities_batch(news_texts: list, model: str = "gpt-4o-mini", max_workers: int = 3) -> list:
     """
-    Process multiple news texts in parallel using ThreadPoolExecutor
+    Process multiple news texts in parallel using ThreadPoolExecutor.
+    With ROUTING_ENABLED each text goes to the model tier router.py picks instead of model
     """
     results = [None] * len(news_texts)
+    if ROUTING_ENABLED:
+        from router import default_router
+        extract = lambda text, _: default_router().extract(text)
+    else:
+        extract = extract_entities
     
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         # Submit all tasks
         future_to_index = {
-            executor.submit(extract_entities, text, model): i 
+            executor.submit(extract, text, model): i 
             for i, text in enumerate(news_texts) 
             if text is not None and len(text) > 100
         }
@@ -190,10 +281,11 @@ def extract_entities_batch(news_texts: list, model: str = "gpt-4o-mini", max_wor
 
 async def extract_entities_batch_async(news_texts: List[str], model: str = "gpt-4o-mini", max_concurrent: int = 5) -> List[Optional[str]]:
     """
-    Process multiple news texts asynchronously with rate limiting
+    Process multiple news texts asynchronously with rate limiting.
+    With ROUTING_ENABLED each text goes to the model tier router.py picks instead of model
     """
     results = [None] * len(news_texts)
-    client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    client = AsyncOpenAI(api_key=get_api_key())
     
     # Create semaphore to limit concurrent requests
     semaphore = asyncio.Semaphore(max_concurrent)
@@ -201,7 +293,13 @@ async def extract_entities_batch_async(news_texts: List[str], model: str = "gpt-
     async def process_single_text(index: int, text: str) -> Tuple[int, Optional[str]]:
         async with semaphore:
             if text is not None and len(text) > 100:
-                result = await extract_entities_async(text, model, client)
+                if ROUTING_ENABLED:
+                    from router import default_router
+                    result = await default_router().extract_async(text, client=client)
+                elif STREAM_RESPONSES:
+                    result = await extract_entities_hedged_async(text, model, client)
+                else:
+                    result = await extract_entities_async(text, model, client)
                 return index, result
             return index, None
     
@@ -222,9 +320,13 @@ async def extract_entities_batch_async(news_texts: List[str], model: str = "gpt-
     return results
 
 def read_csv(file_path: str) -> pd.DataFrame:
-    df = pd.read_csv(file_path)
+    with span("read_csv", file=file_path):
+        df = pd.read_csv(file_path)
+    increment("bytes", os.path.getsize(file_path), stage="read_csv")
     if "text" not in df.columns:
         raise ValueError("CSV must contain a 'text' column")
+    # An all-empty 'json' column is read as float; results are strings
+    df["json"] = df["json"].astype(object) if "json" in df.columns else None
     return df
 
 def insert_value_in_cell(df: pd.DataFrame, column_name: str, row: int, value: str) -> pd.DataFrame:
@@ -236,27 +338,28 @@ def insert_value_in_cell(df: pd.DataFrame, column_name: str, row: int, value: st
     return df
 
 def save_dataframe_to_csv(df, csv_path, encoding='utf-8-sig'):
-    df.to_csv(csv_path, index=False, encoding=encoding)
+    with span("save_dataframe_to_csv", file=csv_path, rows=len(df)):
+        df.to_csv(csv_path, index=False, encoding=encoding)
+    increment("bytes", os.path.getsize(csv_path), stage="save_dataframe_to_csv")
 
-def process_optimized(csv_file, batch_size=10, save_interval=5, max_workers=3):
+def process_optimized(csv_file, batch_size=10, save_interval=5, max_workers=3, budget=None):
     """
-    Optimized processing function with batching and parallel processing
+    Optimized processing function with batching and parallel processing.
+    An optional scheduler.Budget limits the estimated tokens, cost and time spent.
     """
     try:
         df = read_csv(csv_file)
-        news = df["text"].tolist()
-        jsons = df["json"].tolist()
         
-        # Find rows that need processing
-        rows_to_process = []
-        for i in range(len(news)-1, -1, -1):
-            if not pd.isna(news[i]) and len(news[i]) > 100 and pd.isna(jsons[i]):
-                rows_to_process.append((i, news[i]))
+        # Find rows that need processing, highest priority first (see scheduler.py)
+        rows_to_process = pending_rows(df, budget)
         
         logger.info(f"Found {len(rows_to_process)} rows to process")
         
         # Process in batches
         for batch_start in tqdm(range(0, len(rows_to_process), batch_size), desc="Processing batches"):
+            if budget is not None and budget.expired():
+                logger.info("Time budget used up, stopping")
+                break
             batch_end = min(batch_start + batch_size, len(rows_to_process))
             batch = rows_to_process[batch_start:batch_end]
             
@@ -291,25 +394,24 @@ def process_optimized(csv_file, batch_size=10, save_interval=5, max_workers=3):
         logger.error(f"Error in process_optimized: {str(e)}")
         raise
 
-async def process_async_optimized(csv_file, batch_size=10, save_interval=5, max_concurrent=5):
+async def process_async_optimized(csv_file, batch_size=10, save_interval=5, max_concurrent=5, budget=None):
     """
-    Async optimized processing function with better rate limiting
+    Async optimized processing function with better rate limiting.
+    An optional scheduler.Budget limits the estimated tokens, cost and time spent.
     """
     try:
         df = read_csv(csv_file)
-        news = df["text"].tolist()
-        jsons = df["json"].tolist()
         
-        # Find rows that need processing
-        rows_to_process = []
-        for i in range(len(news)-1, -1, -1):
-            if not pd.isna(news[i]) and len(news[i]) > 100 and pd.isna(jsons[i]):
-                rows_to_process.append((i, news[i]))
+        # Find rows that need processing, highest priority first (see scheduler.py)
+        rows_to_process = pending_rows(df, budget)
         
         logger.info(f"Found {len(rows_to_process)} rows to process")
         
         # Process in batches
         for batch_start in tqdm(range(0, len(rows_to_process), batch_size), desc="Processing batches (async)"):
+            if budget is not None and budget.expired():
+                logger.info("Time budget used up, stopping")
+                break
             batch_end = min(batch_start + batch_size, len(rows_to_process))
             batch = rows_to_process[batch_start:batch_end]
             
@@ -361,17 +463,58 @@ def process(csv_file):
     except Exception as e:
         print("Error:", str(e))
 
-if __name__ == "__main__":
-    csv_file = "telegram_messages.csv"
-    
+def process_partitions(partition_files, parallel_partitions=1, budget=None):
+    """
+    Process partitioned storage (see read_sources.ingest_channels) partition by partition.
+    Each partition file is read and saved on its own, newest months first, and up to
+    parallel_partitions partitions are processed at the same time sharing the configured concurrency.
+    A budget is shared by all partitions.
+    """
+    if budget is None:
+        budget = Budget(EXTRACT_MAX_TOKENS, EXTRACT_MAX_COST, EXTRACT_MAX_SECONDS)
+    # Partition paths end in .../month=YYYY-MM/messages.csv
+    partition_files = sorted(partition_files, key=lambda p: os.path.basename(os.path.dirname(p)), reverse=True)
+    logger.info(f"Processing {len(partition_files)} partitions, {parallel_partitions} at a time")
+
+    if PROCESSING_METHOD.lower() == "queue":
+        from work_queue import process_with_queue
+        process_with_queue(partition_files, processes=QUEUE_PROCESSES, budget=budget)
+    elif PROCESSING_METHOD.lower() == "async":
+        per_partition = max(1, MAX_CONCURRENT // parallel_partitions)
+
+        async def run_all():
+            semaphore = asyncio.Semaphore(parallel_partitions)
+
+            async def run_one(path):
+                async with semaphore:
+                    await process_async_optimized(path, BATCH_SIZE, SAVE_INTERVAL, per_partition, budget)
+
+            await asyncio.gather(*(run_one(path) for path in partition_files))
+
+        asyncio.run(run_all())
+    else:
+        per_partition = max(1, MAX_WORKERS // parallel_partitions)
+        with ThreadPoolExecutor(max_workers=parallel_partitions) as executor:
+            list(executor.map(lambda path: process_optimized(path, BATCH_SIZE, SAVE_INTERVAL, per_partition, budget),
+                              partition_files))
+
+def main(csv_file="telegram_messages.csv", budget=None):
+    if budget is None:
+        budget = Budget(EXTRACT_MAX_TOKENS, EXTRACT_MAX_COST, EXTRACT_MAX_SECONDS)
     # Choose your preferred method based on configuration
-    if PROCESSING_METHOD.lower() == "async":
+    if PROCESSING_METHOD.lower() == "queue":
+        # Shared lease-based queue, safe to run next to other workers (see work_queue.py)
+        logger.info("Using the work queue")
+        from work_queue import process_with_queue
+        process_with_queue([csv_file], processes=QUEUE_PROCESSES, budget=budget)
+    elif PROCESSING_METHOD.lower() == "async":
         logger.info("Using async optimization method")
         asyncio.run(process_async_optimized(
             csv_file=csv_file, 
             batch_size=BATCH_SIZE, 
             save_interval=SAVE_INTERVAL, 
-            max_concurrent=MAX_CONCURRENT
+            max_concurrent=MAX_CONCURRENT,
+            budget=budget
         ))
     else:
         logger.info("Using thread-based optimization method")
@@ -379,5 +522,27 @@ if __name__ == "__main__":
             csv_file=csv_file, 
             batch_size=BATCH_SIZE, 
             save_interval=SAVE_INTERVAL, 
-            max_workers=MAX_WORKERS
+            max_workers=MAX_WORKERS,
+            budget=budget
         )
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Extract entities from the messages CSV with the LLM")
+    parser.add_argument("--csv", default="telegram_messages.csv", help="Messages CSV")
+    parser.add_argument("--partitions", help="Process all partitions under this root instead of --csv")
+    parser.add_argument("--parallel-partitions", type=int, default=1, help="Partitions processed at the same time")
+    parser.add_argument("--max-tokens", type=int, default=EXTRACT_MAX_TOKENS,
+                        help="Estimated tokens to spend at most, highest priority messages first")
+    parser.add_argument("--max-cost", type=float, default=EXTRACT_MAX_COST, help="Estimated USD to spend at most")
+    parser.add_argument("--max-seconds", type=float, default=EXTRACT_MAX_SECONDS,
+                        help="Stop starting new batches after this many seconds")
+    args = parser.parse_args()
+
+    setup_logging()
+    budget = Budget(args.max_tokens, args.max_cost, args.max_seconds)
+    if args.partitions:
+        from read_sources import list_partitions
+        process_partitions(list_partitions(args.partitions), args.parallel_partitions, budget)
+    else:
+        main(args.csv, budget)
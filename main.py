@@ -1,7 +1,327 @@
-def main():
-    
+"""
+Single entry point for the pipeline.
+
+    python main.py ingest     # read_sources.py: HTML exports -> CSV
+    python main.py extract    # llm.py: add the LLM 'json' column
+    python main.py resolve    # entity_resolution.py: merge entity name variants
+    python main.py analyse    # analyse.py (+ report.py with --charts)
+    python main.py all        # everything above, in order
+    python main.py status     # what would run, without running it
+    python main.py watch      # watcher.py: keep everything up to date as exports change
+
+With --partitions DIR every channel export found under --source is ingested
+into DIR/channel=<title>/month=<YYYY-MM>/messages.csv, and extract/analyse
+work on those partitions instead of a single CSV.
+
+The stages form a small DAG (ingest -> extract -> resolve -> analyse). A stage is skipped
+when the content hashes of its input artifacts match the ones recorded the last
+time it completed and its outputs still exist; --force runs it anyway. extract also
+counts the rows it left without a result (API errors, budget): while there are any it
+stays "incomplete" and runs again, so failed rows are retried. Stage
+modules (and with them pandas, openai, matplotlib, tqdm) are only imported
+when a stage actually runs, so --help and status return almost immediately.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+
+STATE_FILE = ".pipeline_state.json"
+HASH_CHUNK = 1 << 20
+
+
+class Stage:
+    def __init__(self, name, depends_on, inputs, outputs, run, description, pending=None):
+        self.name = name
+        self.depends_on = depends_on
+        self.inputs = inputs  # args -> list of paths (files or directories)
+        self.outputs = outputs  # args -> list of paths
+        self.run = run  # args -> None
+        self.description = description
+        self.pending = pending  # args -> number of items the run left undone, or None
+
+
+def data_path(args):
+    """The messages artifact: the partition root with --partitions, the single CSV otherwise."""
+    return args.partitions or args.csv
+
+
+def run_ingest(args):
+    import read_sources
+    if args.partitions:
+        read_sources.ingest_channels(args.source, args.partitions)
+    else:
+        read_sources.main(source_folder=args.source, output_path=args.csv)
+
+
+def run_extract(args):
+    import llm
+    llm.setup_logging()
+    if args.partitions:
+        from read_sources import list_partitions
+        llm.process_partitions(list_partitions(args.partitions))
+    else:
+        llm.main(csv_file=args.csv)
+
+
+def pending_extraction(args):
+    """Rows without an LLM result that extract would pick up (same rule as scheduler.pending_rows)."""
+    import pandas as pd
+
+    if args.partitions:
+        from read_sources import list_partitions
+        csv_files = list_partitions(args.partitions)
+    else:
+        csv_files = [args.csv]
+    pending = 0
+    for csv_file in csv_files:
+        df = pd.read_csv(csv_file, usecols=lambda c: c in ("text", "json"))
+        jsons = df["json"] if "json" in df.columns else [None] * len(df)
+        pending += sum(isinstance(text, str) and len(text) > 100 and not isinstance(value, str)
+                       for text, value in zip(df["text"], jsons))
+    return pending
+
+
+def entity_map_path():
+    try:
+        from config import ENTITY_MAP_PATH
+    except ImportError:
+        ENTITY_MAP_PATH = "entity_map.sqlite"
+    return ENTITY_MAP_PATH
+
+
+def run_resolve(args):
+    import logging
+    import entity_resolution
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    if args.partitions:
+        from read_sources import list_partitions
+        csv_files = list_partitions(args.partitions)
+    else:
+        csv_files = [args.csv]
+    # The stage always reads every message, so mention counts are recounted rather than added
+    entity_resolution.resolve_files(csv_files, entity_map_path(), recount=True)
+
+
+def analyse_inputs(args):
+    """The messages plus the entity map, when there is one: analyse groups entities by its clusters."""
+    entity_map = entity_map_path()
+    return [data_path(args)] + ([entity_map] if os.path.exists(entity_map) else [])
+
+
+def run_analyse(args):
+    import contextlib
+    import io
+    import analyse
+
+    buffer = io.StringIO()
+    entity_map = entity_map_path()
+    with contextlib.redirect_stdout(buffer):
+        analyse.main(csv_file=args.csv, partitions_root=args.partitions,
+                     entity_map=entity_map if os.path.exists(entity_map) else None)
+    os.makedirs(os.path.dirname(args.report) or ".", exist_ok=True)
+    with open(args.report, "w", encoding="utf-8") as f:
+        f.write(buffer.getvalue())
+    print(buffer.getvalue(), end="")
+
+    if args.charts:
+        import logging
+        import pandas as pd
+        import report
+
+        logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+        if args.partitions:
+            from read_sources import list_partitions
+            df = pd.concat([pd.read_csv(path) for path in list_partitions(args.partitions)], ignore_index=True)
+        else:
+            df = pd.read_csv(args.csv)
+        report.render_charts(report.build_chart_specs(df))
+
+
+STAGES = {
+    "ingest": Stage("ingest", [], lambda a: [a.source], lambda a: [data_path(a)], run_ingest,
+                    "Parse the exported HTML files into the messages CSV"),
+    "extract": Stage("extract", ["ingest"], lambda a: [data_path(a)], lambda a: [data_path(a)], run_extract,
+                     "Extract content type, entities, hashtags and subject with the LLM", pending_extraction),
+    "resolve": Stage("resolve", ["extract"], lambda a: [data_path(a)], lambda a: [entity_map_path()], run_resolve,
+                     "Cluster entity name variants into canonical entities"),
+    "analyse": Stage("analyse", ["resolve"], analyse_inputs, lambda a: [a.report], run_analyse,
+                     "Print statistics (and render charts with --charts)"),
+}
+
+
+def topological_order(names):
+    """Returns the given stages and everything they depend on, dependencies first."""
+    order = []
+
+    def visit(name):
+        if name in order:
+            return
+        for dependency in STAGES[name].depends_on:
+            visit(dependency)
+        order.append(name)
+
+    for name in names:
+        visit(name)
+    return order
+
+
+def load_state(path=STATE_FILE):
+    if not os.path.exists(path):
+        return {"stages": {}, "hash_cache": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(state, path=STATE_FILE):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def file_hash(path, cache):
+    """
+    SHA-256 of a file's content. Hashes are cached by (size, mtime), so unchanged
+    files are never read again.
+    """
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    signature = [stat.st_size, stat.st_mtime_ns]
+    cached = cache.get(key)
+    if cached and cached[0] == signature:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    cache[key] = [signature, digest.hexdigest()]
+    return digest.hexdigest()
+
+
+def artifact_hash(path, cache):
+    """Hash of a file, or of every file under a directory; None if it doesn't exist."""
+    if os.path.isfile(path):
+        return file_hash(path, cache)
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            file_path = os.path.join(root, name)
+            digest.update(os.path.relpath(file_path, path).encode("utf-8"))
+            digest.update(file_hash(file_path, cache).encode("ascii"))
+    return digest.hexdigest()
+
+
+def stage_status(stage, args, state):
+    """
+    Returns (status, input hashes) where status is "up to date", "incomplete" (inputs
+    unchanged, but the last run left rows pending), "stale" or "missing input".
+    """
+    cache = state.setdefault("hash_cache", {})
+    hashes = {path: artifact_hash(path, cache) for path in stage.inputs(args)}
+    if any(h is None for h in hashes.values()):
+        return "missing input", hashes
+    recorded = state["stages"].get(stage.name, {})
+    outputs_exist = all(os.path.exists(path) for path in stage.outputs(args))
+    if recorded.get("inputs") == hashes and outputs_exist:
+        return ("incomplete" if recorded.get("pending") else "up to date"), hashes
+    return "stale", hashes
+
+
+def run_stages(names, args):
+    state = load_state()
+    for name in topological_order(names) if args.with_deps else names:
+        stage = STAGES[name]
+        status, _ = stage_status(stage, args, state)
+        if status == "missing input":
+            print(f"[{name}] missing input: {', '.join(stage.inputs(args))}")
+            return 1
+        if status == "up to date" and not args.force:
+            print(f"[{name}] inputs unchanged, skipping")
+            if name == "analyse":
+                with open(args.report, encoding="utf-8") as f:
+                    print(f.read(), end="")
+            continue
+
+        print(f"[{name}] running: {stage.description}")
+        start = time.time()
+        stage.run(args)
+        # Record the inputs as they are now; for extract that is the CSV it just wrote
+        cache = state.setdefault("hash_cache", {})
+        state["stages"][name] = {
+            "inputs": {path: artifact_hash(path, cache) for path in stage.inputs(args)},
+            "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "duration": round(time.time() - start, 2),
+        }
+        pending = stage.pending(args) if stage.pending else 0
+        if pending:
+            state["stages"][name]["pending"] = pending
+        save_state(state)
+        print(f"[{name}] done in {time.time() - start:.1f}s")
+        if pending:
+            print(f"[{name}] {pending} rows still pending (API errors or budget); they are retried on the next run")
     return 0
 
 
+def show_status(args):
+    state = load_state()
+    for name in topological_order(list(STAGES)):
+        status, _ = stage_status(STAGES[name], args, state)
+        recorded = state["stages"].get(name, {})
+        last = f"last run {recorded['finished']} ({recorded['duration']}s)" if recorded else "never run"
+        if status == "incomplete":
+            last += f", {recorded['pending']} rows pending"
+        print(f"{name:<8} {status:<14} {last}")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Commodity Telegram channel analysis pipeline")
+    parser.add_argument("--source", default="source", help="Folder with the exported HTML files")
+    parser.add_argument("--csv", default="telegram_messages.csv", help="Messages CSV")
+    parser.add_argument("--partitions", help="Use channel/month partitioned storage under this folder; "
+                                             "--source is then searched for any number of channel exports")
+    parser.add_argument("--report", default=os.path.join("reports", "analysis.txt"),
+                        help="Where the analyse stage writes its text report")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for name, stage in STAGES.items():
+        sub = subparsers.add_parser(name, help=stage.description)
+        sub.add_argument("--force", action="store_true", help="Run even if the inputs are unchanged")
+        sub.add_argument("--with-deps", action="store_true", help="Also run the stages this one depends on")
+        if name == "analyse":
+            sub.add_argument("--charts", action="store_true", help="Also render charts with report.py")
+    sub = subparsers.add_parser("all", help="Run ingest, extract, resolve and analyse")
+    sub.add_argument("--force", action="store_true", help="Run every stage even if the inputs are unchanged")
+    sub.add_argument("--charts", action="store_true", help="Also render charts with report.py")
+    subparsers.add_parser("status", help="Show which stages are up to date")
+    sub = subparsers.add_parser("watch", help="Run the watch-mode daemon on --source (uses --partitions)")
+    sub.add_argument("--workers", type=int, help="Extraction worker processes (default from config.py)")
+    sub.add_argument("--poll", action="store_true", help="Poll instead of using inotify")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == "status":
+        return show_status(args)
+    if args.command == "watch":
+        import watcher
+        argv = ["--source", args.source, "--report", args.report]
+        argv += ["--partitions", args.partitions] if args.partitions else []
+        argv += ["--workers", str(args.workers)] if args.workers is not None else []
+        return watcher.main(argv + (["--poll"] if args.poll else []))
+    if args.command == "all":
+        args.with_deps = True
+        return run_stages(list(STAGES), args)
+    return run_stages([args.command], args)
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
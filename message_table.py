@@ -0,0 +1,372 @@
+"""
+Compact in-memory message table for ingest.
+
+read_sources.py used to collect the whole channel history as a list of dicts:
+a dict per message plus a separate string object for every field, including
+the channel name, the author and the emoji keys that repeat on every row
+(about 1.2 KB per message). MessageTable keeps the same rows column by column:
+
+  - channel, filename, from, date and the reaction emojis are pooled
+    (StringPool): every distinct value is stored once, interned, and rows keep
+    4-byte codes, like a categorical;
+  - id, time, text and attachment are packed as UTF-8 into one buffer per
+    column (PackedStrings) with 8-byte end offsets, instead of one str object
+    each. Full 64 KB blocks of the buffer are zlib-compressed, like the pages
+    of a Parquet column; rows are read back block by block, so writing them
+    out in order decompresses every block once;
+  - reactions are emoji codes and counts in flat arrays with per-row offsets.
+
+Rows are only turned back into dicts when they are read (indexing, iteration),
+and write_csv streams them straight into a CSV in the format pandas' to_csv
+wrote before, so the files don't change. to_dataframe gives a DataFrame with
+the pooled columns as categoricals.
+
+    python message_table.py bench --source source
+
+bench measures the peak RSS of ingest in a fresh process, with the previous
+list-of-dicts code next to the compact one. Extraction (llm.py) still reads the
+CSV into a plain DataFrame.
+"""
+
+import argparse
+import csv
+import os
+import sys
+import zlib
+from array import array
+from bisect import bisect_right
+
+COLUMNS = ['filename', 'id', 'date', 'time', "from", 'text', 'reactions', 'attachment']
+POOLED_COLUMNS = ('channel', 'filename', 'date', 'from')
+PACKED_COLUMNS = ('id', 'time', 'text', 'attachment')
+BLOCK_BYTES = 1 << 16  # Uncompressed size at which a block of a packed column is compressed
+
+
+class StringPool:
+    """
+    Distinct strings of a column, each stored once. Code 0 is None.
+    """
+
+    __slots__ = ('values', 'codes')
+
+    def __init__(self):
+        self.values = [None]
+        self.codes = {None: 0}
+
+    def code(self, value):
+        code = self.codes.get(value)
+        if code is None:
+            value = sys.intern(value)
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def __len__(self):
+        return len(self.values) - 1
+
+
+class PackedStrings:
+    """
+    A column of optional strings packed as UTF-8 into compressed blocks.
+
+    Parameters:
+        block_bytes (int): Uncompressed size at which the open block is compressed
+            (None keeps everything uncompressed).
+    """
+
+    __slots__ = ('data', 'ends', 'present', 'blocks', 'block_ends', 'block_bytes', '_cache')
+
+    def __init__(self, block_bytes=BLOCK_BYTES):
+        self.data = bytearray()  # the open block
+        self.ends = array('Q')  # end of every value in the uncompressed column
+        self.present = bytearray()
+        self.blocks = []  # compressed full blocks
+        self.block_ends = array('Q')  # end of every compressed block in the uncompressed column
+        self.block_bytes = block_bytes
+        self._cache = (None, None)  # (block number, decompressed block)
+
+    def _closed_bytes(self):
+        return self.block_ends[-1] if self.block_ends else 0
+
+    def append(self, value):
+        if value is not None:
+            self.data += value.encode('utf-8')
+        self.ends.append(self._closed_bytes() + len(self.data))
+        self.present.append(value is not None)
+        # Blocks end on value boundaries, so every value lies in a single block
+        if self.block_bytes and len(self.data) >= self.block_bytes:
+            self.blocks.append(zlib.compress(self.data, 1))
+            self.block_ends.append(self.ends[-1])
+            self.data = bytearray()
+
+    def __getitem__(self, row):
+        if not self.present[row]:
+            return None
+        start = self.ends[row - 1] if row else 0
+        end = self.ends[row]
+        block = bisect_right(self.block_ends, start)
+        if block == len(self.blocks):
+            base, data = self._closed_bytes(), self.data
+        else:
+            base = self.block_ends[block - 1] if block else 0
+            cached, data = self._cache
+            if cached != block:
+                data = zlib.decompress(self.blocks[block])
+                self._cache = (block, data)
+        return data[start - base:end - base].decode('utf-8')
+
+    def __len__(self):
+        return len(self.ends)
+
+    def nbytes(self):
+        return (len(self.data) + sum(len(block) for block in self.blocks)
+                + self.ends.itemsize * len(self.ends) + len(self.present))
+
+
+class MessageTable:
+    """
+    Column-oriented table of parsed messages (the dicts of read_sources.parse_html_file,
+    optionally with a 'channel').
+
+    Parameters:
+        messages (iterable): Message dictionaries (or another MessageTable) to start with.
+    """
+
+    __slots__ = ('_pools', '_codes', '_packed', '_emojis', '_reaction_ends', '_reaction_emojis',
+                 '_reaction_counts')
+
+    def __init__(self, messages=None):
+        self._pools = {column: StringPool() for column in POOLED_COLUMNS}
+        self._codes = {column: array('I') for column in POOLED_COLUMNS}
+        self._packed = {column: PackedStrings() for column in PACKED_COLUMNS}
+        self._emojis = StringPool()
+        self._reaction_ends = array('Q')
+        self._reaction_emojis = array('I')
+        self._reaction_counts = array('Q')
+        if messages is not None:
+            self.extend(messages)
+
+    def append(self, message, channel=None):
+        """
+        Adds one message dictionary; channel, if given, overrides the message's 'channel'.
+        """
+        for column in POOLED_COLUMNS:
+            value = channel if column == 'channel' and channel is not None else message.get(column)
+            self._codes[column].append(self._pools[column].code(value))
+        for column in PACKED_COLUMNS:
+            self._packed[column].append(message.get(column))
+        reactions = message.get('reactions')
+        if reactions:
+            for emoji, count in reactions.items():
+                self._reaction_emojis.append(self._emojis.code(emoji))
+                self._reaction_counts.append(count)
+        self._reaction_ends.append(len(self._reaction_emojis))
+
+    def extend(self, messages, channel=None):
+        for message in messages:
+            self.append(message, channel)
+
+    def __len__(self):
+        return len(self._reaction_ends)
+
+    def value(self, row, column):
+        """The value of one cell; reactions as a dictionary {emoji: count} or None."""
+        if column in self._codes:
+            return self._pools[column].values[self._codes[column][row]]
+        if column in self._packed:
+            return self._packed[column][row]
+        if column == 'reactions':
+            start = self._reaction_ends[row - 1] if row else 0
+            end = self._reaction_ends[row]
+            if start == end:
+                return None
+            emojis = self._emojis.values
+            return {emojis[self._reaction_emojis[i]]: self._reaction_counts[i] for i in range(start, end)}
+        raise KeyError(column)
+
+    def row(self, row, columns=None):
+        """One message as a dictionary (the parse_html_file keys, plus 'channel' if set)."""
+        if columns is None:
+            columns = COLUMNS if self._codes['channel'][row] == 0 else ['channel'] + COLUMNS
+        return {column: self.value(row, column) for column in columns}
+
+    def __getitem__(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(row)
+        return self.row(row)
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self.row(row)
+
+    def column(self, name, rows=None):
+        """Values of one column, for all rows or the given row numbers."""
+        return [self.value(row, name) for row in (range(len(self)) if rows is None else rows)]
+
+    def group_rows(self, column, key=None):
+        """
+        Row numbers grouped by the value of a pooled column (e.g. the month of 'date').
+        key is applied once per distinct value, not once per row.
+
+        Returns:
+            dict: Dictionary {key(value): array of row numbers}, in order of first appearance.
+        """
+        pool = self._pools[column]
+        keys = [key(value) if key else value for value in pool.values]
+        groups = {}
+        for row, code in enumerate(self._codes[column]):
+            rows = groups.get(keys[code])
+            if rows is None:
+                rows = groups[keys[code]] = array('Q')
+            rows.append(row)
+        return groups
+
+    def write_csv(self, path, columns=COLUMNS, rows=None, extra=None, encoding='utf-8-sig'):
+        """
+        Streams rows to a CSV file in the format DataFrame.to_csv(index=False) writes.
+
+        Parameters:
+            path (str): Output file.
+            columns (list): Table columns, in order.
+            rows (iterable): Row numbers to write (default: all).
+            extra (dict): Dictionary {column: {message id: value}} of columns appended after
+                columns, e.g. LLM results carried over from a previous file.
+            encoding (str): File encoding.
+        """
+        extra = extra or {}
+        with open(path, 'w', encoding=encoding, newline='') as f:
+            writer = csv.writer(f, lineterminator=os.linesep)
+            writer.writerow(list(columns) + list(extra))
+            for row in (range(len(self)) if rows is None else rows):
+                values = [self.value(row, column) for column in columns]
+                if extra:
+                    message_id = self.value(row, 'id')
+                    values.extend(mapping.get(message_id) for mapping in extra.values())
+                writer.writerow(values)
+
+    def to_dataframe(self, columns=COLUMNS):
+        """The table as a DataFrame, with the pooled columns as categoricals."""
+        import pandas as pd
+
+        data = {}
+        for column in columns:
+            if column in self._codes:
+                pool = self._pools[column]
+                codes = [code - 1 for code in self._codes[column]]
+                data[column] = pd.Categorical.from_codes(codes, categories=pool.values[1:])
+            else:
+                data[column] = self.column(column)
+        return pd.DataFrame(data, columns=list(columns))
+
+    def nbytes(self):
+        """Approximate memory held by the table, in bytes."""
+        total = sum(codes.itemsize * len(codes) for codes in self._codes.values())
+        total += sum(sys.getsizeof(value) for pool in self._pools.values() for value in pool.values[1:])
+        total += sum(packed.nbytes() for packed in self._packed.values())
+        for values in (self._reaction_ends, self._reaction_emojis, self._reaction_counts):
+            total += values.itemsize * len(values)
+        return total
+
+
+def _peak_rss_mb():
+    from metrics import peak_rss_bytes
+    return (peak_rss_bytes() or 0) / 1e6
+
+
+def _measure_child(task, source, work_dir, queue):
+    """Runs one variant in a fresh process and reports (baseline MB, peak MB, messages)."""
+    import pandas as pd
+    import read_sources
+    from metrics import configure
+
+    configure(enabled=False)
+    baseline = _peak_rss_mb()
+    output = os.path.join(work_dir, f"{task}.csv")
+    if task == "ingest_dicts":
+        # The previous ingest: whole-page trees, every message as a dict, then one object DataFrame
+        read_sources.INGEST_MESSAGES_PER_CHUNK = 0
+        messages = []
+        for filename in read_sources.list_export_files(source):
+            messages.extend(read_sources.parse_html_file(os.path.join(source, filename), filename))
+        df = pd.DataFrame(messages)[COLUMNS]
+        df = read_sources.merge_previous_results(df, output)
+        df.to_csv(output, index=False, encoding='utf-8-sig')
+        count = len(df)
+    else:
+        read_sources.main(source, output)
+        count = sum(1 for _ in open(output, encoding='utf-8-sig')) - 1
+    queue.put((baseline, _peak_rss_mb(), count))
+
+
+def bench(source, work_dir=None):
+    """
+    Peak RSS of ingest, old and compact, each in a fresh process.
+
+    Returns:
+        dict: Dictionary {variant: {"baseline_mb", "peak_mb", "growth_mb", "messages"}}; baseline
+            is the peak after imports, growth what the data added on top of it.
+    """
+    import multiprocessing
+    import shutil
+    import tempfile
+
+    context = multiprocessing.get_context("spawn")
+    own_dir = work_dir is None
+    work_dir = work_dir or tempfile.mkdtemp(prefix="message_table_")
+    results = {}
+    try:
+        for task in ("ingest_dicts", "ingest_table"):
+            queue = context.Queue()
+            process = context.Process(target=_measure_child, args=(task, os.path.abspath(source), work_dir, queue))
+            process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(f"Benchmark {task} failed with exit code {process.exitcode}")
+            baseline, peak, count = queue.get()
+            results[task] = {"baseline_mb": baseline, "peak_mb": peak, "growth_mb": peak - baseline,
+                             "messages": count}
+    finally:
+        if own_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact message table memory benchmark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sub = subparsers.add_parser("bench", help="Peak RSS of ingest, old and compact")
+    sub.add_argument("--source", default="source", help="Export folder (e.g. the full channel history)")
+    sub.add_argument("--messages", type=int, default=None,
+                     help="Generate a synthetic export of this many messages instead of using --source")
+    args = parser.parse_args()
+
+    import shutil
+    import tempfile
+
+    source = args.source
+    temp_dir = None
+    if args.messages:
+        from synthetic_export import generate_export
+        temp_dir = tempfile.mkdtemp(prefix="message_table_export_")
+        source = os.path.join(temp_dir, "export")
+        generate_export(source, args.messages)
+    try:
+        results = bench(source)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    print("\nPeak RSS in MB (baseline = after imports)")
+    print(f"{'variant':<14}{'messages':>10}{'baseline':>10}{'peak':>10}{'growth':>10}")
+    for task, r in results.items():
+        print(f"{task:<14}{r['messages']:>10}{r['baseline_mb']:>10.1f}{r['peak_mb']:>10.1f}{r['growth_mb']:>10.1f}")
+    old, new = results["ingest_dicts"], results["ingest_table"]
+    print(f"peak RSS ingest_dicts / ingest_table: {old['peak_mb'] / new['peak_mb']:.1f}x")
+    if new["baseline_mb"] > 0:
+        print(f"(at most {old['peak_mb'] / new['baseline_mb']:.1f}x with no data held at all)")
+
+
+if __name__ == "__main__":
+    main()
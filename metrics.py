@@ -0,0 +1,334 @@
+"""
+Shared tracing and metrics for the pipeline stages.
+
+Usage:
+    from metrics import span, traced, increment
+
+    with span("parse_html_file", file=filename):
+        ...
+    increment("messages", len(messages))
+
+    @traced()
+    def analyze_hashtags(df): ...
+
+Every finished span is appended to a JSON-lines trace file (rotated once it
+grows past METRICS_TRACE_MAX_BYTES, keeping METRICS_TRACE_BACKUPS old files), and per-stage
+totals, counters and the peak RSS of the process are written as a Prometheus
+textfile (for node_exporter's textfile collector) when the process exits.
+Stages listed in PROFILE_STAGES (or the PIPELINE_PROFILE environment variable,
+comma-separated) are additionally run under cProfile, or pyinstrument when
+PROFILER = "pyinstrument" and it is installed.
+
+Only the standard library is imported, so instrumenting a module costs nothing
+at import time.
+"""
+
+import atexit
+import functools
+import inspect
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+try:
+    from config import (METRICS_ENABLED, METRICS_DIR, METRICS_TRACE_MAX_BYTES, METRICS_TRACE_BACKUPS,
+                        PROFILE_STAGES, PROFILER)
+except ImportError:
+    METRICS_ENABLED = True
+    METRICS_DIR = "metrics"
+    METRICS_TRACE_MAX_BYTES = 50 * 1024 * 1024
+    METRICS_TRACE_BACKUPS = 3
+    PROFILE_STAGES = []
+    PROFILER = "cprofile"
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_profile_lock = threading.Lock()
+_stage_stats = {}  # stage -> [count, total seconds, max seconds, errors]
+_counters = {}  # (name, sorted label items) -> value
+_settings = {
+    "enabled": METRICS_ENABLED,
+    "trace_file": os.path.join(METRICS_DIR, "trace.jsonl"),
+    "trace_max_bytes": METRICS_TRACE_MAX_BYTES,
+    "trace_backups": METRICS_TRACE_BACKUPS,
+    "prometheus_file": os.path.join(METRICS_DIR, "pipeline.prom"),
+    "profile_dir": METRICS_DIR,
+    "profile_stages": set(PROFILE_STAGES) | set(filter(None, os.getenv("PIPELINE_PROFILE", "").split(","))),
+}
+_trace_handle = None
+
+
+def configure(enabled=None, trace_file=None, prometheus_file=None, profile_stages=None, profile_dir=None):
+    """
+    Overrides the defaults from config.py. Pass only the settings to change.
+    """
+    global _trace_handle
+    with _lock:
+        if enabled is not None:
+            _settings["enabled"] = enabled
+        if trace_file is not None:
+            _settings["trace_file"] = trace_file
+            if _trace_handle is not None:
+                _trace_handle.close()
+                _trace_handle = None
+        if prometheus_file is not None:
+            _settings["prometheus_file"] = prometheus_file
+        if profile_stages is not None:
+            _settings["profile_stages"] = set(profile_stages)
+        if profile_dir is not None:
+            _settings["profile_dir"] = profile_dir
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, or None where it can't be measured."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def increment(name, value=1, **labels):
+    """Adds value to the counter name (e.g. "messages", "bytes", "api_calls", "api_errors")."""
+    if not _settings["enabled"]:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def _rotate_trace(path):
+    """Shifts trace.jsonl to trace.jsonl.1, .1 to .2 and so on, dropping the oldest."""
+    global _trace_handle
+    try:
+        # Another process writing the same trace may already have rotated it
+        ours = os.path.samestat(os.fstat(_trace_handle.fileno()), os.stat(path))
+    except OSError:
+        ours = False
+    _trace_handle.close()
+    _trace_handle = None
+    if not ours:
+        return
+    backups = _settings["trace_backups"]
+    if backups <= 0:
+        os.remove(path)
+        return
+    for i in range(backups - 1, 0, -1):
+        if os.path.exists(f"{path}.{i}"):
+            os.replace(f"{path}.{i}", f"{path}.{i + 1}")
+    os.replace(path, f"{path}.1")
+
+
+def _write_trace(event):
+    global _trace_handle
+    path = _settings["trace_file"]
+    if not path:
+        return
+    line = json.dumps(event, ensure_ascii=False, default=str) + "\n"
+    with _lock:
+        max_bytes = _settings["trace_max_bytes"]
+        if _trace_handle is not None and max_bytes and _trace_handle.tell() >= max_bytes:
+            _rotate_trace(path)
+        if _trace_handle is None:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            _trace_handle = open(path, "a", encoding="utf-8", buffering=1)
+        _trace_handle.write(line)
+
+
+@contextmanager
+def _profiled(stage):
+    """Runs the block under a profiler if the stage was selected for profiling."""
+    # Only one profiler can be active per process; concurrent spans of the stage run unprofiled
+    if stage not in _settings["profile_stages"] or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    try:
+        os.makedirs(_settings["profile_dir"], exist_ok=True)
+        base = os.path.join(_settings["profile_dir"], f"profile-{stage}-{os.getpid()}-{int(time.time() * 1000)}")
+        if PROFILER == "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                Profiler = None
+            if Profiler is not None:
+                profiler = Profiler()
+                profiler.start()
+                try:
+                    yield
+                finally:
+                    profiler.stop()
+                    with open(base + ".html", "w", encoding="utf-8") as f:
+                        f.write(profiler.output_html())
+                return
+            logger.warning("pyinstrument is not installed, falling back to cProfile")
+
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(base + ".prof")
+    finally:
+        _profile_lock.release()
+
+
+@contextmanager
+def span(stage, **attributes):
+    """
+    Times a block of work as one occurrence of stage.
+
+    Parameters:
+        stage (str): Stage name, e.g. "parse_html_file" or "api_call".
+        **attributes: Extra fields recorded in the trace event (file name, row count, ...).
+    """
+    if not _settings["enabled"]:
+        yield
+        return
+    start_wall = time.time()
+    start = time.perf_counter()
+    error = None
+    try:
+        with _profiled(stage):
+            yield
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        with _lock:
+            stats = _stage_stats.setdefault(stage, [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            if error:
+                stats[3] += 1
+        event = {"stage": stage, "start": start_wall, "duration": duration,
+                 "pid": os.getpid(), "thread": threading.current_thread().name,
+                 "peak_rss_bytes": peak_rss_bytes()}
+        if error:
+            event["error"] = error
+        event.update(attributes)
+        _write_trace(event)
+
+
+def traced(stage=None, attributes=None):
+    """
+    Decorator that wraps every call of a function (sync or async) in a span.
+    The stage name defaults to the function name.
+
+    Parameters:
+        stage (str): Stage name.
+        attributes (callable): Called with the function's arguments; returns a dictionary
+            of extra fields for the trace event, e.g. lambda path, name: {"file": name}.
+    """
+    def decorator(func):
+        name = stage or func.__name__
+
+        def fields(args, kwargs):
+            return attributes(*args, **kwargs) if attributes and _settings["enabled"] else {}
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name, **fields(args, kwargs)):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **fields(args, kwargs)):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(items):
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def prometheus_text():
+    """Renders the current metrics in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        stage_stats = {k: list(v) for k, v in _stage_stats.items()}
+        counters = dict(_counters)
+
+    lines.append("# HELP pipeline_stage_duration_seconds Time spent in each pipeline stage.")
+    lines.append("# TYPE pipeline_stage_duration_seconds summary")
+    for stage, (count, total, _, _) in sorted(stage_stats.items()):
+        lines.append(f'pipeline_stage_duration_seconds_sum{{stage="{_escape(stage)}"}} {total:.6f}')
+        lines.append(f'pipeline_stage_duration_seconds_count{{stage="{_escape(stage)}"}} {count}')
+    lines.append("# HELP pipeline_stage_duration_max_seconds Longest single occurrence of each stage.")
+    lines.append("# TYPE pipeline_stage_duration_max_seconds gauge")
+    for stage, (_, _, longest, _) in sorted(stage_stats.items()):
+        lines.append(f'pipeline_stage_duration_max_seconds{{stage="{_escape(stage)}"}} {longest:.6f}')
+    lines.append("# HELP pipeline_stage_errors_total Stage occurrences that raised an exception.")
+    lines.append("# TYPE pipeline_stage_errors_total counter")
+    for stage, (_, _, _, errors) in sorted(stage_stats.items()):
+        lines.append(f'pipeline_stage_errors_total{{stage="{_escape(stage)}"}} {errors}')
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE pipeline_{name}_total counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f"pipeline_{name}_total{_labels(labels)} {value}")
+
+    peak = peak_rss_bytes()
+    if peak is not None:
+        lines.append("# HELP pipeline_peak_rss_bytes Peak resident set size of the process.")
+        lines.append("# TYPE pipeline_peak_rss_bytes gauge")
+        lines.append(f"pipeline_peak_rss_bytes {peak}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path=None):
+    """Atomically writes the Prometheus textfile (called automatically at exit)."""
+    path = path or _settings["prometheus_file"]
+    if not path or not _settings["enabled"] or not (_stage_stats or _counters):
+        return
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+
+def summary():
+    """
+    Returns per-stage totals.
+
+    Returns:
+        dict: Dictionary {stage: {"count", "total", "max", "errors"}}.
+    """
+    with _lock:
+        return {stage: {"count": c, "total": t, "max": m, "errors": e}
+                for stage, (c, t, m, e) in _stage_stats.items()}
+
+
+def reset():
+    """Clears all collected stage statistics and counters."""
+    with _lock:
+        _stage_stats.clear()
+        _counters.clear()
+
+
+atexit.register(write_prometheus)
@@ -8,6 +8,7 @@ import time
 import asyncio
 import pandas as pd
 from llm import process_optimized, process_async_optimized, extract_entities
+from metrics import summary
 import logging
 
 # Set up logging
@@ -116,6 +117,11 @@ def main():
             print(f"Async is {(thread_time/async_time):.1f}x faster than thread-based")
         else:
             print(f"Thread-based is {(async_time/thread_time):.1f}x faster than async")
+
+        print(f"\n=== Per-Stage Timings ===")
+        for stage, stats in sorted(summary().items()):
+            print(f"{stage}: {stats['count']} calls, {stats['total']:.2f}s total, "
+                  f"{stats['total']/stats['count']:.2f}s avg, {stats['max']:.2f}s max, {stats['errors']} errors")
             
     except FileNotFoundError:
         logger.error(f"CSV file '{csv_file}' not found. Please ensure it exists.")
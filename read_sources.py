@@ -1,6 +1,23 @@
+import gc
 import os
+import re
+import sys
+import html
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from bs4 import BeautifulSoup
+from metrics import traced, increment
+from message_table import MessageTable, COLUMNS
+
+try:
+    from config import PARTITIONS_DIR, INGEST_MAX_WORKERS, INGEST_MESSAGES_PER_CHUNK
+except ImportError:
+    PARTITIONS_DIR = "partitions"
+    INGEST_MAX_WORKERS = 4
+    INGEST_MESSAGES_PER_CHUNK = 100
+
+MESSAGE_START = re.compile(r'<div class="message ')
 
 def parse_date_time(date_string):
     """Split date string into date, time, and timezone."""
@@ -20,18 +37,35 @@ def parse_date_time(date_string):
 
 
 
+def _iter_messages(content):
+    """
+    Yield the "message default clearfix" elements of an export page, parsing
+    INGEST_MESSAGES_PER_CHUNK messages at a time (0 = the whole page at once):
+    the tree of a whole page takes about 20 times the file size.
+    """
+    bounds = [0, len(content)]
+    if INGEST_MESSAGES_PER_CHUNK:
+        starts = [match.start() for match in MESSAGE_START.finditer(content)]
+        bounds[1:1] = starts[INGEST_MESSAGES_PER_CHUNK::INGEST_MESSAGES_PER_CHUNK]
+    for start, end in zip(bounds, bounds[1:]):
+        soup = BeautifulSoup(content[start:end], 'html.parser')
+        yield from soup.select('div.message.default.clearfix')
+        # The tree is full of reference cycles; free it now instead of at some later full collection
+        del soup
+        gc.collect()
+
+@traced(attributes=lambda file_path, filename: {"file": filename})
 def parse_html_file(file_path, filename):
     """Parse a single HTML file and extract messages."""
     messages = []
     
     # Read the HTML file
     with open(file_path, 'r', encoding='utf-8') as file:
-        soup = BeautifulSoup(file, 'html.parser')
-        
-    # Select all messages with class "message default clearfix"
-    message_elements = soup.select('div.message.default.clearfix')
+        content = file.read()
+    increment("bytes", os.path.getsize(file_path), stage="parse_html_file")
     
-    for message in message_elements:
+    # Select all messages with class "message default clearfix", a chunk of the page at a time
+    for message in _iter_messages(content):
         # Skip messages with class "message service"
         if message.select_one('div.message.service'):
             continue
@@ -61,9 +95,9 @@ def parse_html_file(file_path, filename):
                 attachment = a_tag['href']
 
 
-        # Extract from_name
+        # Extract from_name; authors and emojis repeat on every message, so one string object each
         from_elem = message.select_one('div.from_name')
-        from_name = from_elem.get_text(strip=True) if from_elem else None
+        from_name = sys.intern(from_elem.get_text(strip=True)) if from_elem else None
 
         # Extract reactions as a dictionary
         reactions = {}
@@ -73,7 +107,7 @@ def parse_html_file(file_path, filename):
                 emoji = reaction.select_one('div.emoji')
                 count = reaction.select_one('div.count')
                 if emoji and count:
-                    emoji_text = emoji.get_text(strip=True)
+                    emoji_text = sys.intern(emoji.get_text(strip=True))
                     try:
                         count_value = int(count.get_text(strip=True))
                         reactions[emoji_text] = count_value
@@ -94,39 +128,185 @@ def parse_html_file(file_path, filename):
                 'from': from_name
             })
     
+    increment("messages", len(messages), stage="parse_html_file")
     return messages
 
-def main():
+def previous_results(output_path, columns=('json',)):
+    """
+    LLM results of a previous output file by message id.
+
+    Returns:
+        dict: Dictionary {column: {message id: value}}; empty dictionaries if the file doesn't exist.
+    """
+    if not os.path.exists(output_path):
+        return {column: {} for column in columns}
+    previous = pd.read_csv(output_path, usecols=lambda c: c in ('id',) + tuple(columns))
+    results = {}
+    for column in columns:
+        if column in previous.columns:
+            values = previous.dropna(subset=[column]).drop_duplicates('id')
+            results[column] = dict(zip(values['id'], values[column]))
+        else:
+            results[column] = {}
+    return results
+
+def merge_previous_results(df, output_path, columns=('json',)):
+    """Carry LLM results over from a previous output file, matched by message id."""
+    if not os.path.exists(output_path):
+        df = df.assign(**{column: None for column in columns if column not in df.columns})
+        return df
+    previous = pd.read_csv(output_path, usecols=lambda c: c in ('id',) + tuple(columns))
+    for column in columns:
+        if column in previous.columns:
+            values = previous.dropna(subset=[column]).drop_duplicates('id').set_index('id')[column]
+            df[column] = df['id'].map(values)
+        else:
+            df[column] = None
+    return df
+
+def list_export_files(folder):
+    """HTML files of one export in message order: messages.html, messages2.html, ..."""
+    filenames = [f for f in os.listdir(folder) if re.fullmatch(r'messages\d*\.html', f)]
+    filenames.sort(key=lambda x: (x != 'messages.html', int(x.replace('messages', '').replace('.html', '') or 1)))
+    return filenames
+
+def read_channel_title(file_path):
+    """Read the channel title from the page_header of an exported HTML file."""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        head = file.read(16384)
+    match = re.search(r'<div class="page_header">.*?<div class="text bold">\s*(.*?)\s*</div>', head, re.DOTALL)
+    return html.unescape(match.group(1)).strip() if match else None
+
+def channel_slug(title):
+    """File-system safe partition name for a channel title."""
+    slug = re.sub(r'[^\w]+', '_', title or '').strip('_')
+    return slug or 'unknown'
+
+def discover_exports(root):
+    """
+    Find every export directory (a folder containing messages.html) under root.
+
+    Returns:
+        list: List of (channel title, export directory) tuples.
+    """
+    exports = []
+    for folder, dirs, files in os.walk(os.path.abspath(root)):
+        dirs.sort()
+        if 'messages.html' in files:
+            title = read_channel_title(os.path.join(folder, 'messages.html')) or os.path.basename(folder)
+            exports.append((title, folder))
+    return exports
+
+def partition_path(output_root, channel, month):
+    return os.path.join(output_root, f"channel={channel_slug(channel)}", f"month={month or 'unknown'}", 'messages.csv')
+
+def list_partitions(output_root=PARTITIONS_DIR, channel=None):
+    """All partition CSV files under output_root, optionally for a single channel, in order."""
+    paths = []
+    for folder, dirs, files in os.walk(output_root):
+        dirs.sort()
+        if 'messages.csv' in files:
+            if channel is None or os.path.basename(os.path.dirname(folder)) == f"channel={channel_slug(channel)}":
+                paths.append(os.path.join(folder, 'messages.csv'))
+    return paths
+
+def _parse_export_file(args):
+    file_path, filename = args
+    # A MessageTable pickles to a few buffers instead of one object per field
+    return MessageTable(parse_html_file(file_path, filename))
+
+def ingest_channels(root, output_root=PARTITIONS_DIR, max_workers=INGEST_MAX_WORKERS):
+    """
+    Parse all channel exports under root concurrently and write one CSV per channel and month:
+    output_root/channel=<title>/month=<YYYY-MM>/messages.csv
+
+    LLM results already present in a partition are kept for the same message ids.
+    Several exports of the same channel (e.g. overlapping date ranges) are merged,
+    keeping each message id once.
+
+    Returns:
+        dict: Dictionary {channel title: number of messages}.
+
+    Raises:
+        ValueError: If different channel titles map to the same partition folder.
+    """
+    from analyse import date_to_month
+
+    exports = discover_exports(root)
+    titles_by_slug = {}
+    for title, _ in exports:
+        titles_by_slug.setdefault(channel_slug(title), set()).add(title)
+    collisions = {slug: sorted(titles) for slug, titles in titles_by_slug.items() if len(titles) > 1}
+    if collisions:
+        raise ValueError(f"Channel titles share a partition folder: {collisions}; rename an export's channel")
+    tasks = []
+    for title, folder in exports:
+        for filename in list_export_files(folder):
+            tasks.append((title, (os.path.join(folder, filename), filename)))
+    print(f"Found {len(exports)} channel exports with {len(tasks)} files")
+
+    # Files of all channels share one pool, so one huge channel doesn't leave workers idle
+    messages_by_channel = {title: MessageTable() for title, _ in exports}
+    ids_by_channel = {title: set() for title, _ in exports}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for (title, (file_path, filename)), messages in zip(tasks, executor.map(_parse_export_file, [t[1] for t in tasks])):
+            print(f"Processed {title}: {filename}")
+            seen = ids_by_channel[title]
+            new = [m for m in messages if m['id'] not in seen]
+            seen.update(m['id'] for m in new)
+            if len(new) < len(messages):
+                print(f"Skipped {len(messages) - len(new)} messages of {title} already read from another export")
+            messages_by_channel[title].extend(new, channel=title)
+
+    counts = {}
+    for title, table in messages_by_channel.items():
+        if not len(table):
+            continue
+        rows_by_month = table.group_rows('date', key=date_to_month)
+        months = sorted(rows_by_month, key=lambda month: (month is None, month))
+        for month in months:
+            path = partition_path(output_root, title, month or 'unknown')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            table.write_csv(path, ['channel'] + COLUMNS, rows_by_month[month], extra=previous_results(path))
+        counts[title] = len(table)
+        print(f"Saved {len(table)} messages of {title} in {sum(m is not None for m in months)} monthly partitions")
+    return counts
+
+def main(source_folder='source', output_path='telegram_messages.csv'):
     # Define the source folder
-    source_folder = os.path.abspath('source')
+    source_folder = os.path.abspath(source_folder)
     
-    # List to store all messages
-    all_messages = []
+    # Compact column store for all messages (see message_table.py)
+    table = MessageTable()
     
     
-    filenames = [f for f in os.listdir(source_folder) if f.endswith('.html')]
-    filenames.sort(key=lambda x: (x != 'messages.html', int(x.replace('messages', '').replace('.html', '') or 1)))
+    filenames = list_export_files(source_folder)
     
     # Iterate over sorted filenames
     for filename in filenames:
         file_path = os.path.join(source_folder, filename)
         print(f"Processing {filename}...")
-        messages = parse_html_file(file_path, filename)
-        all_messages.extend(messages)
+        table.extend(parse_html_file(file_path, filename))
 
-    # Create DataFrame
-    df = pd.DataFrame(all_messages)
-    
-    # Reorder columns for clarity
-    df = df[['filename', 'id', 'date', 'time', "from", 'text', 'reactions', 'attachment']]
+    # Keep results of llm.py for messages that were already processed
+    previous = previous_results(output_path)
     
-    # Save to CSV with UTF-8 encoding to handle Persian and English text
-    output_path = 'telegram_messages.csv'
-    df.to_csv(output_path, index=False, encoding='utf-8-sig')  # utf-8-sig for Excel compatibility
-    print(f"Saved {len(df)} messages to {output_path}")
+    # Stream to CSV with UTF-8 encoding to handle Persian and English text
+    table.write_csv(output_path, COLUMNS, extra=previous)  # utf-8-sig for Excel compatibility
+    print(f"Saved {len(table)} messages to {output_path}")
 
 
     
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Convert exported Telegram HTML files to CSV")
+    parser.add_argument("--source", default="source", help="Export folder, or root of several exports with --channels")
+    parser.add_argument("--output", default="telegram_messages.csv", help="Output CSV (single export)")
+    parser.add_argument("--channels", action="store_true", help="Ingest every export under --source into partitions")
+    parser.add_argument("--partitions", default=PARTITIONS_DIR, help="Partition root for --channels")
+    parser.add_argument("--workers", type=int, default=INGEST_MAX_WORKERS, help="Parser processes for --channels")
+    args = parser.parse_args()
+    if args.channels:
+        ingest_channels(args.source, args.partitions, args.workers)
+    else:
+        main(args.source, args.output)
@@ -0,0 +1,213 @@
+"""
+Chart reports built from the aggregates in analyse.py.
+
+matplotlib is only imported inside the chart worker, so the plain text report
+in analyse.py never pays for it. Charts are rendered with the headless Agg
+backend in a process pool, and each image is cached under a name derived from
+the hash of the aggregate it was drawn from, so unchanged data is never
+re-rendered.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    from config import REPORT_DIR, REPORT_MAX_WORKERS, REPORT_TOP_N
+except ImportError:
+    REPORT_DIR = "reports"
+    REPORT_MAX_WORKERS = 4
+    REPORT_TOP_N = 15
+
+logger = logging.getLogger(__name__)
+
+
+def aggregate_hash(spec):
+    """
+    Hashes everything that affects how a chart looks.
+
+    Parameters:
+        spec (dict): Chart spec with 'kind', 'title' and 'data' keys.
+
+    Returns:
+        str: Hex SHA-256 digest of the spec.
+    """
+    payload = json.dumps(
+        {k: spec.get(k) for k in ("kind", "title", "data", "top_n")},
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def chart_path(spec, output_dir=REPORT_DIR):
+    """Returns the cache path of a chart: <name>-<hash prefix>.png"""
+    return os.path.join(output_dir, f"{spec['name']}-{aggregate_hash(spec)[:16]}.png")
+
+
+def _render_chart(spec, path):
+    """
+    Draws a single chart and writes it to path. Runs inside a worker process.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    logging.getLogger("matplotlib").setLevel(logging.WARNING)
+
+    fig, ax = plt.subplots(figsize=(12, 6))
+    data = spec["data"]
+
+    if spec["kind"] == "timeseries":
+        # data: {series_name: {month: value}}
+        # Every series is drawn against the same sorted months (a month a series has no
+        # value for counts as 0); string x values would put months first seen in a later
+        # series at the end of the axis
+        months = sorted(set().union(*data.values())) if data else []
+        x = range(len(months))
+        for series_name, points in data.items():
+            ax.plot(x, [points.get(m, 0) for m in months], marker=".", label=str(series_name))
+        ax.set_xlabel("Month")
+        if data:
+            ax.legend(loc="upper left", fontsize="small")
+        # Keep roughly 24 labels regardless of history length
+        step = len(months) // 24 + 1
+        ax.set_xticks(x[::step])
+        ax.set_xticklabels(months[::step])
+        ax.tick_params(axis="x", rotation=90)
+    elif spec["kind"] == "top_n":
+        # data: {label: value}, drawn as horizontal bars, largest on top
+        items = sorted(data.items(), key=lambda x: x[1], reverse=True)[:spec.get("top_n", REPORT_TOP_N)]
+        labels = [str(k) for k, _ in reversed(items)]
+        ax.barh(labels, [v for _, v in reversed(items)])
+    else:
+        plt.close(fig)
+        raise ValueError(f"Unknown chart kind: {spec['kind']}")
+
+    ax.set_title(spec.get("title", spec["name"]))
+    fig.tight_layout()
+
+    # Write to a temporary file first so a half-written image is never served from the cache
+    tmp_path = path + ".tmp"
+    fig.savefig(tmp_path, format="png", dpi=100)
+    plt.close(fig)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _remove_stale(spec, output_dir, keep_path):
+    """Deletes older cached images of the same chart."""
+    prefix = f"{spec['name']}-"
+    for filename in os.listdir(output_dir):
+        path = os.path.join(output_dir, filename)
+        if filename.startswith(prefix) and filename.endswith(".png") and path != keep_path:
+            stem = filename[len(prefix):-len(".png")]
+            # Only touch files that look like our own <name>-<16 hex chars>.png
+            if len(stem) == 16 and all(c in "0123456789abcdef" for c in stem):
+                os.remove(path)
+
+
+def render_charts(specs, output_dir=REPORT_DIR, max_workers=REPORT_MAX_WORKERS):
+    """
+    Renders chart specs to PNG files, skipping charts whose aggregate hasn't changed.
+
+    Parameters:
+        specs (list): List of chart specs (dicts with 'name', 'kind', 'title' and 'data').
+        output_dir (str): Directory for the cached images.
+        max_workers (int): Number of worker processes.
+
+    Returns:
+        dict: Dictionary {chart name: image path}.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+    pending = []
+    for spec in specs:
+        path = chart_path(spec, output_dir)
+        paths[spec["name"]] = path
+        if os.path.exists(path):
+            logger.info(f"Chart '{spec['name']}' unchanged, using cached {path}")
+        else:
+            pending.append((spec, path))
+
+    if not pending:
+        return paths
+
+    if max_workers <= 1 or len(pending) == 1:
+        for spec, path in pending:
+            try:
+                _render_chart(spec, path)
+                _remove_stale(spec, output_dir, path)
+            except Exception as e:
+                logger.error(f"Rendering chart '{spec['name']}' failed: {str(e)}")
+                paths.pop(spec["name"], None)
+    else:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(pending))) as executor:
+            future_to_spec = {executor.submit(_render_chart, spec, path): (spec, path) for spec, path in pending}
+            for future in as_completed(future_to_spec):
+                spec, path = future_to_spec[future]
+                try:
+                    future.result()
+                    _remove_stale(spec, output_dir, path)
+                except Exception as e:
+                    logger.error(f"Rendering chart '{spec['name']}' failed: {str(e)}")
+                    paths.pop(spec["name"], None)
+
+    logger.info(f"Rendered {len(pending)} chart(s) into {output_dir}")
+    return paths
+
+
+def build_chart_specs(df, top_n=REPORT_TOP_N):
+    """
+    Computes the aggregates for the standard charts.
+
+    Parameters:
+        df (pandas.DataFrame): Processed messages with 'date', 'reactions' and 'json' columns.
+        top_n (int): Number of bars in top-N charts and series in trend charts.
+
+    Returns:
+        list: List of chart specs for render_charts.
+    """
+    from analyse import (analyze_content_type_by_month, analyze_entity_trends, analyze_hashtags,
+                         extract_unique_entities_from_pairs, analyze_entity_pairs,
+                         sum_reactions_by_month, sum_reactions_by_type)
+
+    return [
+        {"name": "content_type_by_month", "kind": "timeseries",
+         "title": "Content type over time", "data": analyze_content_type_by_month(df)},
+        {"name": "entity_trends", "kind": "timeseries",
+         "title": "Entity type mentions over time", "data": analyze_entity_trends(df, top_n=top_n)},
+        {"name": "reactions_by_month", "kind": "timeseries",
+         "title": "Reaction engagement over time", "data": {"reactions": sum_reactions_by_month(df)}},
+        {"name": "reactions_by_type", "kind": "top_n", "top_n": top_n,
+         "title": "Top reactions", "data": sum_reactions_by_type(df)},
+        {"name": "top_hashtags", "kind": "top_n", "top_n": top_n,
+         "title": "Top hashtags", "data": analyze_hashtags(df)},
+        {"name": "top_entities", "kind": "top_n", "top_n": top_n,
+         "title": "Most connected entity types",
+         "data": extract_unique_entities_from_pairs(analyze_entity_pairs(df))},
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render charts for the processed Telegram messages")
+    parser.add_argument("--csv", default="telegram_messages.csv", help="Processed messages CSV")
+    parser.add_argument("--output-dir", default=REPORT_DIR, help="Directory for chart images")
+    parser.add_argument("--workers", type=int, default=REPORT_MAX_WORKERS, help="Chart worker processes")
+    parser.add_argument("--top-n", type=int, default=REPORT_TOP_N, help="Items per top-N chart")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    import pandas as pd
+    df = pd.read_csv(args.csv)
+    paths = render_charts(build_chart_specs(df, top_n=args.top_n), args.output_dir, args.workers)
+    for name, path in paths.items():
+        print(f"{name}: {path}")
+
+
+if __name__ == "__main__":
+    main()
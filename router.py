@@ -0,0 +1,492 @@
+"""
+Cost/latency-aware model routing for the LLM extraction.
+
+Every message used to go to gpt-4o-mini, whether it was a one-line price tick
+or a long macro analysis. With ROUTING_ENABLED the extraction in llm.py asks a
+ModelRouter which of the MODEL_TIERS (cheapest first) to use for each message:
+
+  - a tier only takes messages up to its max_chars, in its languages and of
+    its content types. The language is guessed from the script (Persian or
+    English); the content type is pre-classified from ROUTING_CONTENT_KEYWORDS
+    unless the caller already knows it;
+  - of the tiers that qualify the cheapest healthy one is used. A tier whose
+    recent error rate exceeds ROUTING_MAX_ERROR_RATE, or whose recent p95
+    latency exceeds ROUTING_LATENCY_SLO, is skipped until its bad calls age out
+    of the ROUTING_WINDOW_SECONDS window;
+  - a failed call, or an answer without a valid extraction JSON object, falls
+    back to another qualifying tier (more capable ones first, then cheaper
+    ones), up to ROUTING_MAX_ATTEMPTS calls per message.
+
+Every decision is logged at DEBUG level (fallbacks at INFO) and the routed
+call is recorded as a "route" span in the metrics trace, with the tier, the
+language, the content type and why cheaper tiers were skipped.
+
+    python router.py plan --csv telegram_messages.csv
+    python router.py report --messages 200 --concurrency 20 --time-scale 0.2
+
+plan shows how a CSV's pending messages would be routed and the estimated
+cost, without calling the API. report runs the same messages through every
+tier on its own and through the router against the local fake API
+(fake_llm.py), and prints throughput, estimated cost, valid answers and the
+agreement of each tier's extractions with the most capable tier's.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+from metrics import span, increment
+from scheduler import estimate_tokens, CHARS_PER_TOKEN
+from streaming import JsonStreamScanner, LatencyTracker
+
+try:
+    from config import (MODEL_TIERS, ROUTING_CONTENT_KEYWORDS, ROUTING_MAX_ERROR_RATE, ROUTING_LATENCY_SLO,
+                        ROUTING_MIN_SAMPLES, ROUTING_WINDOW_SECONDS, ROUTING_MAX_ATTEMPTS,
+                        OUTPUT_TOKENS_ESTIMATE, STREAM_RESPONSES)
+except ImportError:
+    MODEL_TIERS = [
+        {"name": "standard", "model": "gpt-4o-mini", "input_price": 0.15, "output_price": 0.60,
+         "max_chars": None, "languages": None, "content_types": None},
+    ]
+    ROUTING_CONTENT_KEYWORDS = {}
+    ROUTING_MAX_ERROR_RATE = 0.2
+    ROUTING_LATENCY_SLO = 20.0
+    ROUTING_MIN_SAMPLES = 10
+    ROUTING_WINDOW_SECONDS = 300
+    ROUTING_MAX_ATTEMPTS = 3
+    OUTPUT_TOKENS_ESTIMATE = 250
+    STREAM_RESPONSES = True
+
+logger = logging.getLogger(__name__)
+
+PERSIAN_LETTERS = re.compile(r"[\u0600-\u06FF\uFB50-\uFDFF\uFE70-\uFEFF]")
+LATIN_LETTERS = re.compile(r"[A-Za-z]")
+
+
+def detect_language(text):
+    """
+    Guesses the language of a message from its letters.
+
+    Returns:
+        str: "fa" if at least as many letters are Persian as Latin, else "en".
+    """
+    return "fa" if len(PERSIAN_LETTERS.findall(text)) >= len(LATIN_LETTERS.findall(text)) else "en"
+
+
+def classify_content(text, keywords=None):
+    """
+    Pre-classifies a message into the llm.py content types before extraction.
+
+    Parameters:
+        text (str): Message text.
+        keywords (dict): Dictionary {content type: [keyword, ...]}, matched case-insensitively.
+
+    Returns:
+        str: The content type with the most keyword hits, or "news" if none matches.
+    """
+    keywords = ROUTING_CONTENT_KEYWORDS if keywords is None else keywords
+    lowered = text.casefold()
+    hits = {content_type: sum(lowered.count(word.casefold()) for word in words)
+            for content_type, words in keywords.items()}
+    best = max(hits, key=hits.get, default=None)
+    return best if best is not None and hits[best] > 0 else "news"
+
+
+def validate_answer(answer):
+    """
+    The extraction JSON object of a model answer, without fences or notes around it.
+
+    Returns:
+        str: The object's text, or None if the answer has no object with an 'entities' dictionary.
+    """
+    if not isinstance(answer, str):
+        return None
+    scanner = JsonStreamScanner()
+    if not scanner.feed(answer):
+        return None
+    if not isinstance(json.loads(scanner.result).get("entities"), dict):
+        return None
+    return scanner.result
+
+
+def estimate_call_cost(tier, text, answer=None):
+    """
+    Estimated price in USD of one call of a tier: the prompt and message, plus the
+    answer if there is one (else the usual answer length).
+    """
+    output_tokens = int(len(answer) / CHARS_PER_TOKEN) if answer else OUTPUT_TOKENS_ESTIMATE
+    input_tokens = estimate_tokens(text) - OUTPUT_TOKENS_ESTIMATE
+    return (input_tokens * tier["input_price"] + output_tokens * tier["output_price"]) / 1e6
+
+
+class TierStats:
+    """
+    Recent calls of one tier, for deciding whether it is healthy, and what it has cost.
+
+    Parameters:
+        window_seconds (float): Calls older than this are forgotten.
+    """
+
+    def __init__(self, window_seconds=ROUTING_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self.recent = deque()  # (time, ok, seconds)
+        self.calls = 0
+        self.failures = 0
+        self.cost = 0.0
+        # Hedging of streamed calls needs the latencies of this model only
+        self.hedging = LatencyTracker()
+        self._lock = threading.Lock()
+
+    def record(self, ok, seconds, cost):
+        now = time.time()
+        with self._lock:
+            self.recent.append((now, ok, seconds))
+            self.calls += 1
+            self.failures += not ok
+            self.cost += cost
+            self._prune(now)
+
+    def _prune(self, now):
+        while self.recent and self.recent[0][0] < now - self.window_seconds:
+            self.recent.popleft()
+
+    def health(self, max_error_rate=ROUTING_MAX_ERROR_RATE, latency_slo=ROUTING_LATENCY_SLO,
+               min_samples=ROUTING_MIN_SAMPLES):
+        """
+        Returns:
+            str: None if the tier is healthy (or there are too few recent calls to tell),
+                else the reason it isn't.
+        """
+        with self._lock:
+            self._prune(time.time())
+            recent = list(self.recent)
+        if len(recent) < min_samples:
+            return None
+        error_rate = sum(not ok for _, ok, _ in recent) / len(recent)
+        if error_rate > max_error_rate:
+            return f"error rate {error_rate:.0%}"
+        latencies = sorted(seconds for _, _, seconds in recent)
+        p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        if latency_slo is not None and p95 > latency_slo:
+            return f"p95 latency {p95:.1f}s"
+        return None
+
+
+class ModelRouter:
+    """
+    Picks a model tier for each message and falls back to others on failure.
+
+    Parameters:
+        tiers (list): Tier dictionaries like MODEL_TIERS, cheapest first. A max_chars,
+            languages or content_types of None accepts anything.
+        max_error_rate (float): Recent error rate above which a tier is skipped.
+        latency_slo (float): Recent p95 latency in seconds above which a tier is skipped.
+        min_samples (int): Recent calls needed before a tier can be judged unhealthy.
+        window_seconds (float): Age after which calls are forgotten.
+        max_attempts (int): Calls per message, fallbacks included.
+    """
+
+    def __init__(self, tiers=None, max_error_rate=ROUTING_MAX_ERROR_RATE, latency_slo=ROUTING_LATENCY_SLO,
+                 min_samples=ROUTING_MIN_SAMPLES, window_seconds=ROUTING_WINDOW_SECONDS,
+                 max_attempts=ROUTING_MAX_ATTEMPTS):
+        self.tiers = list(MODEL_TIERS if tiers is None else tiers)
+        if not self.tiers:
+            raise ValueError("At least one model tier is needed")
+        self.max_error_rate = max_error_rate
+        self.latency_slo = latency_slo
+        self.min_samples = min_samples
+        self.max_attempts = max_attempts
+        self.stats = {tier["name"]: TierStats(window_seconds) for tier in self.tiers}
+
+    @staticmethod
+    def _unsuitable(tier, chars, language, content_type):
+        """Why a tier can't take a message, or None if it can."""
+        if tier.get("max_chars") is not None and chars > tier["max_chars"]:
+            return "too long"
+        if tier.get("languages") is not None and language not in tier["languages"]:
+            return f"no {language}"
+        if tier.get("content_types") is not None and content_type not in tier["content_types"]:
+            return f"no {content_type}"
+        return None
+
+    def route(self, news_text, content_type=None):
+        """
+        Decides which tiers to call for a message, in order.
+
+        Parameters:
+            news_text (str): Message text.
+            content_type (str): The message's content type if already known, else it is pre-classified.
+
+        Returns:
+            tuple: (list of tiers to try, decision dictionary with "tier", "language",
+                "content_type", "chars" and "skipped" reasons of cheaper tiers).
+        """
+        language = detect_language(news_text)
+        content_type = content_type or classify_content(news_text)
+        skipped = {}
+        suitable = []
+        unhealthy = []
+        for tier in self.tiers:
+            reason = self._unsuitable(tier, len(news_text), language, content_type)
+            if reason is None:
+                reason = self.stats[tier["name"]].health(self.max_error_rate, self.latency_slo, self.min_samples)
+                (unhealthy if reason else suitable).append(tier)
+            if reason and not suitable:
+                skipped[tier["name"]] = reason
+
+        if suitable:
+            first = suitable[0]
+            position = self.tiers.index(first)
+            # Fall back to more capable tiers first, then cheaper ones, unhealthy ones last
+            others = [t for t in self.tiers[position + 1:] if t in suitable] + \
+                     [t for t in reversed(self.tiers[:position]) if t in suitable]
+            chain = [first] + others + unhealthy
+        elif unhealthy:
+            # All qualifying tiers look unhealthy; the most capable one is the best bet
+            chain = unhealthy[::-1]
+        else:
+            # Nothing qualifies (e.g. longer than every max_chars): try the most capable tiers
+            chain = self.tiers[::-1]
+        chain = chain[:self.max_attempts]
+        decision = {"tier": chain[0]["name"], "language": language, "content_type": content_type,
+                    "chars": len(news_text), "skipped": skipped}
+        logger.debug(f"Routed {len(news_text)} chars ({language}, {content_type}) to {chain[0]['name']}"
+                     + (f", skipped {skipped}" if skipped else ""))
+        increment("routed_messages", tier=chain[0]["name"])
+        return chain, decision
+
+    def _record(self, tier, news_text, answer, seconds):
+        self.stats[tier["name"]].record(answer is not None, seconds, estimate_call_cost(tier, news_text, answer))
+        if answer is None:
+            increment("routing_failures", tier=tier["name"])
+
+    def _fall_back(self, chain, attempt, news_text):
+        if attempt + 1 < len(chain):
+            logger.info(f"{chain[attempt]['name']} gave no valid answer, falling back to "
+                        f"{chain[attempt + 1]['name']} for text: {news_text[:100]}...")
+            increment("routing_fallbacks", source=chain[attempt]["name"], target=chain[attempt + 1]["name"])
+        else:
+            logger.warning(f"No tier gave a valid answer for text: {news_text[:100]}...")
+
+    def extract(self, news_text, content_type=None):
+        """
+        Routed version of llm.extract_entities.
+
+        Returns:
+            str: The extraction JSON object, or None if every tier tried failed.
+        """
+        from llm import extract_entities
+
+        chain, decision = self.route(news_text, content_type)
+        with span("route", **decision):
+            for attempt, tier in enumerate(chain):
+                start = time.perf_counter()
+                answer = validate_answer(extract_entities(news_text, tier["model"]))
+                self._record(tier, news_text, answer, time.perf_counter() - start)
+                if answer is not None:
+                    return answer
+                self._fall_back(chain, attempt, news_text)
+        return None
+
+    async def extract_async(self, news_text, content_type=None, client=None, stream=STREAM_RESPONSES):
+        """
+        Routed version of llm.extract_entities_async; with stream, of llm.extract_entities_hedged_async
+        (hedged against the latencies of the tier's own model).
+
+        Returns:
+            str: The extraction JSON object, or None if every tier tried failed.
+        """
+        import llm
+
+        chain, decision = self.route(news_text, content_type)
+        with span("route", **decision):
+            for attempt, tier in enumerate(chain):
+                start = time.perf_counter()
+                if stream:
+                    answer = await llm.extract_entities_hedged_async(news_text, tier["model"], client,
+                                                                      self.stats[tier["name"]].hedging)
+                else:
+                    answer = await llm.extract_entities_async(news_text, tier["model"], client)
+                answer = validate_answer(answer)
+                self._record(tier, news_text, answer, time.perf_counter() - start)
+                if answer is not None:
+                    return answer
+                self._fall_back(chain, attempt, news_text)
+        return None
+
+    def summary(self):
+        """
+        Returns:
+            dict: Dictionary {tier name: {"calls", "failures", "cost"}} since the router was created.
+        """
+        return {name: {"calls": stats.calls, "failures": stats.failures, "cost": stats.cost}
+                for name, stats in self.stats.items()}
+
+
+_default_router = None
+_default_lock = threading.Lock()
+
+
+def default_router():
+    """The process-wide router used by llm.py, so all batches share the observed tier health."""
+    global _default_router
+    with _default_lock:
+        if _default_router is None:
+            _default_router = ModelRouter()
+        return _default_router
+
+
+def plan(csv_file, router=None):
+    """
+    Routes the pending messages of a CSV without calling the API.
+
+    Returns:
+        dict: Dictionary {tier name: {"messages", "cost"}} with the estimated cost of the first calls.
+    """
+    from llm import read_csv
+    from scheduler import pending_rows
+
+    router = router or ModelRouter()
+    by_name = {tier["name"]: tier for tier in router.tiers}
+    result = {name: {"messages": 0, "cost": 0.0} for name in by_name}
+    for _, text in pending_rows(read_csv(csv_file)):
+        chain, _ = router.route(text)
+        name = chain[0]["name"]
+        result[name]["messages"] += 1
+        result[name]["cost"] += estimate_call_cost(by_name[name], text)
+    return result
+
+
+def _entity_values(answer):
+    result = json.loads(answer)
+    return result.get("type_of_content"), {str(value).casefold() for values in result["entities"].values()
+                                           if isinstance(values, list) for value in values}
+
+
+def agreement(answers, reference):
+    """
+    Agreement of extractions with reference extractions of the same messages.
+
+    Returns:
+        tuple: (mean Jaccard similarity of the entity values, share of equal content types),
+            over the messages both answered; NaN if there are none.
+    """
+    jaccards = []
+    same_type = []
+    for answer, expected in zip(answers, reference):
+        if answer is None or expected is None:
+            continue
+        content_type, values = _entity_values(answer)
+        expected_type, expected_values = _entity_values(expected)
+        union = values | expected_values
+        jaccards.append(len(values & expected_values) / len(union) if union else 1.0)
+        same_type.append(content_type == expected_type)
+    if not jaccards:
+        return float("nan"), float("nan")
+    return sum(jaccards) / len(jaccards), sum(same_type) / len(same_type)
+
+
+async def _run_router(router, texts, base_url, concurrency):
+    from openai import AsyncOpenAI
+
+    client = AsyncOpenAI(api_key="fake", base_url=base_url, max_retries=0)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(text):
+        async with semaphore:
+            return await router.extract_async(text, client=client)
+
+    try:
+        return await asyncio.gather(*(one(text) for text in texts))
+    finally:
+        await client.close()
+
+
+def report(num_messages=200, concurrency=20, time_scale=1.0, seed=0, tiers=None):
+    """
+    Runs the same messages through each tier on its own and through the router,
+    against a fresh fake API (fake_llm.py) each. Tier models are replaced by
+    "fake-<tier name>", so the fake API imitates their speed and quality.
+
+    Returns:
+        dict: Dictionary {tier name or "routed": {"messages_per_second", "cost", "valid",
+            "entity_agreement", "type_agreement", "calls", "tiers"}}; agreement is measured
+            against the last (most capable) tier.
+    """
+    import fake_llm
+    from metrics import configure
+    from synthetic_export import generate_dataframe
+
+    configure(enabled=False)
+    tiers = [dict(tier, model=f"fake-{tier['name']}") for tier in (MODEL_TIERS if tiers is None else tiers)]
+    df = generate_dataframe(num_messages * 3, seed=seed, with_json=False)
+    texts = [t for t in df["text"] if isinstance(t, str) and len(t) > 100][:num_messages]
+
+    # Each tier alone takes every message, once; the router uses all tiers with their limits
+    modes = [(tier["name"], ModelRouter([dict(tier, max_chars=None, languages=None, content_types=None)],
+                                        max_attempts=1))
+             for tier in tiers]
+    modes.append(("routed", ModelRouter(tiers, latency_slo=ROUTING_LATENCY_SLO * time_scale)))
+
+    answers = {}
+    results = {}
+    for mode, router in modes:
+        server = fake_llm.make_server(port=0, time_scale=time_scale, seed=seed)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+            start = time.perf_counter()
+            answers[mode] = asyncio.run(_run_router(router, texts, base_url, concurrency))
+            seconds = (time.perf_counter() - start) / time_scale
+        finally:
+            server.shutdown()
+            server.server_close()
+        summary = router.summary()
+        results[mode] = {"messages_per_second": len(texts) / seconds,
+                         "cost": sum(s["cost"] for s in summary.values()),
+                         "valid": sum(a is not None for a in answers[mode]) / len(texts),
+                         "calls": sum(s["calls"] for s in summary.values()),
+                         "tiers": {name: s["calls"] for name, s in summary.items()}}
+
+    reference = answers[tiers[-1]["name"]]
+    for mode in results:
+        results[mode]["entity_agreement"], results[mode]["type_agreement"] = agreement(answers[mode], reference)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost/latency-aware model routing of the LLM extraction")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    sub = subparsers.add_parser("plan", help="Show how a CSV's pending messages would be routed")
+    sub.add_argument("--csv", default="telegram_messages.csv", help="Messages CSV")
+    sub = subparsers.add_parser("report", help="Compare the tiers and the router against the fake API")
+    sub.add_argument("--messages", type=int, default=200)
+    sub.add_argument("--concurrency", type=int, default=20)
+    sub.add_argument("--time-scale", type=float, default=1.0, help="Multiplies every delay of the fake API")
+    sub.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.command == "plan":
+        result = plan(args.csv)
+        print(f"{'tier':<10}{'messages':>10}{'est. cost':>12}")
+        for name, r in result.items():
+            print(f"{name:<10}{r['messages']:>10}{r['cost']:>12.4f}")
+        return
+
+    results = report(args.messages, args.concurrency, args.time_scale, args.seed)
+    print(f"\n{args.messages} messages, concurrency {args.concurrency}; agreement with the most capable tier")
+    print(f"{'mode':<10}{'msg/s':>8}{'cost $':>10}{'valid':>8}{'entities':>10}{'type':>8}{'calls':>8}  calls per tier")
+    for mode, r in results.items():
+        per_tier = ", ".join(f"{name} {calls}" for name, calls in r["tiers"].items() if calls)
+        print(f"{mode:<10}{r['messages_per_second']:>8.1f}{r['cost']:>10.4f}{r['valid']:>8.0%}"
+              f"{r['entity_agreement']:>10.0%}{r['type_agreement']:>8.0%}{r['calls']:>8}  {per_tier}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,216 @@
+"""
+Priority scheduling of LLM extraction work.
+
+Pending messages used to be extracted in strict reverse row order, so a large
+backlog held back today's market-moving posts. Here every pending message gets
+a priority score and work is handed out best first, optionally within a token,
+cost or time budget ("spend at most N tokens, best items first").
+
+The score is a sum of terms measured in half-lives:
+
+    score = posted_hours / SCHEDULER_HALF_LIFE_HOURS            recency
+          + ENGAGEMENT weight * log2(1 + total reactions)       engagement
+          + sum of SCHEDULER_HINTS bonuses found in the text     content hints
+          - COST weight * log2(estimated tokens)                 cost
+
+A post one half-life newer, or with twice the reactions (at weight 1), scores
+one point more. Because recency is counted from a fixed origin instead of
+"now", scores don't decay: a score stored when a message was queued stays
+comparable with the scores of messages that arrive later, and new arrivals
+naturally outrank the older backlog. That is what lets work_queue.py pre-empt
+the backlog simply by claiming in score order.
+"""
+
+import math
+import threading
+import time
+from datetime import datetime
+
+try:
+    from config import (SCHEDULER_HALF_LIFE_HOURS, SCHEDULER_WEIGHTS, SCHEDULER_HINTS,
+                        PROMPT_OVERHEAD_TOKENS, OUTPUT_TOKENS_ESTIMATE, CHARS_PER_TOKEN,
+                        PRICE_PER_MILLION_INPUT_TOKENS, PRICE_PER_MILLION_OUTPUT_TOKENS)
+except ImportError:
+    SCHEDULER_HALF_LIFE_HOURS = 24
+    SCHEDULER_WEIGHTS = {"engagement": 1.0, "hints": 1.0, "cost": 0.5}
+    SCHEDULER_HINTS = {}
+    PROMPT_OVERHEAD_TOKENS = 900
+    OUTPUT_TOKENS_ESTIMATE = 250
+    CHARS_PER_TOKEN = 3.0
+    PRICE_PER_MILLION_INPUT_TOKENS = 0.15
+    PRICE_PER_MILLION_OUTPUT_TOKENS = 0.60
+
+
+def estimate_tokens(text):
+    """
+    Rough token count of one extraction call: system prompt, message text and answer.
+    """
+    input_tokens = PROMPT_OVERHEAD_TOKENS + int(len(text) / CHARS_PER_TOKEN)
+    return input_tokens + OUTPUT_TOKENS_ESTIMATE
+
+
+def estimate_cost(tokens):
+    """Estimated price in USD of a call estimated at the given number of tokens."""
+    output_tokens = min(tokens, OUTPUT_TOKENS_ESTIMATE)
+    return ((tokens - output_tokens) * PRICE_PER_MILLION_INPUT_TOKENS
+            + output_tokens * PRICE_PER_MILLION_OUTPUT_TOKENS) / 1e6
+
+
+def message_timestamp(date, time_of_day=None):
+    """
+    Seconds since the epoch of a message's "dd.mm.yyyy" date and "HH:MM:SS" time, or None.
+    """
+    if not isinstance(date, str):
+        return None
+    try:
+        if isinstance(time_of_day, str):
+            return datetime.strptime(f"{date} {time_of_day}", "%d.%m.%Y %H:%M:%S").timestamp()
+        return datetime.strptime(date, "%d.%m.%Y").timestamp()
+    except ValueError:
+        return None
+
+
+def priority(record, weights=None, hints=None, half_life_hours=SCHEDULER_HALF_LIFE_HOURS):
+    """
+    Priority score of a pending message; higher is extracted first.
+
+    Parameters:
+        record (dict): Message with 'text' and optionally 'date', 'time' and 'reactions'
+            (a dict as parse_html_file returns it, or its string form as stored in the CSV).
+        weights (dict): Weights of the "engagement", "hints" and "cost" terms.
+        hints (dict): Dictionary {keyword: bonus}, matched case-insensitively in the text.
+        half_life_hours (float): Age difference worth one point.
+
+    Returns:
+        float: The score.
+    """
+    from analyse import sum_reactions
+
+    weights = SCHEDULER_WEIGHTS if weights is None else weights
+    hints = SCHEDULER_HINTS if hints is None else hints
+    text = record.get("text") if isinstance(record.get("text"), str) else ""
+
+    score = 0.0
+    posted = message_timestamp(record.get("date"), record.get("time"))
+    if posted is not None:
+        score += posted / 3600 / half_life_hours
+
+    reactions = record.get("reactions")
+    if isinstance(reactions, dict):
+        reactions = sum(reactions.values())
+    else:
+        reactions = sum_reactions(reactions) if isinstance(reactions, str) else 0
+    score += weights.get("engagement", 0) * math.log2(1 + reactions)
+
+    if hints:
+        lowered = text.casefold()
+        score += weights.get("hints", 0) * sum(bonus for keyword, bonus in hints.items()
+                                               if keyword.casefold() in lowered)
+
+    score -= weights.get("cost", 0) * math.log2(estimate_tokens(text))
+    return score
+
+
+class Budget:
+    """
+    Limits on one extraction run. Any limit left as None is unlimited.
+
+    Parameters:
+        max_tokens (int): Estimated tokens to spend at most.
+        max_cost (float): Estimated USD to spend at most.
+        max_seconds (float): Wall time after which no new work is started.
+    """
+
+    def __init__(self, max_tokens=None, max_cost=None, max_seconds=None):
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.deadline = time.time() + max_seconds if max_seconds else None
+        self.tokens = 0
+        self.cost = 0.0
+        self._lock = threading.Lock()
+
+    def fits(self, tokens):
+        """True if work estimated at tokens can still be started."""
+        if self.expired():
+            return False
+        if self.max_tokens is not None and self.tokens + tokens > self.max_tokens:
+            return False
+        if self.max_cost is not None and self.cost + estimate_cost(tokens) > self.max_cost:
+            return False
+        return True
+
+    def take(self, tokens):
+        """
+        Reserves tokens if they fit. Safe to call from several threads sharing the budget.
+
+        Returns:
+            bool: True if the work can be started.
+        """
+        with self._lock:
+            if not self.fits(tokens):
+                return False
+            self.tokens += tokens
+            self.cost += estimate_cost(tokens)
+            return True
+
+    def remaining_tokens(self):
+        """Tokens left under both the token and the cost limit (None if unlimited)."""
+        limits = []
+        if self.max_tokens is not None:
+            limits.append(self.max_tokens - self.tokens)
+        if self.max_cost is not None:
+            per_token = estimate_cost(1_000_000) / 1_000_000
+            limits.append(int((self.max_cost - self.cost) / per_token))
+        return max(0, min(limits)) if limits else None
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def exhausted(self):
+        """True once nothing more can be started."""
+        remaining = self.remaining_tokens()
+        return self.expired() or (remaining is not None and remaining < estimate_tokens(""))
+
+
+def schedule(records, budget=None):
+    """
+    Orders pending work best first and keeps what fits in the token/cost budget.
+    Items too expensive for what is left are skipped, so cheaper ones further down
+    the list can still use the rest of the budget.
+
+    Parameters:
+        records (list): (key, record) tuples; record as for priority().
+        budget (Budget): Optional limits; the selected items are reserved in it.
+
+    Returns:
+        list: The selected keys, highest priority first.
+    """
+    ranked = sorted(records, key=lambda item: priority(item[1]), reverse=True)
+    if budget is None:
+        return [key for key, _ in ranked]
+    selected = []
+    for key, record in ranked:
+        tokens = estimate_tokens(record.get("text") or "")
+        if budget.take(tokens):
+            selected.append(key)
+        elif budget.exhausted():
+            break
+    return selected
+
+
+def pending_rows(df, budget=None, min_length=100):
+    """
+    The rows of a messages DataFrame that still need extraction, best first.
+
+    Returns:
+        list: (row position, text) tuples.
+    """
+    columns = [c for c in ("text", "date", "time", "reactions", "json") if c in df.columns]
+    records = []
+    for position, values in enumerate(zip(*(df[c] for c in columns))):
+        record = dict(zip(columns, values))
+        text = record["text"]
+        if isinstance(text, str) and len(text) > min_length and not isinstance(record.get("json"), str):
+            records.append((position, record))
+    texts = {position: record["text"] for position, record in records}
+    return [(position, texts[position]) for position in schedule(records, budget)]
@@ -0,0 +1,339 @@
+"""
+Local "similar past news" search.
+
+Messages are turned into hashed TF-IDF vectors (Persian and English tokens
+plus word bigrams, hashed into a fixed number of features) built from the
+message text and the LLM 'subject'. Vectors are appended to a sparse CSR
+matrix on disk, which is memory-mapped for queries, so the index can grow
+incrementally as new messages arrive. Queries are brute-force cosine
+similarity over the whole matrix, vectorized with NumPy and processed in
+row blocks, so a batch of queries costs one pass over the index.
+
+Everything runs on the CPU and needs no network access or trained model.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import unicodedata
+import zlib
+
+import numpy as np
+
+from kg_loader import iter_csv_records, message_key, parse_extraction
+
+try:
+    from config import SIMILAR_NEWS_DIR, SIMILAR_NEWS_FEATURES
+except ImportError:
+    SIMILAR_NEWS_DIR = "similar_news"
+    SIMILAR_NEWS_FEATURES = 2 ** 18
+
+logger = logging.getLogger(__name__)
+
+# Arabic code points that Persian text often uses in place of the Persian ones
+PERSIAN_TRANSLATION = str.maketrans({
+    "\u064a": "\u06cc",  # Arabic yeh -> Persian yeh
+    "\u0649": "\u06cc",  # Alef maksura -> Persian yeh
+    "\u0643": "\u06a9",  # Arabic kaf -> Persian keheh
+    "\u0629": "\u0647",  # Teh marbuta -> heh
+    "\u200c": " ",        # Zero-width non-joiner
+    **{chr(0x06f0 + d): str(d) for d in range(10)},  # Persian digits
+    **{chr(0x0660 + d): str(d) for d in range(10)},  # Arabic-Indic digits
+})
+DIACRITICS = re.compile("[\u064b-\u065f\u0670]")
+TOKEN = re.compile(r"[^\W_]+")
+
+# Rows scored per step; keeps the (queries x non-zeros) work buffer small
+SCORE_BLOCK_NNZ = 2_000_000
+
+
+def normalize_text(text):
+    """Unicode and Persian/Arabic normalization, lower-cased."""
+    text = unicodedata.normalize("NFKC", text).translate(PERSIAN_TRANSLATION)
+    return DIACRITICS.sub("", text).lower()
+
+
+def tokenize(text):
+    """
+    Splits text into word tokens and adjacent word bigrams.
+    Single characters and pure numbers are dropped.
+    """
+    words = [w for w in TOKEN.findall(normalize_text(text)) if len(w) > 1 and not w.isdigit()]
+    return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+
+def hash_features(tokens, n_features=SIMILAR_NEWS_FEATURES):
+    """
+    Hashes tokens into a sparse sublinear term-frequency vector.
+
+    Returns:
+        tuple: (indices, values) as int32 and float32 arrays, indices sorted.
+    """
+    if not tokens:
+        return np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)
+    # crc32 is stable across processes, unlike hash()
+    hashed = np.fromiter((zlib.crc32(t.encode("utf-8")) % n_features for t in tokens),
+                         dtype=np.int64, count=len(tokens))
+    indices, counts = np.unique(hashed, return_counts=True)
+    return indices.astype(np.int32), (1.0 + np.log(counts)).astype(np.float32)
+
+
+def document_text(record):
+    """Text that is indexed for a message: its text plus the LLM subject, if any."""
+    text = record.get("text")
+    text = text if isinstance(text, str) else ""
+    data = parse_extraction(record.get("json"))
+    if data and isinstance(data.get("subject"), str):
+        text = f"{text} {data['subject']}"
+    return text
+
+
+class SimilarNewsIndex:
+    """
+    Append-only hashed TF-IDF index stored in index_dir.
+
+    Files:
+        meta.json     number of features and documents
+        indptr.bin    int64 row offsets (num_docs + 1)
+        indices.bin   int32 feature indices of all rows
+        data.bin      float32 term-frequency weights of all rows
+        df.npy        document frequency per feature
+        docs.jsonl    id, date and a text snippet per row
+    """
+
+    def __init__(self, index_dir=SIMILAR_NEWS_DIR, n_features=SIMILAR_NEWS_FEATURES):
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        meta_path = os.path.join(index_dir, "meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            self.n_features = meta["n_features"]
+            self.num_docs = meta["num_docs"]
+            self.df = np.load(os.path.join(index_dir, "df.npy"))
+        else:
+            self.n_features = n_features
+            self.num_docs = 0
+            self.df = np.zeros(n_features, dtype=np.int64)
+            with open(self._path("indptr.bin"), "wb") as f:
+                f.write(np.zeros(1, dtype=np.int64).tobytes())
+            for name in ("indices.bin", "data.bin", "docs.jsonl"):
+                open(self._path(name), "wb").close()
+            self._write_meta()
+
+        self.docs = []
+        with open(self._path("docs.jsonl"), encoding="utf-8") as f:
+            for line in f:
+                self.docs.append(json.loads(line))
+        if len(self.docs) > self.num_docs:
+            # A crash between appending rows and updating meta.json leaves extra rows; drop them
+            self.docs = self.docs[:self.num_docs]
+            with open(self._path("docs.jsonl"), "w", encoding="utf-8") as f:
+                for doc in self.docs:
+                    f.write(json.dumps(doc, ensure_ascii=False) + "\n")
+        self.doc_index = {doc["id"]: i for i, doc in enumerate(self.docs)}
+        self._matrix = None
+
+    def _path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    def _write_meta(self):
+        np.save(self._path("df.npy"), self.df)
+        tmp_path = self._path("meta.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"n_features": self.n_features, "num_docs": self.num_docs}, f)
+        os.replace(tmp_path, self._path("meta.json"))
+
+    def add_records(self, records):
+        """
+        Vectorizes and appends message records that aren't indexed yet.
+
+        Parameters:
+            records (iterable): Dicts with 'id', 'date', 'text' and optionally 'json' keys.
+
+        Returns:
+            int: Number of messages added.
+        """
+        indptr_end = int(np.fromfile(self._path("indptr.bin"), dtype=np.int64)[self.num_docs])
+        added = 0
+        with open(self._path("indptr.bin"), "r+b") as indptr_file, \
+                open(self._path("indices.bin"), "r+b") as indices_file, \
+                open(self._path("data.bin"), "r+b") as data_file, \
+                open(self._path("docs.jsonl"), "a", encoding="utf-8") as docs_file:
+            # Position after the last committed row, dropping anything a crash left behind
+            indptr_file.seek((self.num_docs + 1) * 8)
+            indptr_file.truncate()
+            indices_file.seek(indptr_end * 4)
+            indices_file.truncate()
+            data_file.seek(indptr_end * 4)
+            data_file.truncate()
+
+            for record in records:
+                doc_id = message_key(record)
+                if doc_id is None or doc_id in self.doc_index:
+                    continue
+                text = document_text(record)
+                indices, values = hash_features(tokenize(text), self.n_features)
+                indices_file.write(indices.tobytes())
+                data_file.write(values.tobytes())
+                indptr_end += len(indices)
+                indptr_file.write(np.int64(indptr_end).tobytes())
+                self.df[indices] += 1
+
+                doc = {"id": doc_id, "date": record.get("date") if isinstance(record.get("date"), str) else None,
+                       "text": text[:200]}
+                docs_file.write(json.dumps(doc, ensure_ascii=False) + "\n")
+                self.docs.append(doc)
+                self.doc_index[doc_id] = self.num_docs + added
+                added += 1
+
+        self.num_docs += added
+        self._write_meta()
+        self._matrix = None
+        if added:
+            logger.info(f"Indexed {added} new messages ({self.num_docs} total)")
+        return added
+
+    def _load_matrix(self):
+        """Memory-maps the CSR arrays and computes IDF-weighted row norms."""
+        if self._matrix is None:
+            indptr = np.memmap(self._path("indptr.bin"), dtype=np.int64, mode="r")[:self.num_docs + 1]
+            nnz = int(indptr[-1])
+            indices = (np.memmap(self._path("indices.bin"), dtype=np.int32, mode="r")[:nnz]
+                       if nnz else np.zeros(0, dtype=np.int32))
+            data = (np.memmap(self._path("data.bin"), dtype=np.float32, mode="r")[:nnz]
+                    if nnz else np.zeros(0, dtype=np.float32))
+            idf = (np.log((1.0 + self.num_docs) / (1.0 + self.df)) + 1.0).astype(np.float32)
+            squared = np.concatenate([[0.0], np.cumsum((data * idf[indices]).astype(np.float64) ** 2)])
+            norms = np.sqrt(squared[indptr[1:]] - squared[indptr[:-1]])
+            self._matrix = (indptr, indices, data, idf, norms)
+        return self._matrix
+
+    def _query_vectors(self, features, idf):
+        """
+        L2-normalized TF-IDF vectors for a batch of (indices, values) feature vectors, restricted
+        to the features the queries actually use.
+
+        Returns:
+            tuple: (vocabulary, queries) - the sorted feature indices used by any query, and a
+            (queries, len(vocabulary) + 1) array whose last column is all zeros, for features
+            no query has.
+        """
+        vocabulary = np.unique(np.concatenate([indices for indices, _ in features] + [np.zeros(0, np.int32)]))
+        queries = np.zeros((len(features), len(vocabulary) + 1), dtype=np.float32)
+        for i, (indices, values) in enumerate(features):
+            columns = np.searchsorted(vocabulary, indices)
+            queries[i, columns] = values * idf[indices]
+            norm = np.linalg.norm(queries[i])
+            if norm > 0:
+                queries[i] /= norm
+        return vocabulary, queries
+
+    @staticmethod
+    def _query_columns(vocabulary, block_indices):
+        """Column of each feature index in the query array; the all-zero last column if no query has it."""
+        columns = np.searchsorted(vocabulary, block_indices)
+        # -1 never matches a feature index, so searches past the end land on the zero column too
+        columns[np.append(vocabulary, -1)[columns] != block_indices] = len(vocabulary)
+        return columns
+
+    def query(self, texts, top_k=10, exclude=None):
+        """
+        Finds the indexed messages most similar to each query text.
+
+        Parameters:
+            texts (list): Query texts.
+            top_k (int): Number of results per query.
+            exclude (list): Optional document id to leave out per query (e.g. the query message itself).
+
+        Returns:
+            list: One list of (doc, score) tuples per query, best first.
+        """
+        features = [hash_features(tokenize(text), self.n_features) for text in texts]
+        return self._search(features, top_k, exclude)
+
+    def similar_to(self, doc_ids, top_k=10):
+        """
+        Finds messages similar to already indexed messages, excluding the messages themselves.
+        Ids that are not in the index are logged and get an empty result list.
+        """
+        if self.num_docs == 0:
+            return [[] for _ in doc_ids]
+        indptr, indices, data, _, _ = self._load_matrix()
+        features = []
+        for doc_id in doc_ids:
+            row = self.doc_index.get(doc_id)
+            if row is None:
+                logger.warning(f"Message id {doc_id!r} is not in the index")
+                features.append((np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32)))
+                continue
+            lo, hi = int(indptr[row]), int(indptr[row + 1])
+            features.append((np.asarray(indices[lo:hi]), np.asarray(data[lo:hi])))
+        return self._search(features, top_k, exclude=list(doc_ids))
+
+    def _search(self, features, top_k, exclude):
+        if self.num_docs == 0:
+            return [[] for _ in features]
+        indptr, indices, data, idf, norms = self._load_matrix()
+        vocabulary, queries = self._query_vectors(features, idf)
+        scores = np.zeros((len(features), self.num_docs), dtype=np.float32)
+
+        # Score rows block by block: gather query weights at each row's features, then sum per row
+        block_nnz = max(1, SCORE_BLOCK_NNZ // max(1, len(features)))
+        start_row = 0
+        while start_row < self.num_docs:
+            end_row = int(np.searchsorted(indptr, indptr[start_row] + block_nnz, side="right")) - 1
+            end_row = min(max(end_row, start_row + 1), self.num_docs)
+            lo, hi = int(indptr[start_row]), int(indptr[end_row])
+            block_indices = np.asarray(indices[lo:hi])
+            weights = np.asarray(data[lo:hi]) * idf[block_indices]
+            products = queries[:, self._query_columns(vocabulary, block_indices)] * weights
+            cumulative = np.zeros((len(features), hi - lo + 1), dtype=np.float64)
+            np.cumsum(products, axis=1, out=cumulative[:, 1:])
+            offsets = np.asarray(indptr[start_row:end_row + 1]) - lo
+            scores[:, start_row:end_row] = cumulative[:, offsets[1:]] - cumulative[:, offsets[:-1]]
+            start_row = end_row
+
+        scores /= np.where(norms > 0, norms, 1).astype(np.float32)
+
+        results = []
+        for i in range(len(features)):
+            row = scores[i]
+            if exclude and exclude[i] in self.doc_index:
+                row[self.doc_index[exclude[i]]] = -1
+            k = min(top_k, self.num_docs)
+            best = np.argpartition(-row, k - 1)[:k]
+            best = best[np.argsort(-row[best], kind="stable")]
+            results.append([(self.docs[j], float(row[j])) for j in best if row[j] > 0])
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search past messages similar to a text or message id")
+    parser.add_argument("--csv", default="telegram_messages.csv", help="Messages CSV to index")
+    parser.add_argument("--index-dir", default=SIMILAR_NEWS_DIR, help="Index directory")
+    parser.add_argument("--update", action="store_true", help="Index new messages from the CSV first")
+    parser.add_argument("--id", action="append", default=[], help="Find messages similar to this message id")
+    parser.add_argument("--text", action="append", default=[], help="Find messages similar to this text")
+    parser.add_argument("--top-k", type=int, default=5, help="Results per query")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    index = SimilarNewsIndex(args.index_dir)
+    if args.update or index.num_docs == 0:
+        index.add_records(iter_csv_records(args.csv))
+
+    queries = [(f"id {doc_id}", r) for doc_id, r in zip(args.id, index.similar_to(args.id, args.top_k))] if args.id else []
+    if args.text:
+        queries += [(f"text {t[:50]!r}", r) for t, r in zip(args.text, index.query(args.text, args.top_k))]
+    for label, results in queries:
+        print(f"\nSimilar to {label}:")
+        for doc, score in results:
+            print(f"  {score:.3f}  {doc['id']}  {doc['date']}  {doc['text'][:100]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Helpers for cutting the tail latency of LLM calls.
+
+JsonStreamScanner finds the end of the first JSON object in a streamed
+response, so the request can be closed as soon as the object is complete
+instead of waiting for the model to finish (closing fences, trailing notes,
+runaway output). LatencyTracker keeps a window of recent times to first chunk
+and decides when a request has waited long enough to be worth hedging: a
+duplicate is sent once a call's first chunk is later than the observed p95,
+as long as the hedges stay within a fixed fraction of all requests.
+"""
+
+import json
+import threading
+from collections import deque
+
+try:
+    from config import HEDGE_PERCENTILE, HEDGE_MAX_FRACTION, HEDGE_MIN_SAMPLES, HEDGE_WINDOW
+except ImportError:
+    HEDGE_PERCENTILE = 95
+    HEDGE_MAX_FRACTION = 0.05
+    HEDGE_MIN_SAMPLES = 20
+    HEDGE_WINDOW = 500
+
+
+class JsonStreamScanner:
+    """
+    Incrementally scans streamed text for the first balanced JSON object.
+    Anything before the opening brace (e.g. a ```json fence) is skipped.
+
+    Usage:
+        scanner = JsonStreamScanner()
+        for delta in stream:
+            if scanner.feed(delta):
+                break
+        scanner.result  # the object's text, or None
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+        self.result = None
+
+    def feed(self, text):
+        """
+        Adds the next piece of the response. A balanced candidate that isn't valid JSON
+        (e.g. "{placeholder}" in a note before the object) is dropped and scanning goes
+        on with the text after it.
+
+        Returns:
+            bool: True once a complete, valid JSON object has been received.
+        """
+        if self.result is not None:
+            return True
+        start = 0
+        if not self.started:
+            start = text.find("{")
+            if start < 0:
+                return False
+            self.started = True
+        i = start
+        while i < len(text):
+            char = text[i]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == "{":
+                self.depth += 1
+            elif char == "}":
+                self.depth -= 1
+                if self.depth == 0:
+                    self.parts.append(text[start:i + 1])
+                    candidate = "".join(self.parts)
+                    try:
+                        json.loads(candidate)
+                    except json.JSONDecodeError:
+                        self._reset()
+                        start = text.find("{", i + 1)
+                        if start < 0:
+                            return False
+                        self.started = True
+                        i = start
+                        continue
+                    self.result = candidate
+                    return True
+            i += 1
+        self.parts.append(text[start:])
+        return False
+
+    def _reset(self):
+        self.parts = []
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escaped = False
+
+
+class LatencyTracker:
+    """
+    Sliding window of call latencies and the hedging budget.
+
+    Parameters:
+        percentile (float): Latency percentile after which a request is hedged.
+        max_fraction (float): Hedged requests allowed as a fraction of all requests.
+        min_samples (int): Latencies needed before the percentile is trusted.
+        window (int): Number of recent latencies kept.
+    """
+
+    def __init__(self, percentile=HEDGE_PERCENTILE, max_fraction=HEDGE_MAX_FRACTION,
+                 min_samples=HEDGE_MIN_SAMPLES, window=HEDGE_WINDOW):
+        self.percentile = percentile
+        self.max_fraction = max_fraction
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=window)
+        self.requests = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def value(self, percentile=None):
+        """The given percentile (default: the hedging percentile) of the window, or None if empty."""
+        with self._lock:
+            ordered = sorted(self.latencies)
+        if not ordered:
+            return None
+        percentile = self.percentile if percentile is None else percentile
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def hedge_delay(self):
+        """
+        Counts a new request and returns how long to wait before hedging it,
+        or None while there are too few samples.
+        """
+        with self._lock:
+            self.requests += 1
+            enough = len(self.latencies) >= self.min_samples
+        return self.value() if enough else None
+
+    def try_hedge(self):
+        """Reserves one hedge if the budget allows it."""
+        with self._lock:
+            if self.hedges + 1 > self.max_fraction * self.requests:
+                return False
+            self.hedges += 1
+            return True
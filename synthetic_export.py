@@ -0,0 +1,232 @@
+"""
+Synthetic Telegram channel exports for benchmarking.
+
+Generates HTML files with the same structure as the real exports in source/
+(page header with the channel title, "message service" date separators,
+"message default clearfix" messages and their "joined" follow-ups, date
+titles, from_name, Persian/English text with hashtags, media wraps and
+reactions), split into messages.html, messages2.html, ... like Telegram does.
+It can also produce the processed CSV directly, including a synthetic 'json'
+column shaped like the llm.py output, so analyse.py can be benchmarked at any
+size without calling the API.
+
+Output is deterministic for a given seed.
+"""
+
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timedelta
+from html import escape
+
+MESSAGES_PER_FILE = 1000
+CHANNEL_TITLE = "@Commodities کامودیتی"
+
+PERSIAN_WORDS = [
+    "قیمت", "سنگ", "آهن", "فولاد", "مس", "طلا", "نفت", "افزایش", "کاهش", "بازار", "چین", "صادرات",
+    "واردات", "تن", "دلار", "هفته", "بندر", "تولید", "تقاضا", "عرضه", "بورس", "کالا", "شمش", "میلگرد",
+    "ورق", "زغال", "کک", "آلومینیوم", "روی", "امروز", "گزارش", "شاخص", "رشد", "معدن", "ایمیدرو", "ذخایر",
+]
+ENGLISH_WORDS = [
+    "Iron Ore", "steel", "price", "China", "export", "LME", "copper", "billet", "rebar", "HRC", "Fed",
+    "inflation", "demand", "supply", "Baltic", "Dalian", "futures", "USD", "tonnes", "week",
+]
+HASHTAGS = ["#سنگ_آهن", "#فولاد", "#مس", "#طلا", "#نفت", "#چین", "#بورس", "#فیلم", "#گزارش"]
+EMOJIS = ["👍", "👎", "🔥", "❤", "🤣", "😢", "👏"]
+
+# Entity names include the alias variants the LLM really produces
+ENTITIES = {
+    "Commodity": ["Iron Ore", "Iron ore", "Steel", "Copper", "Gold", "Crude Oil", "Coking Coal", "Billet"],
+    "Country": ["China", "USA", "United States", "US", "Iran", "India", "Turkey"],
+    "Organization": ["Federal Reserve", "Fed", "LME", "IMIDRO", "World Bank"],
+    "Company": ["Mobarakeh Steel", "Vale", "BHP", "Rio Tinto", "Esfahan Steel"],
+    "Port": ["Bandar Abbas", "Qingdao", "Tianjin"],
+    "Price": ["$100/ton", "$2,000/ounce", "$450/ton"],
+}
+CONTENT_TYPES = ["macro", "industry", "commodity", "news"]
+
+
+def random_text(rng):
+    """Persian-heavy text with some English terms and hashtags, length distributed like the real channel."""
+    length = int(rng.lognormvariate(3.2, 0.9)) + 1
+    words = [rng.choice(ENGLISH_WORDS) if rng.random() < 0.15 else rng.choice(PERSIAN_WORDS) for _ in range(length)]
+    if rng.random() < 0.4:
+        words.insert(0, rng.choice(HASHTAGS))
+    return " ".join(words)
+
+
+def _message_html(rng, message_id, when, joined, from_name):
+    parts = [f'     <div class="message default clearfix{" joined" if joined else ""}" id="message{message_id}">\n']
+    if not joined:
+        parts.append('      <div class="pull_left userpic_wrap">\n'
+                     '       <div class="userpic userpic4" style="width: 42px; height: 42px">\n'
+                     '        <div class="initials" style="line-height: 42px">\n@\n        </div>\n'
+                     '       </div>\n      </div>\n')
+    parts.append('      <div class="body">\n')
+    parts.append(f'       <div class="pull_right date details" title="{when:%d.%m.%Y %H:%M:%S} UTC+03:30">\n'
+                 f'{when:%H:%M}\n       </div>\n')
+    if not joined:
+        parts.append(f'       <div class="from_name">\n{escape(from_name)}\n       </div>\n')
+
+    if rng.random() < 0.4:
+        stamp = f"{message_id}@{when:%d-%m-%Y_%H-%M-%S}"
+        parts.append('       <div class="media_wrap clearfix">\n'
+                     f'        <a class="photo_wrap clearfix pull_left" href="photos/photo_{stamp}.jpg">\n'
+                     f'         <img class="photo" src="photos/photo_{stamp}_thumb.jpg" style="width: 260px; height: 218px"/>\n'
+                     '        </a>\n       </div>\n')
+    if rng.random() < 0.95:
+        text = escape(random_text(rng))
+        parts.append(f'       <div class="text">\n{text}<br><br><a href="https://t.me/Commodities">@Commodities</a>\n'
+                     '       </div>\n')
+    if rng.random() < 0.5:
+        parts.append('       <div class="reactions">\n')
+        for emoji in rng.sample(EMOJIS, rng.randint(1, 4)):
+            parts.append('        <div class="reaction">\n'
+                         f'         <div class="emoji">\n{emoji}\n         </div>\n'
+                         f'         <div class="count">\n{rng.randint(1, 300)}\n         </div>\n'
+                         '        </div>\n')
+        parts.append('       </div>\n')
+    parts.append('      </div>\n     </div>\n')
+    return "".join(parts)
+
+
+def _page_header(title):
+    return ('<!DOCTYPE html>\n<html>\n <head>\n  <meta charset="utf-8"/>\n<title>Exported Data</title>\n'
+            '  <link href="css/style.css" rel="stylesheet"/>\n </head>\n <body>\n  <div class="page_wrap">\n'
+            '   <div class="page_header">\n    <div class="content">\n'
+            f'     <div class="text bold">\n{escape(title)}\n     </div>\n'
+            '    </div>\n   </div>\n   <div class="page_body chat_page">\n    <div class="history">\n')
+
+
+def _page_footer(next_file):
+    link = (f'     <a class="pagination block_link" href="{next_file}">\nNext messages\n     </a>\n'
+            if next_file else "")
+    return f"{link}    </div>\n   </div>\n  </div>\n </body>\n</html>\n"
+
+
+def export_filename(index):
+    """Telegram's naming: messages.html, messages2.html, messages3.html, ..."""
+    return "messages.html" if index == 0 else f"messages{index + 1}.html"
+
+
+def generate_export(output_dir, num_messages, seed=0, messages_per_file=MESSAGES_PER_FILE,
+                    channel_title=CHANNEL_TITLE, start=datetime(2015, 10, 25, 21, 0, 0)):
+    """
+    Writes a synthetic channel export.
+
+    Parameters:
+        output_dir (str): Directory for the HTML files.
+        num_messages (int): Number of "message default" messages to generate.
+        seed (int): Random seed.
+        messages_per_file (int): Messages per HTML file.
+        channel_title (str): Title written into the page header.
+        start (datetime): Date of the first message.
+
+    Returns:
+        list: Paths of the written files, in order.
+    """
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    num_files = max(1, -(-num_messages // messages_per_file))
+    paths = []
+    message_id = 1
+    when = start
+    last_day = None
+    service_id = 1
+    written = 0
+    for file_index in range(num_files):
+        path = os.path.join(output_dir, export_filename(file_index))
+        next_file = export_filename(file_index + 1) if file_index + 1 < num_files else None
+        in_file = min(messages_per_file, num_messages - written)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(_page_header(channel_title))
+            previous = None
+            for _ in range(in_file):
+                when += timedelta(seconds=int(rng.expovariate(1 / 5400)) + 1)
+                if when.date() != last_day:
+                    # Date separators are "message service" entries with their own negative ids
+                    f.write(f'     <div class="message service" id="message-{service_id}">\n'
+                            f'      <div class="body details">\n{when:%d %B %Y}\n      </div>\n     </div>\n')
+                    last_day = when.date()
+                    service_id += 1
+                    previous = None
+                joined = previous is not None and (when - previous).total_seconds() < 3600
+                f.write(_message_html(rng, message_id, when, joined, channel_title))
+                previous = when
+                message_id += 1
+            f.write(_page_footer(next_file))
+        written += in_file
+        paths.append(path)
+    return paths
+
+
+def synthetic_json(rng, text):
+    """An llm.py-style extraction result for a message text."""
+    entities = {}
+    for entity_type in rng.sample(list(ENTITIES), rng.randint(1, 4)):
+        entities[entity_type] = rng.sample(ENTITIES[entity_type], rng.randint(1, 2))
+    hashtags = [word for word in text.split() if word.startswith("#")]
+    subject = " ".join(rng.sample(["steel", "iron ore", "prices", "supply", "demand", "China", "export"], 3))
+    return json.dumps({"type_of_content": rng.choice(CONTENT_TYPES), "entities": entities,
+                       "hashtags": hashtags, "subject": subject}, ensure_ascii=False)
+
+
+def add_synthetic_json(df, seed=0, min_length=100):
+    """
+    Fills the 'json' column of a messages DataFrame the way llm.py would,
+    for every message with text longer than min_length.
+    """
+    rng = random.Random(seed)
+    df["json"] = [synthetic_json(rng, text) if isinstance(text, str) and len(text) > min_length else None
+                  for text in df["text"]]
+    return df
+
+
+def generate_dataframe(num_messages, seed=0, with_json=True):
+    """
+    Builds the processed-messages DataFrame directly (same columns as read_sources.py),
+    without writing and parsing HTML.
+    """
+    import pandas as pd
+
+    rng = random.Random(seed)
+    when = datetime(2015, 10, 25, 21, 0, 0)
+    rows = []
+    for message_id in range(1, num_messages + 1):
+        when += timedelta(seconds=int(rng.expovariate(1 / 5400)) + 1)
+        text = random_text(rng) if rng.random() < 0.95 else None
+        reactions = ({e: rng.randint(1, 300) for e in rng.sample(EMOJIS, rng.randint(1, 4))}
+                     if rng.random() < 0.5 else None)
+        rows.append({
+            "filename": export_filename((message_id - 1) // MESSAGES_PER_FILE),
+            "id": f"message{message_id}",
+            "date": f"{when:%d.%m.%Y}",
+            "time": f"{when:%H:%M:%S}",
+            "from": CHANNEL_TITLE,
+            "text": text,
+            # Stored the way the CSV round trip stores it: a dict literal string
+            "reactions": str(reactions) if reactions else None,
+            "attachment": None,
+        })
+    df = pd.DataFrame(rows)
+    return add_synthetic_json(df, seed) if with_json else df
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic Telegram channel export")
+    parser.add_argument("--messages", type=int, default=10000, help="Number of messages")
+    parser.add_argument("--output-dir", default="synthetic_source", help="Directory for the HTML files")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--csv", help="Also write a processed CSV with a synthetic 'json' column here")
+    args = parser.parse_args()
+
+    paths = generate_export(args.output_dir, args.messages, seed=args.seed)
+    print(f"Wrote {args.messages} messages to {len(paths)} files in {args.output_dir}")
+    if args.csv:
+        generate_dataframe(args.messages, seed=args.seed).to_csv(args.csv, index=False, encoding="utf-8-sig")
+        print(f"Wrote {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
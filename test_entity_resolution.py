@@ -0,0 +1,174 @@
+"""
+Tests of entity_resolution.py: normalization, matching, clustering and the saved mapping.
+
+    python -m pytest test_entity_resolution.py
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import entity_resolution
+from entity_resolution import EntityResolver, is_match, normalize_name
+
+ALIASES = {"Country": [["USA", "US", "United States"]]}
+
+
+class NormalizeTest(unittest.TestCase):
+    def test_punctuation_case_and_legal_forms(self):
+        self.assertEqual(normalize_name("U.S."), "us")
+        self.assertEqual(normalize_name("Iron Ore"), normalize_name("Iron ore"))
+        self.assertEqual(normalize_name("The Esfahan Steel Co."), "esfahan steel")
+        self.assertEqual(normalize_name("  Vale   S.A. "), "vale")
+
+    def test_arabic_letter_forms_become_persian(self):
+        self.assertEqual(normalize_name("كرمان"), "کرمان")
+        self.assertEqual(normalize_name("شرکت فولاد مباركه"), "فولاد مبارکه")
+
+
+class IsMatchTest(unittest.TestCase):
+    def test_latin_and_persian_spellings(self):
+        self.assertTrue(is_match("esfahan", normalize_name("اصفهان")))
+        self.assertTrue(is_match("isfahan", normalize_name("اصفهان")))
+
+    def test_acronym_matches_its_initials(self):
+        self.assertTrue(is_match("us", "united states", acronyms=["us"]))
+        self.assertFalse(is_match("us", "united states"))
+
+    def test_different_companies_with_a_shared_word(self):
+        self.assertFalse(is_match("mobarakeh steel", "esfahan steel"))
+
+    def test_different_numbers_never_match(self):
+        self.assertFalse(is_match(normalize_name("$450/ton"), normalize_name("$460/ton")))
+
+
+class ResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.resolver = EntityResolver(path=None, aliases=ALIASES)
+
+    def test_country_variants_share_one_id(self):
+        self.resolver.update([("Country", "U.S."), ("Country", "USA"), ("Country", "United States")])
+        ids = {self.resolver.canonical_id("Country", name) for name in ("U.S.", "USA", "United States")}
+        self.assertEqual(ids, {"country:united states"})
+
+    def test_city_spellings_across_scripts(self):
+        self.resolver.update([("City", "Esfahan"), ("City", "اصفهان"), ("City", "Isfahan")])
+        self.assertEqual(len({self.resolver.cluster_of("City", name) for name in ("Esfahan", "اصفهان", "Isfahan")}), 1)
+
+    def test_steel_companies_stay_apart(self):
+        self.resolver.update([("Company", "Mobarakeh Steel"), ("Company", "Esfahan Steel"),
+                              ("Company", "Esfahan Steel Co.")])
+        self.assertNotEqual(self.resolver.cluster_of("Company", "Mobarakeh Steel"),
+                            self.resolver.cluster_of("Company", "Esfahan Steel"))
+        self.assertEqual(self.resolver.cluster_of("Company", "Esfahan Steel"),
+                         self.resolver.cluster_of("Company", "Esfahan Steel Co."))
+
+    def test_entity_types_are_resolved_separately(self):
+        self.resolver.update([("City", "Esfahan"), ("Province", "Esfahan")])
+        self.assertNotEqual(self.resolver.cluster_of("City", "Esfahan"), self.resolver.cluster_of("Province", "Esfahan"))
+
+    def test_bridging_variant_merges_into_the_most_mentioned_cluster(self):
+        # "Maobarakeh" and "Mbarakeh" don't match each other, "Mobaarakeh" matches both
+        self.resolver.update([("Company", "Mbarakeh")] * 3 + [("Company", "Maobarakeh")])
+        self.assertNotEqual(self.resolver.cluster_of("Company", "Mbarakeh"),
+                            self.resolver.cluster_of("Company", "Maobarakeh"))
+        stats = self.resolver.update([("Company", "Mobaarakeh")])
+        self.assertEqual(stats["merged_clusters"], 1)
+        for name in ("Mbarakeh", "Maobarakeh", "Mobaarakeh"):
+            self.assertEqual(self.resolver.cluster_of("Company", name), "company:mbarakeh")
+        self.assertEqual(len(self.resolver.clusters), 1)
+
+
+class SavedMappingTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.path = os.path.join(self.folder, "entity_map.sqlite")
+
+    def open_resolver(self):
+        resolver = EntityResolver(self.path, aliases=ALIASES)
+        self.addCleanup(resolver.close)
+        return resolver
+
+    def snapshot(self):
+        resolver = self.open_resolver()
+        snapshot = (dict(resolver.variants), dict(resolver.clusters), dict(resolver.type_names))
+        resolver.close()
+        return snapshot
+
+    def test_save_and_load_round_trip(self):
+        resolver = self.open_resolver()
+        resolver.update([("Country", "USA"), ("Country", "USA"), ("City", "Esfahan"), ("City", "اصفهان")])
+        resolver.save()
+        expected = (dict(resolver.variants), dict(resolver.clusters), dict(resolver.type_names))
+        resolver.close()
+        self.assertEqual(self.snapshot(), expected)
+
+    def test_incremental_update_after_reload(self):
+        resolver = self.open_resolver()
+        resolver.update([("City", "Esfahan")] * 2)
+        resolver.save()
+        resolver.close()
+
+        resolver = self.open_resolver()
+        stats = resolver.update([("City", "Isfahan"), ("City", "Esfahan")])
+        resolver.save()
+        resolver.close()
+        self.assertEqual(stats["new_variants"], 1)
+        self.assertEqual(stats["new_clusters"], 0)
+        variants, clusters, _ = self.snapshot()
+        self.assertEqual(variants[("city", "esfahan")][1:], ["city:esfahan", 3])
+        self.assertEqual(variants[("city", "isfahan")][1:], ["city:esfahan", 1])
+        self.assertEqual(list(clusters), ["city:esfahan"])
+
+    def test_merged_cluster_is_removed_from_the_file(self):
+        resolver = self.open_resolver()
+        resolver.update([("Company", "Mbarakeh")] * 3 + [("Company", "Maobarakeh")])
+        resolver.save()
+        resolver.update([("Company", "Mobaarakeh")])
+        resolver.save()
+        resolver.close()
+        variants, clusters, _ = self.snapshot()
+        self.assertEqual(list(clusters), ["company:mbarakeh"])
+        self.assertEqual({entry[1] for entry in variants.values()}, {"company:mbarakeh"})
+
+
+class ResolveFilesTest(unittest.TestCase):
+    def setUp(self):
+        import pandas as pd
+
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.path = os.path.join(self.folder, "entity_map.sqlite")
+        self.history = os.path.join(self.folder, "history.csv")
+        self.batch = os.path.join(self.folder, "batch.csv")
+        self.addCleanup(entity_resolution.load_resolver.cache_clear)
+        extraction = {"entities": {"Country": ["USA", "United States"], "City": ["Esfahan"]}}
+        pd.DataFrame({"id": [1, 2, 3], "json": [json.dumps(extraction)] * 2 + [None]}).to_csv(
+            self.history, index=False)
+        pd.DataFrame({"id": [4], "json": [json.dumps({"entities": {"City": ["Isfahan"]}})]}).to_csv(
+            self.batch, index=False)
+
+    def mentions(self):
+        resolver = EntityResolver(self.path)
+        counts = {variant: entry[2] for (_, variant), entry in resolver.variants.items()}
+        resolver.close()
+        return counts
+
+    def test_recount_of_the_same_history_keeps_the_counts(self):
+        entity_resolution.resolve_files([self.history], self.path, recount=True)
+        first = self.mentions()
+        entity_resolution.resolve_files([self.history], self.path, recount=True)
+        self.assertEqual(self.mentions(), first)
+        self.assertEqual(first, {"usa": 2, "united states": 2, "esfahan": 2})
+
+    def test_update_adds_the_counts_of_a_new_batch(self):
+        entity_resolution.resolve_files([self.history], self.path)
+        entity_resolution.resolve_files([self.batch], self.path)
+        self.assertEqual(self.mentions(), {"usa": 2, "united states": 2, "esfahan": 2, "isfahan": 1})
+
+
+if __name__ == "__main__":
+    unittest.main()
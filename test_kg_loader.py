@@ -0,0 +1,135 @@
+"""
+Tests of kg_loader.py against a stub driver, no Neo4j server needed.
+
+    python -m pytest test_kg_loader.py
+"""
+
+import json
+import os
+import tempfile
+import unittest
+
+import kg_loader
+
+
+class RecordingTransaction:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def run(self, query, **parameters):
+        self.calls.append((query, parameters))
+
+
+class RecordingSession:
+    """Session stub: records schema statements and every execute_write with the queries it ran."""
+
+    def __init__(self, log):
+        self.log = log
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def run(self, statement, **parameters):
+        self.log.append(("run", statement))
+        return self
+
+    def consume(self):
+        return None
+
+    def execute_write(self, work, *args):
+        calls = []
+        result = work(RecordingTransaction(calls), *args)
+        self.log.append(("execute_write", calls))
+        return result
+
+
+class RecordingDriver:
+    def __init__(self):
+        self.log = []
+        self.databases = []
+
+    def session(self, database=None):
+        self.databases.append(database)
+        return RecordingSession(self.log)
+
+    def writes(self):
+        return [calls for kind, calls in self.log if kind == "execute_write"]
+
+
+def make_record(i):
+    extraction = {
+        "type_of_content": "news",
+        "entities": {"Commodity": ["Steel", "Iron Ore"], "Country": ["China"]},
+        "hashtags": ["#steel"],
+        "subject": f"subject {i}",
+    }
+    return {"id": f"message{i}", "date": "01.05.2024", "time": "10:00:00", "text": f"text {i}",
+            "reactions": None, "json": json.dumps(extraction)}
+
+
+def message_batches(driver):
+    """Number of messages in each write transaction."""
+    return [len(parameters["rows"]) for calls in driver.writes()
+            for query, parameters in calls if query == kg_loader.MERGE_MESSAGES]
+
+
+class LoadRecordsTest(unittest.TestCase):
+    def test_batches_have_batch_size_messages(self):
+        driver = RecordingDriver()
+        written = kg_loader.load_records(driver, (make_record(i) for i in range(25)), batch_size=10)
+        self.assertEqual(written, 25)
+        self.assertEqual(message_batches(driver), [10, 10, 5])
+
+    def test_nodes_are_merged_before_relationships(self):
+        driver = RecordingDriver()
+        kg_loader.load_records(driver, [make_record(i) for i in range(3)], batch_size=10)
+        (calls,) = driver.writes()
+        queries = [query for query, _ in calls]
+        self.assertEqual(queries, [kg_loader.MERGE_MESSAGES, kg_loader.MERGE_ENTITIES, kg_loader.MERGE_HASHTAGS,
+                                   kg_loader.MERGE_CONTENT_TYPES, kg_loader.MERGE_MENTIONS,
+                                   kg_loader.MERGE_TAGGED, kg_loader.MERGE_HAS_CONTENT_TYPE])
+        parameters = dict(calls)
+        self.assertEqual(len(parameters[kg_loader.MERGE_ENTITIES]["rows"]), 3)
+        self.assertEqual(len(parameters[kg_loader.MERGE_MENTIONS]["rows"]), 9)
+
+    def test_records_without_extraction_are_skipped(self):
+        driver = RecordingDriver()
+        records = [make_record(0), dict(make_record(1), json=None), dict(make_record(2), json="not json")]
+        self.assertEqual(kg_loader.load_records(driver, records, batch_size=10), 1)
+        self.assertEqual(message_batches(driver), [1])
+
+
+class LoadCsvTest(unittest.TestCase):
+    def setUp(self):
+        import pandas as pd
+
+        handle, self.csv_file = tempfile.mkstemp(suffix=".csv")
+        os.close(handle)
+        pd.DataFrame([make_record(i) for i in range(7)]).to_csv(self.csv_file, index=False, encoding="utf-8-sig")
+
+    def tearDown(self):
+        os.remove(self.csv_file)
+
+    def test_schema_is_created_before_any_write(self):
+        driver = RecordingDriver()
+        kg_loader.load_csv(self.csv_file, driver=driver, batch_size=3, database="graph")
+        kinds = [kind for kind, _ in driver.log]
+        schema_count = len(kg_loader.SCHEMA_STATEMENTS)
+        self.assertEqual(kinds[:schema_count], ["run"] * schema_count)
+        self.assertEqual([statement for _, statement in driver.log[:schema_count]], kg_loader.SCHEMA_STATEMENTS)
+        self.assertNotIn("run", kinds[schema_count:])
+        self.assertEqual(message_batches(driver), [3, 3, 1])
+        self.assertEqual(set(driver.databases), {"graph"})
+
+    def test_rerun_writes_the_same_merges(self):
+        first, second = RecordingDriver(), RecordingDriver()
+        kg_loader.load_csv(self.csv_file, driver=first, batch_size=3)
+        kg_loader.load_csv(self.csv_file, driver=second, batch_size=3)
+        self.assertEqual(first.log, second.log)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+"""
+Tests of the priority score in scheduler.py.
+
+    python -m pytest test_scheduler.py
+"""
+
+import unittest
+
+import scheduler
+
+
+def make_record(reactions):
+    return {"id": "message1", "date": "01.05.2024", "time": "10:00:00",
+            "text": "Iron ore futures in Dalian rose for a third session " * 3, "reactions": reactions}
+
+
+class PriorityTest(unittest.TestCase):
+    def test_reactions_dict_and_csv_string_score_the_same(self):
+        # watcher.py enqueues the dicts parse_html_file returns, enqueue_csv the strings read back from the CSV
+        reactions = {"👍": 1, "👎": 1}
+        self.assertEqual(scheduler.priority(make_record(reactions)), scheduler.priority(make_record(str(reactions))))
+
+    def test_reactions_raise_the_priority(self):
+        self.assertGreater(scheduler.priority(make_record({"👍": 1, "👎": 1})), scheduler.priority(make_record(None)))
+
+    def test_missing_or_invalid_reactions_count_as_none(self):
+        baseline = scheduler.priority(make_record(None))
+        self.assertEqual(scheduler.priority(make_record("not a dict")), baseline)
+        self.assertEqual(scheduler.priority(make_record(float("nan"))), baseline)
+
+
+if __name__ == "__main__":
+    unittest.main()
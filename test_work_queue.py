@@ -0,0 +1,153 @@
+"""
+Tests of the lease rules of work_queue.py on a temporary queue, no API calls.
+
+    python -m pytest test_work_queue.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from work_queue import WorkQueue
+
+
+def make_records(n):
+    return [{"id": f"message{i}", "date": "01.05.2024", "time": f"10:{i % 60:02d}:00",
+             "text": f"Steel billet prices in Tehran rose again, report {i}. " * 3} for i in range(n)]
+
+
+class QueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.path = os.path.join(self.folder, "queue.sqlite")
+        self.csv_file = os.path.join(self.folder, "messages.csv")
+        self.queue = self.open_queue()
+        self.queue.enqueue_records(self.csv_file, make_records(6))
+
+    def open_queue(self, lease_seconds=60):
+        """A connection to the queue file, like the one each worker process opens."""
+        queue = WorkQueue(self.path, lease_seconds=lease_seconds)
+        self.addCleanup(queue.close)
+        return queue
+
+    def statuses(self):
+        return self.queue.stats()["messages.csv"]
+
+
+class ClaimTest(QueueTestCase):
+    def test_two_workers_claim_disjoint_rows(self):
+        first = self.queue.claim("worker-a", limit=4)
+        second = self.open_queue().claim("worker-b", limit=4)
+        first_ids = {message_id for _, message_id, _, _ in first}
+        second_ids = {message_id for _, message_id, _, _ in second}
+        self.assertEqual(len(first_ids), 4)
+        self.assertEqual(len(second_ids), 2)
+        self.assertFalse(first_ids & second_ids)
+        self.assertEqual(self.queue.claim("worker-c"), [])
+
+    def test_expired_lease_is_claimed_again(self):
+        # A negative lease expires as soon as it is taken, like a worker that crashed
+        crashed = self.open_queue(lease_seconds=-1).claim("worker-a", limit=6)
+        reclaimed = self.queue.claim("worker-b", limit=6)
+        self.assertEqual(sorted(reclaimed), sorted(crashed))
+
+    def test_live_lease_is_not_claimed_again(self):
+        self.queue.claim("worker-a", limit=6)
+        self.assertEqual(self.open_queue().claim("worker-b", limit=6), [])
+
+    def test_heartbeat_only_extends_own_leases(self):
+        keys = [(source, message_id) for source, message_id, _, _ in
+                self.open_queue(lease_seconds=-1).claim("worker-a", limit=2)]
+        self.assertEqual(self.queue.heartbeat("worker-b", keys), 0)
+        self.assertEqual(self.queue.heartbeat("worker-a", keys), 2)
+        # Extended to the full lease, so nobody can reclaim them now
+        self.assertEqual(len(self.queue.claim("worker-b", limit=6)), 4)
+
+    def test_row_abandoned_max_attempts_times_fails(self):
+        crashing = self.open_queue(lease_seconds=-1)
+        for attempt in range(3):
+            self.assertEqual(len(crashing.claim(f"worker-{attempt}", limit=6, max_attempts=3)), 6)
+        self.assertEqual(self.queue.claim("worker-d", limit=6, max_attempts=3), [])
+        self.assertEqual(self.statuses(), {"failed": 6})
+        self.assertEqual(self.queue.retry_failed(), 6)
+        self.assertEqual(len(self.queue.claim("worker-d", limit=6, max_attempts=3)), 6)
+
+
+class CompleteTest(QueueTestCase):
+    def test_complete_needs_the_lease(self):
+        (source, message_id, _, _), = self.queue.claim("worker-a", limit=1)
+        self.assertFalse(self.queue.complete("worker-b", source, message_id, '{"entities": {}}'))
+        self.assertTrue(self.queue.complete("worker-a", source, message_id, '{"entities": {}}'))
+        self.assertFalse(self.queue.complete("worker-a", source, message_id, '{"entities": {}}'))
+        self.assertEqual(self.statuses(), {"done": 1, "pending": 5})
+
+    def test_late_worker_cannot_overwrite_reclaimed_row(self):
+        (source, message_id, _, _), = self.open_queue(lease_seconds=-1).claim("worker-a", limit=1)
+        self.queue.claim("worker-b", limit=6)
+        self.assertFalse(self.queue.complete("worker-a", source, message_id, '{"late": true}'))
+        self.assertTrue(self.queue.complete("worker-b", source, message_id, '{"entities": {}}'))
+
+    def test_release_needs_the_lease(self):
+        (source, message_id, _, _), = self.queue.claim("worker-a", limit=1)
+        self.queue.release("worker-b", source, message_id)
+        self.assertEqual(self.statuses(), {"leased": 1, "pending": 5})
+        self.queue.release("worker-a", source, message_id)
+        self.assertEqual(self.statuses(), {"pending": 6})
+
+    def test_release_fails_row_after_max_attempts(self):
+        for attempt in range(2):
+            (source, message_id, _, _), = self.queue.claim("worker-a", limit=1)
+            self.queue.release("worker-a", source, message_id, max_attempts=2)
+        self.assertEqual(self.statuses(), {"failed": 1, "pending": 5})
+
+
+class ApplyTest(QueueTestCase):
+    def setUp(self):
+        import pandas as pd
+        import metrics
+
+        # apply_results traces its writes; keep the trace out of the working directory
+        metrics.configure(enabled=False)
+        self.addCleanup(metrics.configure, enabled=metrics.METRICS_ENABLED)
+        super().setUp()
+        df = pd.DataFrame(make_records(6))
+        df["json"] = None
+        df.to_csv(self.csv_file, index=False, encoding="utf-8-sig")
+
+    def test_results_are_written_into_the_csv_once(self):
+        from llm import read_csv
+
+        claimed = self.queue.claim("worker-a", limit=2)
+        for source, message_id, _, _ in claimed:
+            self.queue.complete("worker-a", source, message_id, f'{{"subject": "{message_id}"}}')
+        applied = {}
+        self.assertEqual(self.queue.apply_results(on_applied=lambda csv_file, results: applied.update(results)), 2)
+        self.assertEqual(sorted(applied), sorted(message_id for _, message_id, _, _ in claimed))
+
+        df = read_csv(self.csv_file)
+        written = df[df["json"].map(lambda value: isinstance(value, str))]
+        self.assertEqual(len(written), 2)
+        for message_id, value in zip(written["id"], written["json"]):
+            self.assertEqual(value, f'{{"subject": "{message_id}"}}')
+        self.assertEqual(self.statuses(), {"applied": 2, "pending": 4})
+        # No temporary file is left behind, and applying again writes nothing
+        self.assertEqual(sorted(os.listdir(self.folder)), ["messages.csv", "queue.sqlite"])
+        self.assertEqual(self.queue.apply_results(), 0)
+
+    def test_apply_keeps_results_already_in_the_csv(self):
+        from llm import read_csv
+
+        (source, message_id, _, _), = self.queue.claim("worker-a", limit=1)
+        df = read_csv(self.csv_file)
+        df.loc[df["id"] == message_id, "json"] = '{"subject": "earlier"}'
+        df.to_csv(self.csv_file, index=False, encoding="utf-8-sig")
+        self.queue.complete("worker-a", source, message_id, '{"subject": "later"}')
+        self.assertEqual(self.queue.apply_results(), 0)
+        df = read_csv(self.csv_file)
+        self.assertEqual(df.loc[df["id"] == message_id, "json"].item(), '{"subject": "earlier"}')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,411 @@
+"""
+Watch mode: continuous ingestion and enrichment.
+
+    python watcher.py --source exports --partitions partitions --workers 2
+    python main.py --source exports --partitions partitions watch    # same thing
+
+Instead of running read_sources.py, llm.py and analyse.py by hand, each
+rereading everything, the daemon:
+
+  1. waits for changes under the export root (inotify on Linux, polling
+     elsewhere or with --poll);
+  2. parses only export files whose size or mtime changed, adds the messages
+     that aren't stored yet to their channel/month partition and pushes them
+     straight into the work queue;
+  3. runs extraction workers (work_queue.run_worker) that take the new rows,
+     highest priority first; workers on other hosts can share the queue;
+  4. every second, writes finished results into the partitions and updates
+     the report aggregates with just the new results.
+
+The file signatures are checkpointed in WATCH_STATE_FILE after each ingest.
+Writing a partition and queueing rows are idempotent (rows are matched by
+message id), so export files may settle in any order (rsync copying
+messages10.html before messages2.html), and a crash between the two steps
+and the checkpoint only repeats work. SIGINT/SIGTERM
+stop the daemon gracefully: workers finish their current batch, the last
+results are applied and the checkpoint is saved.
+
+While the daemon runs it is the only writer of the partitions; don't run
+read_sources.py or `work_queue.py apply` on the same folder at the same time.
+"""
+
+import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import io
+import json
+import logging
+import multiprocessing
+import os
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+
+try:
+    from config import (WATCH_STATE_FILE, WATCH_POLL_INTERVAL, WATCH_SETTLE_SECONDS, WATCH_APPLY_INTERVAL,
+                        WATCH_WORKERS, WATCH_SHUTDOWN_TIMEOUT, PARTITIONS_DIR, REPORT_DIR, WORK_QUEUE_PATH)
+except ImportError:
+    WATCH_STATE_FILE = ".watch_state.json"
+    WATCH_POLL_INTERVAL = 2.0
+    WATCH_SETTLE_SECONDS = 1.0
+    WATCH_APPLY_INTERVAL = 1.0
+    WATCH_WORKERS = 1
+    WATCH_SHUTDOWN_TIMEOUT = 120
+    PARTITIONS_DIR = "partitions"
+    REPORT_DIR = "reports"
+    WORK_QUEUE_PATH = "work_queue.sqlite"
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+class InotifyWatcher:
+    """
+    Wakes up on file system events under root, using Linux inotify through ctypes.
+    New subdirectories (a new channel export) are watched as they appear.
+    """
+
+    def __init__(self, root):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        self._watch_tree(root)
+
+    def _watch_tree(self, root):
+        for folder, _, _ in os.walk(root):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {folder}")
+            self.watches[wd] = folder
+
+    def wait(self, timeout):
+        """
+        Blocks until something changed or timeout seconds passed.
+
+        Returns:
+            bool: True if there were events.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in self.watches:
+                self._watch_tree(os.path.join(self.watches[wd], name))
+            if mask & IN_Q_OVERFLOW:
+                logger.warning("inotify queue overflowed, rescanning")
+        # Events only trigger a scan, which compares file signatures, so lost events can't lose files
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    """Fallback for systems without inotify: reports a change every interval seconds."""
+
+    def __init__(self, interval=WATCH_POLL_INTERVAL):
+        self.interval = interval
+        self.last_poll = 0.0
+
+    def wait(self, timeout):
+        remaining = self.last_poll + self.interval - time.time()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return False
+        time.sleep(max(0.0, remaining))
+        self.last_poll = time.time()
+        return True
+
+    def close(self):
+        pass
+
+
+def make_watcher(root, poll=False, poll_interval=WATCH_POLL_INTERVAL):
+    """inotify where available, polling otherwise (or when poll is True)."""
+    if not poll and sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify unavailable ({e}), polling every {poll_interval}s")
+    return PollingWatcher(poll_interval)
+
+
+def _watch_worker(queue_path, stop):
+    """Extraction worker process of the daemon; stops after its current batch when stop is set."""
+    from llm import setup_logging
+    from work_queue import run_worker
+
+    setup_logging()
+    # Ctrl-C reaches the whole process group; the daemon decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    run_worker(queue_path, poll_interval=0.5, stop=stop)
+
+
+class WatchDaemon:
+    """
+    Parameters:
+        source_root (str): Folder containing the channel exports.
+        partitions_root (str): Partitioned storage (see read_sources.ingest_channels).
+        queue_path (str): Work queue database.
+        report_path (str): Text report kept up to date.
+        state_file (str): Checkpoint file.
+        workers (int): Extraction worker processes to run (0 when workers run elsewhere).
+        poll (bool): Use polling instead of inotify.
+    """
+
+    def __init__(self, source_root, partitions_root=PARTITIONS_DIR, queue_path=WORK_QUEUE_PATH,
+                 report_path=os.path.join(REPORT_DIR, "analysis.txt"), state_file=WATCH_STATE_FILE,
+                 workers=WATCH_WORKERS, poll=False):
+        self.source_root = source_root
+        self.partitions_root = partitions_root
+        self.queue_path = queue_path
+        self.report_path = report_path
+        self.state_file = state_file
+        self.workers = workers
+        self.poll = poll
+        self.stop = threading.Event()
+        self.state = self.load_state()
+        self.titles = {}
+        self.unsettled = False
+        self.aggregates = None
+
+    def load_state(self):
+        if not os.path.exists(self.state_file):
+            return {"files": {}}
+        with open(self.state_file, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_state(self):
+        tmp_path = self.state_file + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.state_file)
+
+    def _title(self, folder):
+        from read_sources import read_channel_title
+
+        if folder not in self.titles:
+            self.titles[folder] = read_channel_title(os.path.join(folder, "messages.html")) or os.path.basename(folder)
+        return self.titles[folder]
+
+    def scan(self):
+        """
+        Export files that changed since the checkpoint and haven't been written to for
+        WATCH_SETTLE_SECONDS (so half-written files are left for the next scan).
+
+        Returns:
+            list: (channel title, file path, filename, signature) tuples in message order.
+        """
+        from read_sources import list_export_files
+
+        changed = []
+        self.unsettled = False
+        now = time.time()
+        for folder, dirs, files in os.walk(os.path.abspath(self.source_root)):
+            dirs.sort()
+            if "messages.html" not in files:
+                continue
+            for filename in list_export_files(folder):
+                path = os.path.join(folder, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                signature = [stat.st_size, stat.st_mtime_ns]
+                if self.state["files"].get(path) == signature:
+                    continue
+                if now - stat.st_mtime < WATCH_SETTLE_SECONDS:
+                    self.unsettled = True
+                    continue
+                changed.append((self._title(folder), path, filename, signature))
+        return changed
+
+    def ingest(self, changed):
+        """
+        Parses the changed files and stores and queues the messages that are new.
+
+        Returns:
+            int: Number of new messages.
+        """
+        import pandas as pd
+        from analyse import date_to_month
+        from metrics import span
+        from read_sources import COLUMNS, parse_html_file, partition_path
+        from work_queue import WorkQueue
+
+        new_by_channel = {}
+        with span("watch_parse", files=len(changed)):
+            for title, path, filename, _ in changed:
+                # Old messages are dropped by id when the partition is written, not here:
+                # the files of an export don't necessarily settle in message order
+                new_by_channel.setdefault(title, []).extend(parse_html_file(path, filename))
+
+        total = 0
+        queue = WorkQueue(self.queue_path)
+        try:
+            for title, messages in new_by_channel.items():
+                if not messages:
+                    continue
+                df = pd.DataFrame(messages)[COLUMNS]
+                df.insert(0, "channel", title)
+                df["json"] = None
+                months = df["date"].map(date_to_month).fillna("unknown")
+                for month, part in df.groupby(months, sort=True):
+                    path = partition_path(self.partitions_root, title, month)
+                    part = self._append_partition(path, part)
+                    queue.enqueue_records(path, part.to_dict("records"))
+                    total += len(part)
+        finally:
+            queue.close()
+
+        for _, path, _, signature in changed:
+            self.state["files"][path] = signature
+        self.save_state()
+        if total:
+            logger.info(f"Ingested {total} new messages from {len(changed)} files")
+        return total
+
+    def _append_partition(self, path, part):
+        """
+        Adds rows to a partition file (atomically) and returns the rows that were really new.
+        """
+        import pandas as pd
+        from llm import read_csv
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            existing = read_csv(path)
+            part = part[~part["id"].isin(set(existing["id"]))]
+            if part.empty:
+                return part
+            combined = pd.concat([existing, part], ignore_index=True)
+        else:
+            combined = part
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        combined.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+        os.replace(tmp_path, path)
+        return part
+
+    def _on_applied(self, csv_file, results):
+        """Folds freshly applied results into the report aggregates."""
+        import pandas as pd
+        from analyse import analyze_frame, merge_results
+
+        batch = analyze_frame(pd.DataFrame({"json": list(results.values())}))
+        self.aggregates = merge_results([self.aggregates, batch])
+
+    def write_report(self):
+        from analyse import print_report
+
+        a = self.aggregates
+        buffer = io.StringIO()
+        with contextlib.redirect_stdout(buffer):
+            print_report(a["content_types"], a["entity_keys"], len(a["entity_values"]), a["hashtags"],
+                         a["entity_pairs"])
+        os.makedirs(os.path.dirname(self.report_path) or ".", exist_ok=True)
+        tmp_path = self.report_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, self.report_path)
+
+    def _handle_signal(self, signum, frame):
+        logger.info(f"Received signal {signum}, shutting down after the current step")
+        self.stop.set()
+
+    def run(self):
+        """Runs until SIGINT/SIGTERM."""
+        from analyse import analyze_partitions, merge_results
+        from read_sources import list_partitions
+        from work_queue import WorkQueue
+
+        os.makedirs(self.source_root, exist_ok=True)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+
+        # Full aggregates once at startup; from then on only new results are added
+        partitions = list_partitions(self.partitions_root) if os.path.isdir(self.partitions_root) else []
+        self.aggregates = analyze_partitions(partitions) if partitions else merge_results([])
+        self.write_report()
+
+        worker_stop = multiprocessing.Event()
+        processes = [multiprocessing.Process(target=_watch_worker, args=(self.queue_path, worker_stop),
+                                             name=f"watch-worker-{i}") for i in range(self.workers)]
+        for process in processes:
+            process.start()
+
+        watcher = make_watcher(self.source_root, self.poll)
+        queue = WorkQueue(self.queue_path)
+        logger.info(f"Watching {self.source_root} with {type(watcher).__name__}, {self.workers} workers")
+        try:
+            changed = True  # Catch up on whatever changed while the daemon wasn't running
+            while not self.stop.is_set():
+                if changed or self.unsettled:
+                    files = self.scan()
+                    if files:
+                        self.ingest(files)
+                if queue.apply_results(self._on_applied):
+                    self.write_report()
+                changed = watcher.wait(WATCH_APPLY_INTERVAL)
+        finally:
+            worker_stop.set()
+            deadline = time.time() + WATCH_SHUTDOWN_TIMEOUT
+            for process in processes:
+                process.join(max(0.0, deadline - time.time()))
+                if process.is_alive():
+                    # SIGTERM would only set worker_stop again (see _watch_worker), which a worker
+                    # stuck in an API call never checks. Its leases expire and the rows are
+                    # claimed again next time
+                    logger.warning(f"{process.name} didn't finish in time, killing it")
+                    process.kill()
+                    process.join()
+            if queue.apply_results(self._on_applied):
+                self.write_report()
+            queue.close()
+            watcher.close()
+            self.save_state()
+            logger.info("Stopped")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Watch export folders and keep partitions, extraction and report up to date")
+    parser.add_argument("--source", default="source", help="Folder containing the channel exports")
+    parser.add_argument("--partitions", default=PARTITIONS_DIR, help="Partitioned storage root")
+    parser.add_argument("--queue", default=WORK_QUEUE_PATH, help="Work queue database")
+    parser.add_argument("--report", default=os.path.join(REPORT_DIR, "analysis.txt"), help="Report kept up to date")
+    parser.add_argument("--state", default=WATCH_STATE_FILE, help="Checkpoint file")
+    parser.add_argument("--workers", type=int, default=WATCH_WORKERS,
+                        help="Extraction worker processes (0 if workers run elsewhere)")
+    parser.add_argument("--poll", action="store_true", help="Poll instead of using inotify")
+    args = parser.parse_args(argv)
+
+    from llm import setup_logging
+    setup_logging()
+    WatchDaemon(args.source, args.partitions, args.queue, args.report, args.state, args.workers, args.poll).run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
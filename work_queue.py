@@ -0,0 +1,569 @@
+"""
+Lease-based work queue for LLM extraction shared by many worker processes.
+
+process_optimized/process_async_optimized assume a single process owns the CSV:
+two of them at once extract the same rows and overwrite each other's saves.
+Here the pending rows are copied into a SQLite queue instead, and workers
+(processes on this host, or on other hosts that mount the same folder) claim
+disjoint batches under a lease:
+
+    python work_queue.py enqueue --csv telegram_messages.csv
+    python work_queue.py work --processes 4                       # on any number of machines
+    python work_queue.py work --api-key-env OPENAI_API_KEY_2      # a second key, second quota
+    python work_queue.py apply                                    # write results into the CSVs
+    python work_queue.py status
+
+A claim marks rows as leased to the worker until lease_expires; the worker
+extends the lease with heartbeats while its API calls run. Rows whose lease
+ran out (the worker crashed or was killed) are claimed again by the next
+worker. Results are committed to the queue row by row, and only by the worker
+that still holds the lease, so a late worker can't overwrite a newer result.
+The CSVs are only rewritten by apply, atomically (temporary file + rename).
+
+Leases use wall-clock time, so hosts sharing a queue need roughly synchronized
+clocks (well within WORK_QUEUE_LEASE_SECONDS).
+
+Sharing the queue between hosts relies on SQLite's file locking (POSIX byte-range
+locks), which many NFS and SMB/CIFS setups implement incompletely or not at all:
+locks silently succeed, two workers can claim the same rows and the database can
+be corrupted. Only share it on a network filesystem whose locking works (e.g.
+NFSv4 with locking enabled, not mounted with nolock/local_lock); otherwise keep
+the queue on a local disk and run all workers on that host.
+"""
+
+import argparse
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+try:
+    from config import (WORK_QUEUE_PATH, WORK_QUEUE_LEASE_SECONDS, WORK_QUEUE_CLAIM_SIZE,
+                        WORK_QUEUE_JOURNAL_MODE, MAX_WORKERS, MAX_RETRIES)
+except ImportError:
+    WORK_QUEUE_PATH = "work_queue.sqlite"
+    WORK_QUEUE_LEASE_SECONDS = 120
+    WORK_QUEUE_CLAIM_SIZE = 10
+    WORK_QUEUE_JOURNAL_MODE = "DELETE"
+    MAX_WORKERS = 3
+    MAX_RETRIES = 3
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+APPLIED = "applied"  # done and written into the CSV
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    source TEXT NOT NULL,           -- CSV file, relative to the queue's folder
+    message_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    priority REAL NOT NULL DEFAULT 0,  -- scheduler.priority(), claimed highest first
+    tokens INTEGER NOT NULL DEFAULT 0,  -- scheduler.estimate_tokens()
+    status TEXT NOT NULL DEFAULT 'pending',
+    lease_owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT,
+    updated REAL,
+    PRIMARY KEY (source, message_id)
+);
+CREATE INDEX IF NOT EXISTS tasks_claimable ON tasks (status, priority);
+CREATE INDEX IF NOT EXISTS tasks_expiring ON tasks (status, lease_expires);
+"""
+
+
+def worker_name():
+    """Unique name of this worker process across hosts: hostname:pid."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class WorkQueue:
+    """
+    SQLite-backed queue of rows waiting for extraction.
+
+    Every method opens its own short transaction, so any number of processes can
+    use the same file. Claims run under BEGIN IMMEDIATE, which takes SQLite's write
+    lock before reading, so two workers can never claim the same row.
+    """
+
+    def __init__(self, path=WORK_QUEUE_PATH, lease_seconds=WORK_QUEUE_LEASE_SECONDS,
+                 journal_mode=WORK_QUEUE_JOURNAL_MODE):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.base_dir = os.path.dirname(os.path.abspath(path))
+        # Autocommit mode: transactions are opened explicitly where they are needed
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        # WAL is faster but needs shared memory, so it only works when all workers are on one host
+        self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self._migrate()
+        self.conn.executescript(SCHEMA)
+
+    def _migrate(self):
+        """Adds the scheduling columns to queues created before they existed."""
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(tasks)")}
+        if columns and "priority" not in columns:
+            self.conn.execute("DROP INDEX IF EXISTS tasks_claimable")
+            self.conn.execute("ALTER TABLE tasks ADD COLUMN priority REAL NOT NULL DEFAULT 0")
+            self.conn.execute("ALTER TABLE tasks ADD COLUMN tokens INTEGER NOT NULL DEFAULT 0")
+
+    def close(self):
+        self.conn.close()
+
+    def _source_key(self, csv_file):
+        return os.path.relpath(os.path.abspath(csv_file), self.base_dir)
+
+    def _source_path(self, source):
+        return os.path.join(self.base_dir, source)
+
+    def _transaction(self, statements):
+        """Runs statements(cursor) inside BEGIN IMMEDIATE ... COMMIT and returns its result."""
+        with self._lock:
+            cursor = self.conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(cursor)
+                cursor.execute("COMMIT")
+                return result
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+
+    def enqueue_csv(self, csv_file):
+        """
+        Adds the rows of a messages CSV that still need extraction (text longer than
+        100 characters and no 'json' result) with their scheduler priority. Rows already
+        in the queue are left alone. Rows queued later (new posts) are claimed before
+        the older backlog whenever their priority is higher.
+
+        Returns:
+            int: Number of newly queued rows.
+        """
+        from llm import read_csv
+
+        df = read_csv(csv_file)
+        if "id" not in df.columns:
+            raise ValueError("CSV must contain an 'id' column")
+        columns = [c for c in ("id", "text", "date", "time", "reactions", "json") if c in df.columns]
+        return self.enqueue_records(csv_file, (dict(zip(columns, values)) for values in zip(*(df[c] for c in columns))))
+
+    def enqueue_records(self, csv_file, records):
+        """
+        Adds message records that belong to csv_file (e.g. just parsed by watcher.py, before
+        anyone reads the CSV back). Records that are too short or already have a 'json'
+        result are skipped, like in enqueue_csv.
+
+        Returns:
+            int: Number of newly queued rows.
+        """
+        from scheduler import estimate_tokens, priority
+
+        source = self._source_key(csv_file)
+        now = time.time()
+        rows = []
+        for record in records:
+            text = record.get("text")
+            if isinstance(text, str) and len(text) > 100 and not isinstance(record.get("json"), str):
+                rows.append((source, str(record["id"]), text, priority(record), estimate_tokens(text), now))
+
+        def insert(cursor):
+            before = self.conn.total_changes
+            cursor.executemany("INSERT OR IGNORE INTO tasks (source, message_id, text, priority, tokens, updated) "
+                               "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            return self.conn.total_changes - before
+
+        added = self._transaction(insert)
+        logger.info(f"Queued {added} of {len(rows)} pending rows from {csv_file}")
+        return added
+
+    def claim(self, worker, limit=WORK_QUEUE_CLAIM_SIZE, max_tokens=None, max_attempts=MAX_RETRIES):
+        """
+        Leases up to limit claimable rows (pending, or leased with an expired lease) to worker,
+        highest priority first. Expired rows that were already claimed max_attempts times are
+        marked failed instead: a message that crashes or hangs its worker never reaches release.
+
+        Parameters:
+            worker (str): Name of the claiming worker.
+            limit (int): Maximum number of rows.
+            max_tokens (int): Only claim rows estimated at no more than this many tokens in
+                total (the worker's remaining budget), None for no limit.
+            max_attempts (int): Claims after which an abandoned row is given up.
+
+        Returns:
+            list: (source, message_id, text, tokens) tuples.
+        """
+        def claim_rows(cursor):
+            now = time.time()
+            # Cheap rows further down can still fit what is left of a token budget
+            wanted = limit if max_tokens is None else limit * 10
+            cursor.execute(
+                "UPDATE tasks SET status = ?, lease_owner = NULL, lease_expires = NULL, updated = ? "
+                "WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                (FAILED, now, LEASED, now, max_attempts))
+            if cursor.rowcount:
+                logger.warning(f"Gave up on {cursor.rowcount} rows whose lease expired after {max_attempts} claims")
+            # Pending rows come straight off tasks_claimable in priority order, stopping after
+            # wanted rows; expired leases are found through tasks_expiring, so neither query
+            # walks the whole pending set or every live lease while holding the write lock
+            candidates = cursor.execute(
+                "SELECT source, message_id, text, tokens, priority FROM tasks WHERE status = ? "
+                "ORDER BY priority DESC LIMIT ?", (PENDING, wanted)).fetchall()
+            candidates += cursor.execute(
+                "SELECT source, message_id, text, tokens, priority FROM tasks WHERE status = ? AND lease_expires < ? "
+                "ORDER BY priority DESC LIMIT ?", (LEASED, now, wanted)).fetchall()
+            candidates = sorted(candidates, key=lambda row: row[4], reverse=True)[:wanted]
+            rows = []
+            remaining = max_tokens
+            for source, message_id, text, tokens, _ in candidates:
+                if remaining is not None:
+                    if tokens > remaining:
+                        continue
+                    remaining -= tokens
+                rows.append((source, message_id, text, tokens))
+                if len(rows) == limit:
+                    break
+            cursor.executemany(
+                "UPDATE tasks SET status = ?, lease_owner = ?, lease_expires = ?, "
+                "attempts = attempts + 1, updated = ? WHERE source = ? AND message_id = ?",
+                [(LEASED, worker, now + self.lease_seconds, now, source, message_id)
+                 for source, message_id, _, _ in rows])
+            return rows
+
+        return self._transaction(claim_rows)
+
+    def heartbeat(self, worker, keys):
+        """
+        Extends the lease of the given (source, message_id) keys that worker still holds.
+
+        Returns:
+            int: Number of leases extended.
+        """
+        def extend(cursor):
+            before = self.conn.total_changes
+            expires = time.time() + self.lease_seconds
+            cursor.executemany(
+                "UPDATE tasks SET lease_expires = ? "
+                "WHERE source = ? AND message_id = ? AND status = ? AND lease_owner = ?",
+                [(expires, source, message_id, LEASED, worker) for source, message_id in keys])
+            return self.conn.total_changes - before
+
+        return self._transaction(extend)
+
+    def complete(self, worker, source, message_id, result):
+        """
+        Stores the result of a leased row. Ignored if the lease was lost in the meantime
+        (it expired and another worker claimed the row).
+
+        Returns:
+            bool: True if the result was stored.
+        """
+        def store(cursor):
+            cursor.execute(
+                "UPDATE tasks SET status = ?, result = ?, lease_owner = NULL, lease_expires = NULL, updated = ? "
+                "WHERE source = ? AND message_id = ? AND status = ? AND lease_owner = ?",
+                (DONE, result, time.time(), source, message_id, LEASED, worker))
+            return cursor.rowcount == 1
+
+        return self._transaction(store)
+
+    def release(self, worker, source, message_id, max_attempts=MAX_RETRIES):
+        """
+        Returns a row whose extraction failed to the queue, or marks it failed after max_attempts claims.
+        """
+        def give_back(cursor):
+            cursor.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, "
+                "lease_owner = NULL, lease_expires = NULL, updated = ? "
+                "WHERE source = ? AND message_id = ? AND status = ? AND lease_owner = ?",
+                (max_attempts, FAILED, PENDING, time.time(), source, message_id, LEASED, worker))
+
+        self._transaction(give_back)
+
+    def retry_failed(self):
+        """Moves failed rows back to pending with a fresh attempt count."""
+        def reset(cursor):
+            cursor.execute("UPDATE tasks SET status = ?, attempts = 0, updated = ? WHERE status = ?",
+                           (PENDING, time.time(), FAILED))
+            return cursor.rowcount
+
+        return self._transaction(reset)
+
+    def remaining(self):
+        """Number of rows that are pending or leased."""
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM tasks WHERE status IN (?, ?)",
+                                     (PENDING, LEASED)).fetchone()[0]
+
+    def stats(self):
+        """
+        Returns:
+            dict: Dictionary {source: {status: count}}, with leased rows split into
+                  "leased" and "expired".
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT source, CASE WHEN status = ? AND lease_expires < ? THEN 'expired' ELSE status END, "
+                "COUNT(*) FROM tasks GROUP BY 1, 2", (LEASED, time.time())).fetchall()
+        stats = {}
+        for source, status, count in rows:
+            stats.setdefault(source, {})[status] = count
+        return stats
+
+    def apply_results(self, on_applied=None):
+        """
+        Writes the finished results into the 'json' column of their CSV files.
+        Each file is replaced atomically, so readers never see a half-written CSV.
+
+        Parameters:
+            on_applied (callable): Optional on_applied(csv_file, {message_id: result}),
+                called with the results written into each file.
+
+        Returns:
+            int: Number of results written.
+        """
+        from llm import read_csv
+        from metrics import span
+
+        with self._lock:
+            rows = self.conn.execute("SELECT source, message_id, result FROM tasks WHERE status = ?",
+                                     (DONE,)).fetchall()
+        by_source = {}
+        for source, message_id, result in rows:
+            by_source.setdefault(source, {})[message_id] = result
+
+        written = 0
+        for source, results in by_source.items():
+            csv_file = self._source_path(source)
+            if not os.path.exists(csv_file):
+                logger.warning(f"{csv_file} no longer exists, skipping {len(results)} results")
+                continue
+            df = read_csv(csv_file)
+            ids = df["id"].astype(str)
+            missing = ~df["json"].map(lambda value: isinstance(value, str))
+            update = missing & ids.isin(results.keys())
+            df.loc[update, "json"] = ids[update].map(results)
+            if update.any():
+                tmp_path = f"{csv_file}.{os.getpid()}.tmp"
+                with span("apply_results", file=csv_file, rows=int(update.sum())):
+                    df.to_csv(tmp_path, index=False, encoding="utf-8-sig")
+                    os.replace(tmp_path, csv_file)
+
+            def mark_applied(cursor):
+                cursor.executemany("UPDATE tasks SET status = ? WHERE source = ? AND message_id = ? AND status = ?",
+                                   [(APPLIED, source, message_id, DONE) for message_id in results])
+
+            self._transaction(mark_applied)
+            written += int(update.sum())
+            logger.info(f"Wrote {int(update.sum())} results to {csv_file}")
+            if on_applied is not None and update.any():
+                on_applied(csv_file, {message_id: results[message_id] for message_id in ids[update]})
+        return written
+
+
+def _heartbeat_loop(queue, worker, keys, stop):
+    """Extends the leases of keys every third of the lease time until stop is set."""
+    while not stop.wait(queue.lease_seconds / 3):
+        try:
+            queue.heartbeat(worker, keys)
+        except sqlite3.Error as e:
+            logger.warning(f"Heartbeat failed: {e}")
+
+
+def run_worker(queue_path=WORK_QUEUE_PATH, claim_size=WORK_QUEUE_CLAIM_SIZE, max_workers=MAX_WORKERS,
+               wait=False, poll_interval=5.0, budget=None, stop=None):
+    """
+    Claims and processes batches until the queue has nothing left to claim.
+
+    Parameters:
+        queue_path (str): Path of the queue database.
+        claim_size (int): Rows leased per claim.
+        max_workers (int): Concurrent API calls within this worker.
+        wait (bool): Keep polling while other workers still hold leases, so rows
+            they abandon are picked up; otherwise stop as soon as nothing is claimable.
+        poll_interval (float): Seconds between polls when waiting.
+        budget (scheduler.Budget): Optional token/cost/time limits of this worker.
+        stop (Event): If given, the worker keeps polling an empty queue (a long-running
+            worker, see watcher.py) until the event is set; the current batch is finished first.
+
+    Returns:
+        int: Number of rows this worker completed.
+    """
+    from llm import extract_entities_batch
+    from metrics import increment, span
+
+    queue = WorkQueue(queue_path)
+    worker = worker_name()
+    completed = 0
+    try:
+        while stop is None or not stop.is_set():
+            if budget is not None and budget.exhausted():
+                logger.info(f"{worker}: budget used up")
+                break
+            max_tokens = budget.remaining_tokens() if budget is not None else None
+            batch = queue.claim(worker, claim_size, max_tokens)
+            if not batch:
+                if stop is not None:
+                    stop.wait(poll_interval)
+                    continue
+                if wait and queue.remaining():
+                    time.sleep(poll_interval)
+                    continue
+                break
+
+            if budget is not None:
+                budget.take(sum(tokens for _, _, _, tokens in batch))
+            keys = [(source, message_id) for source, message_id, _, _ in batch]
+            heartbeat_stop = threading.Event()
+            heartbeat = threading.Thread(target=_heartbeat_loop, args=(queue, worker, keys, heartbeat_stop),
+                                         daemon=True)
+            heartbeat.start()
+            try:
+                with span("queue_batch", worker=worker, rows=len(batch)):
+                    results = extract_entities_batch([text for _, _, text, _ in batch], max_workers=max_workers)
+            finally:
+                heartbeat_stop.set()
+                heartbeat.join()
+
+            for (source, message_id), result in zip(keys, results):
+                if result is None:
+                    queue.release(worker, source, message_id)
+                    increment("queue_released")
+                elif queue.complete(worker, source, message_id, result):
+                    completed += 1
+                    increment("queue_completed")
+                else:
+                    logger.warning(f"Lease on {source}/{message_id} was lost, result discarded")
+                    increment("queue_lease_lost")
+            logger.info(f"{worker}: completed {completed} rows")
+    finally:
+        queue.close()
+    return completed
+
+
+def _worker_process(args):
+    queue_path, claim_size, max_workers, wait, api_key_env, limits = args
+    from llm import setup_logging
+    from scheduler import Budget
+
+    setup_logging()
+    if api_key_env:
+        # extract_entities reads OPENAI_API_KEY, so each process can be given its own key
+        os.environ["OPENAI_API_KEY"] = os.environ[api_key_env]
+    return run_worker(queue_path, claim_size, max_workers, wait, budget=Budget(*limits))
+
+
+def _split_budget(budget, processes):
+    """(max_tokens, max_cost, max_seconds) of one of processes workers sharing budget."""
+    if budget is None:
+        return None, None, None
+    max_tokens = (budget.max_tokens - budget.tokens) // processes if budget.max_tokens is not None else None
+    max_cost = (budget.max_cost - budget.cost) / processes if budget.max_cost is not None else None
+    max_seconds = max(0.0, budget.deadline - time.time()) if budget.deadline is not None else None
+    return max_tokens, max_cost, max_seconds
+
+
+def run_workers(queue_path=WORK_QUEUE_PATH, processes=1, api_key_envs=None, claim_size=WORK_QUEUE_CLAIM_SIZE,
+                max_workers=MAX_WORKERS, wait=False, budget=None):
+    """
+    Runs worker processes on this host. With several API key variables the processes
+    are spread over the keys round-robin. A budget is split evenly between the processes.
+
+    Returns:
+        int: Number of rows completed by all processes.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    api_key_envs = api_key_envs or [None]
+    limits = _split_budget(budget, processes)
+    jobs = [(queue_path, claim_size, max_workers, wait, api_key_envs[i % len(api_key_envs)], limits)
+            for i in range(processes)]
+    if processes == 1:
+        return _worker_process(jobs[0])
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        return sum(executor.map(_worker_process, jobs))
+
+
+def process_with_queue(csv_files, queue_path=WORK_QUEUE_PATH, processes=1, budget=None):
+    """
+    Enqueues the CSV files, works the queue with local processes and writes the results back.
+    This is PROCESSING_METHOD = "queue" in llm.py.
+    """
+    queue = WorkQueue(queue_path)
+    try:
+        for csv_file in csv_files:
+            queue.enqueue_csv(csv_file)
+    finally:
+        queue.close()
+    run_workers(queue_path, processes=processes, budget=budget)
+    queue = WorkQueue(queue_path)
+    try:
+        return queue.apply_results()
+    finally:
+        queue.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lease-based work queue for LLM extraction")
+    parser.add_argument("--queue", default=WORK_QUEUE_PATH, help="Queue database (on a shared folder with working file locks for several hosts)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sub = subparsers.add_parser("enqueue", help="Queue the rows that still need extraction")
+    sub.add_argument("--csv", action="append", default=[], help="Messages CSV (repeatable)")
+    sub.add_argument("--partitions", help="Queue every partition under this root")
+
+    sub = subparsers.add_parser("work", help="Claim and process rows")
+    sub.add_argument("--processes", type=int, default=1, help="Worker processes on this host")
+    sub.add_argument("--api-key-env", action="append", default=[],
+                     help="Environment variable holding an API key (repeatable, spread over the processes)")
+    sub.add_argument("--claim-size", type=int, default=WORK_QUEUE_CLAIM_SIZE, help="Rows leased per claim")
+    sub.add_argument("--threads", type=int, default=MAX_WORKERS, help="Concurrent API calls per process")
+    sub.add_argument("--wait", action="store_true",
+                     help="Keep running until rows leased by other workers are finished or recovered")
+    sub.add_argument("--max-tokens", type=int, help="Estimated tokens this host may spend, best rows first")
+    sub.add_argument("--max-cost", type=float, help="Estimated USD this host may spend")
+    sub.add_argument("--max-seconds", type=float, help="Stop claiming after this many seconds")
+
+    subparsers.add_parser("apply", help="Write finished results into the CSV files")
+    subparsers.add_parser("status", help="Show row counts per file and status")
+    subparsers.add_parser("retry-failed", help="Queue rows that failed MAX_RETRIES times again")
+    args = parser.parse_args()
+
+    from llm import setup_logging
+    setup_logging()
+
+    if args.command == "work":
+        from scheduler import Budget
+        budget = Budget(args.max_tokens, args.max_cost, args.max_seconds)
+        total = run_workers(args.queue, args.processes, args.api_key_env or None, args.claim_size,
+                            args.threads, args.wait, budget)
+        print(f"Completed {total} rows")
+        return
+
+    queue = WorkQueue(args.queue)
+    try:
+        if args.command == "enqueue":
+            csv_files = list(args.csv)
+            if args.partitions:
+                from read_sources import list_partitions
+                csv_files.extend(list_partitions(args.partitions))
+            for csv_file in csv_files:
+                queue.enqueue_csv(csv_file)
+        elif args.command == "apply":
+            print(f"Wrote {queue.apply_results()} results")
+        elif args.command == "retry-failed":
+            print(f"Requeued {queue.retry_failed()} rows")
+        else:
+            for source, counts in sorted(queue.stats().items()):
+                print(f"{source}: " + ", ".join(f"{status} {count}" for status, count in sorted(counts.items())))
+    finally:
+        queue.close()
+
+
+if __name__ == "__main__":
+    main()